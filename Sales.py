@@ -1,35 +1,57 @@
-# Library for data manipulation and analysis
-import pandas as pd
-# Library for interacting with the file system
-import os.path
-# Library for encoding binary data into a URL-safe format
-import base64
-# Library for constructing email messages
-from email.message import EmailMessage
-# Class to create text-based email parts
-from email.mime.text import MIMEText
-# Library to make requests to Google's API
-from google.auth.transport.requests import Request
-# Library to manage user authentication and authorization
-from google.oauth2.credentials import Credentials
-# Library to handle the OAuth 2.0 authorization flow for desktop apps
-from google_auth_oauthlib.flow import InstalledAppFlow
-# Library to create a service object for the Gmail API
-from googleapiclient.discovery import build
-# Library to handle errors from Google's API
-from googleapiclient.errors import HttpError
-# Library to sanitize filenames for security
-from werkzeug.utils import secure_filename
-# Library for common string operations
-import string
-# Library to add delays to the code execution
+# Function that defers heavy libraries until the first function that needs them runs
+from lazy import lazy_import, warm_up
+# Library for data manipulation and analysis, imported the first time a contact file is read or rendered
+pd = lazy_import("pandas")
+# Pool of authenticated Gmail clients shared by every campaign in the process, and its background warm-up
+from gmail_client import shared_client_pool, warm_up_client
+# Class to send messages over persistent SMTP connections, and its optional library (None if it isn't installed)
+from smtp_sender import SmtpSender, aiosmtplib
+# Class to send messages concurrently under the Gmail rate limit, and functions to sort its errors into kinds worth retrying
+from sender import RETRYABLE, GmailSender, error_kind
+# Functions to parse message templates once per campaign
+from message_template import compile_body, compile_lines, compile_template
+# Function to render a whole contact list as columns
+from bulk_render import render_contacts, title_value
+# Functions to stream contact files in bounded chunks, the derived columns their columnar copies store, and pyarrow (None if it isn't installed)
+from contacts import (NORMALIZED_EMAIL, NORMALIZED_LINKEDIN, ROW_FLAGS_COLUMN, UNSENDABLE_BITS, pa, read_contacts, read_derived,
+                      read_header)
+# Class and function to record every send so campaigns can resume without duplicates
+from ledger import LEDGER_DATABASE, SendLedger, content_hash
+# Class that builds each campaign's constant MIME bytes once and splices recipients into them
+from message_assembly import MessageAssembler
+# Library to encode messages in worker processes while earlier batches send
+from concurrent.futures import Future, ProcessPoolExecutor
+# Class that writes messages to a local spool instead of sending them, for dry runs
+from spool import SpoolSender
+# Classes that time each stage of a campaign, record metrics and save each campaign's summary
+from metrics import MetricsStore, StageTimer, shared_registry
+# Library to time reading each batch
 import time
+# Class and functions to skip suppressed recipients and deduplicate contacts across files
+from suppression import SuppressionList, normalize_email, normalize_linkedin
+# Library to hash the campaign settings into a stable campaign ID
+import hashlib
+# Library to serialize the campaign settings
+import json
+
+
+# Imports the libraries campaigns read and render contact files with in a background thread, and returns the thread
+def warm_up_campaigns(transport=None):
+    """
+    Also warms up Google's client libraries if transport is given, with the Gmail discovery document
+    unless the campaigns send over SMTP (see Sales.create_sender for the transports)
+    """
+    if transport is not None:
+        smtp = transport == "smtp" or (transport == "auto" and aiosmtplib is not None)
+        warm_up_client(discovery=not smtp)
+    return warm_up(pd, *(module for module in (pa,) if module is not None))
 
-# Defines the list of authorization scopes required to access the user's Gmail account
-SCOPES = ["https://mail.google.com/", "https://www.googleapis.com/auth/gmail.settings.sharing", "https://www.googleapis.com/auth/gmail.settings.basic"]
 
 # Defines the Sales class to manage contact-related actions
 class Sales:
+    # Stores the RenderCache rendered subjects, bodies and LinkedIn lines are looked up in, or None to render every row
+    render_cache = None
+
     # Initializes the Sales object with personal and contact data
     def __init__(self, first_name, last_name, email, role, mobile, csv, subject=None, body_text=None,linkedin_text=None):
         # Stores the first name of the sender
@@ -42,7 +64,7 @@ class Sales:
         self.role = role 
         # Stores the mobile number of the sender
         self.mobile = mobile
-        # Stores the list of uploaded CSV files containing contacts
+        # Stores the paths of the uploaded CSV files containing contacts
         self.contacts = csv
         # Stores the subject line for the email
         self.subject = subject
@@ -51,137 +73,341 @@ class Sales:
         # Stores the LinkedIn message text
         self.linkedin_text = linkedin_text
 
+    # Returns the sender profile and templates as a plain dictionary, so the campaign can be rebuilt in another process
+    def to_dict(self):
+        return {"first_name": self.first_name, "last_name": self.last_name, "email": self.email, "role": self.role, "mobile": self.mobile,
+                "csv": self.contacts, "subject": self.subject, "body_text": self.body_text, "linkedin_text": self.linkedin_text}
+
+    # Returns the process-wide pool of authenticated Gmail clients, logging in the first time it is needed
+    def service_factory(self):
+        return shared_client_pool()
+
+    # Builds the send engine for a transport
+    def create_sender(self, transport="gmail", service_factory=None, workers=4, limiter=None):
+        """
+        "gmail" sends through the Gmail API, pacing itself to the API's quota with a token bucket, or with
+        limiter if one is given, such as a SharedTokenBucket other processes sending as this account also use.
+        "smtp" sends through Gmail's SMTP server over workers persistent connections, logging in with
+        the same OAuth token, and needs aiosmtplib. "auto" picks SMTP when aiosmtplib is installed,
+        since it isn't held to the API's per-second quota, and the Gmail API otherwise.
+        """
+        if transport == "auto":
+            transport = "smtp" if aiosmtplib is not None else "gmail"
+        if transport == "gmail":
+            return GmailSender(service_factory or self.service_factory(), workers=workers, limiter=limiter)
+        if transport == "smtp":
+            return SmtpSender(username=self.email, credentials=shared_client_pool().credentials, connections=workers)
+        raise ValueError(f"Unknown transport {transport!r}; expected 'gmail', 'smtp' or 'auto'")
+
+    # Returns an ID that stays the same when the same campaign is run again, so a rerun resumes it
+    def campaign_id(self):
+        return hashlib.sha256(json.dumps(self.to_dict(), sort_keys=True).encode()).hexdigest()[:32]
+
     # Reads the CSV file, authenticates with Gmail, and sends emails to each contact
-    def send_email(self):
+    def send_email(self, service_factory=None, workers=4, ledger=None, campaign=None, encode_workers=1, dry_run=None, timer=None, transport="gmail",
+                   suppression=None):
         """
         Reads in CSV file containing sales contacts and sends appropriate email to each
+
+        service_factory builds the Gmail service used by each worker thread; pass one returning a
+        FakeGmailService to run a campaign offline. workers is the number of sends in flight at once.
+        transport picks how messages are delivered (see create_sender).
+        Every send is recorded in the ledger under campaign, so running the same campaign again
+        picks up where it stopped instead of emailing everyone a second time. encode_workers processes
+        assemble the next batch of messages while the current one sends; pass 0 to assemble in this process.
+
+        dry_run is a spool target (an .mbox file, a folder for .eml files or smtp://host:port); when it
+        is given, every message is written there at full speed instead of being sent, and nothing is
+        recorded in the real ledger. Pass a StageTimer as timer to get the time spent in each stage; the
+        totals are also added to the campaign's summary in the metrics database.
+
+        Each address is emailed once however many uploaded files list it, and addresses on the
+        suppression list (the default SuppressionList unless one is handed in) are never emailed.
         """
-        # Initializes the credentials variable to None
-        creds = None
-        # The file token.json stores the user's access and refresh tokens, and is
-        # created automatically when the authorization flow completes for the first time
-        # Checks if the token.json file exists
-        if os.path.exists("token.json"):
-            # Loads credentials from the token.json file
-            creds = Credentials.from_authorized_user_file("token.json", SCOPES)
-        # If there are no (valid) credentials available, let the user log in
-        # Checks if credentials are not valid or not present
-        if not creds or not creds.valid:
-            # If credentials are expired and a refresh token exists, refreshes them
-            if creds and creds.expired and creds.refresh_token:
-                creds.refresh(Request())
-            # Otherwise, initiates the authorization flow to get new credentials
-            else:
-                # Creates an InstalledAppFlow object from the client secrets file
-                flow = InstalledAppFlow.from_client_secrets_file(
-                    "credentials.json", SCOPES
-                )
-                # Runs the local server to handle the authentication redirect and get credentials
-                creds = flow.run_local_server(port=0)
-            # Save the credentials for the next run
-            # Writes the new credentials to the token.json file for future use
-            with open("token.json", "w") as token:
-                token.write(creds.to_json())
-
-        # Starts a try-except block to handle potential API errors
+        # Compiles the subject and body once and checks every file has the columns they use before anything is sent
+        self.check_templates(compile_template(self.subject), compile_body(self.body_text))
+        campaign = campaign or self.campaign_id()
+        timer = timer or StageTimer("dry-run" if dry_run else "email")
+        # Counts the messages sent, failed and skipped across every file
+        totals = {"sent": 0, "failed": 0, "skipped": 0}
+        # Creates the send engine for the transport, or one that writes to the spool on a dry run
+        sender = SpoolSender(dry_run) if dry_run else self.create_sender(transport, service_factory, workers)
+        # Opens the default ledger unless one was handed in, keeping a dry run's ledger in memory so it can't mark anyone as sent
+        own_ledger = ledger is None
+        ledger = ledger or SendLedger(":memory:" if dry_run else LEDGER_DATABASE)
+        # Opens the default suppression list unless one was handed in
+        own_suppression = suppression is None
+        suppression = suppression or SuppressionList()
+        # Starts the processes that encode messages, if any
+        encoder = ProcessPoolExecutor(encode_workers) if encode_workers else None
+        # Initializes send_message in case there are no contacts to send to
+        send_message = None
         try:
             # Iterates through each uploaded contact file
             for file in self.contacts:
-                # Declares 'service' as a global variable
-                global service
-                # Builds a Gmail API service object using the authenticated credentials
-                service = build("gmail", "v1", credentials=creds)
-                # Opens the contact CSV file
-                contacts_file = open(file.filename)
-                # Reads the CSV file into a pandas DataFrame
-                df = pd.read_csv(contacts_file)
-                # Extracts the 'Email' column and converts it to a list
-                emails = df['Email'].tolist()
-                # Generates the email signature
-                signature = self.create_signature()
-
-                # Iterates through the list of email addresses
-                for i in range(len(emails)):
-                    # Creates the personalized email body
-                    body = self.create_body(df, i)
-                    # Creates the personalized email subject
-                    subject = self.create_subject(df, i)
-                    # Creates a MIMEText message object with the body and signature in HTML format
-                    message = MIMEText(f"<!DOCTYPE html>\n<html>\n<body>\n" + body + signature + "\n</body<\n</html>", "html")
-
-                    # Sets the 'From' header of the email.
-                    message["From"] = self.email
-                    # Sets the 'To' header of the email.
-                    message["To"] = emails[i]
-                    # Sets the 'Subject' header of the email.
-                    message["Subject"] = subject
-
-                    # encoded message
-                    # Encodes the email message into a URL-safe base64 string.
-                    encoded_message = base64.urlsafe_b64encode(message.as_bytes()).decode()
-
-                    # Creates a dictionary with the encoded message for the API call
-                    create_message = {"raw": encoded_message}
-                    # Sends the message using the Gmail API
-                    send_message = (
-                        service.users()
-                        .messages()
-                        .send(userId="me", body=create_message)
-                        .execute()
-                    )
-                    # Pauses for 10 seconds to avoid hitting API rate limits
-                    time.sleep(10)
-        # Catches and prints any HttpError that occurs during the API call
-        except HttpError as error:
-            print(f"An error occurred: {error}")
-            # Sets send_message to None in case of an error
-            send_message = None
+                # Sends every message in the file and keeps the response from the last one
+                sent, failed, skipped, response = self.send_contacts(file, sender, ledger, campaign, encoder=encoder, timer=timer, suppression=suppression)
+                send_message = response or send_message
+                totals = {"sent": totals["sent"] + sent, "failed": totals["failed"] + failed, "skipped": totals["skipped"] + skipped}
+        finally:
+            sender.close()
+            if encoder is not None:
+                encoder.shutdown()
+            if own_ledger:
+                ledger.close()
+            if own_suppression:
+                suppression.close()
+            # Saves the campaign's stage times and counts, and publishes this process's metrics
+            MetricsStore().add_campaign(campaign, timer, **totals)
+            shared_registry().flush()
         # Returns the result of the last send message API call
         return send_message
 
-    # Creates the personalized email body by replacing placeholders with data from the DataFrame
+    # Sends rows start to stop of a contact file, skipping rows and recipients the ledger already settled
+    def send_contacts(self, path, sender, ledger, campaign, start=0, stop=None, batch_size=100, encoder=None, timer=None, suppression=None,
+                      schedule=None, zone=None, deadline=None, tally=None):
+        """
+        Returns the number of messages sent, the number that failed, the number of rows skipped and the
+        last successful API response. Recipients a run that stopped mid-batch already sent this exact
+        message to count as sent, since that run stopped before it could count them
+
+        Before anything is rendered, rows without an address, rows on the suppression list and rows whose
+        address an earlier row of the campaign (in this or any other file) already claimed are skipped.
+
+        If encoder is a process pool, each batch is encoded there while the batch before it is sending.
+        The time spent reading, rendering, encoding, checking the ledger and sending is added to timer.
+
+        If zone is given, only the rows the schedule places in that timezone are sent and the other rows
+        are left alone. If deadline is given, no batch starts sending after that time; calling again with
+        the same arguments picks up from the first batch that wasn't sent.
+
+        If tally is a Counter, each batch's sent, failed and skipped counts are added to it once the
+        checkpoint has moved past the batch, and the sends of the batch in progress are kept under
+        "unsettled", so a caller whose run raised knows exactly what was settled and what was sent.
+        """
+        timer = timer or StageTimer()
+        # Identifies this range of the file in the ledger's checkpoints
+        key = f"{path}:{start}" if zone is None else f"{path}:{start}:{zone}"
+        # Skips straight past the rows an earlier run already settled, without reading or rendering them
+        done = ledger.checkpoint(campaign, key)
+        first = start + done
+        if stop is not None and first >= stop:
+            return 0, 0, 0, None
+        # Reads only the Email column and the columns the subject and body reference
+        columns = self.template_columns(["Email"], compile_template(self.subject), compile_body(self.body_text))
+        # Also reads each row's normalized address and flags if the file's columnar copy stores them
+        derived = read_derived(path)
+        if NORMALIZED_EMAIL in derived and ROW_FLAGS_COLUMN in derived:
+            columns += [NORMALIZED_EMAIL, ROW_FLAGS_COLUMN]
+        # Also reads the timezone column when only one timezone's rows are sent
+        if zone is not None and schedule.column not in columns:
+            columns.append(schedule.column)
+        # Builds the headers, HTML wrapper and signature shared by every message once
+        assembler = self.message_assembler()
+        sent = failed = skipped = 0
+        last_response = None
+        offset = 0
+        # Remembers the counts at the end of the last batch, so each batch's outcomes are added to the registry once
+        batch_sent = batch_failed = batch_skipped = 0
+        metrics = shared_registry()
+        # Streams the remaining rows in batches, moving the checkpoint past each batch once all of its sends are recorded
+        batches = read_contacts(path, columns, chunksize=batch_size, start=first, stop=stop)
+        # Filters out rows that won't be sent, then renders and encodes the rest
+        def prepare_next():
+            batch = self.read_batch(batches, timer)
+            if batch is None:
+                return None
+            # Counts every row read towards the checkpoint, but only this timezone's rows towards the outcomes
+            read = len(batch)
+            if zone is not None:
+                batch = batch[schedule.zone_keys(batch[schedule.column]) == zone]
+            kept = self.filter_batch(batch, path, first, ledger, campaign, suppression, timer)
+            return read, len(batch), self.prepare_batch(kept, assembler, encoder, timer)
+        pending = prepare_next()
+        # Stops before the next batch once the send window has closed, leaving the checkpoint at that batch
+        while pending is not None and (deadline is None or time.time() < deadline):
+            read, rows, (batch, encoded) = pending
+            skipped += rows - len(batch)
+            # Starts encoding the next batch so it is ready by the time this one has sent
+            pending = prepare_next()
+            # Waits for the batch's messages, counting the wait as encoding time when another process encodes them
+            with timer.stage("encode", len(batch) if encoder is not None else 0):
+                raws = encoded.result()
+            with timer.stage("ledger", len(batch)):
+                # Pairs each recipient with their encoded message and its content hash
+                messages = [(email, {"raw": raw}, content_hash(raw)) for email, raw in zip(batch["Email"], raws)]
+                # Drops recipients who already got this exact message, in case an earlier run stopped mid-batch, counting them as sent
+                skip = ledger.already_sent(campaign, [(email, digest) for email, _, digest in messages])
+                messages = [entry for entry in messages if (entry[0], entry[2]) not in skip]
+                sent += len(skip)
+                if tally is not None:
+                    tally["unsettled"] += len(skip)
+            # Sends the batch, collecting errors instead of stopping at the first one; the time includes recording each result
+            with timer.stage("send", len(messages)):
+                responses = sender.send_each([message for _, message, _ in messages], return_errors=True)
+                for (email, message, digest), response in zip(messages, responses):
+                    # Records each send as soon as it finishes, with the error for a failure or the Gmail message ID for a success
+                    if isinstance(response, Exception):
+                        ledger.record(campaign, [(email, digest, "failed", None, str(response))])
+                        # Keeps the whole message on the dead-letter list, so it can be replayed once the problem is fixed
+                        ledger.bury(campaign, [(email, digest, message["raw"], error_kind(response), str(response))])
+                        metrics.inc("sales_dead_letters_total", outcome="added")
+                        failed += 1
+                    else:
+                        ledger.record(campaign, [(email, digest, "sent", response.get("id"), None)])
+                        sent += 1
+                        last_response = response
+                        if tally is not None:
+                            tally["unsettled"] += 1
+            # Moves the checkpoint past the batch so a rerun doesn't read it again
+            offset += read
+            ledger.advance(campaign, key, done + offset)
+            # Counts the batch's outcomes
+            for outcome, count in (("sent", sent - batch_sent), ("failed", failed - batch_failed), ("skipped", skipped - batch_skipped)):
+                metrics.inc("sales_messages_total", count, pipeline=timer.pipeline, outcome=outcome)
+                if tally is not None:
+                    tally[outcome] += count
+            if tally is not None:
+                tally["unsettled"] = 0
+            batch_sent, batch_failed, batch_skipped = sent, failed, skipped
+        return sent, failed, skipped, last_response
+
+    # Sends a campaign's dead letters again, resolving each one that is sent or no longer needs to be
+    def replay_dead_letters(self, sender, ledger, campaign, suppression=None, kinds=RETRYABLE, batch_size=100):
+        """
+        Replays the messages that failed with one of the given error kinds, by default rate limits and
+        transient errors; pass None to also replay permanent failures such as bad addresses. Recipients
+        who were sent the same message since, or were added to the suppression list, are skipped. A
+        message that fails again stays on the list. Returns the number sent, failed and skipped
+        """
+        sent = failed = skipped = 0
+        metrics = shared_registry()
+        letters = ledger.dead_letters(campaign, kinds)
+        for i in range(0, len(letters), batch_size):
+            batch = letters[i:i + batch_size]
+            # Resolves letters whose message was delivered by a rerun, or whose recipient has since unsubscribed or bounced
+            delivered = ledger.already_sent(campaign, [(recipient, digest) for _, recipient, digest, _ in batch])
+            suppressed = suppression.contains("email", [recipient for _, recipient, _, _ in batch]) if suppression is not None else set()
+            resolved = [id for id, recipient, digest, _ in batch if (recipient, digest) in delivered or recipient in suppressed]
+            skipped += len(resolved)
+            batch = [letter for letter in batch if letter[0] not in set(resolved)]
+            responses = sender.send_each([{"raw": raw} for _, _, _, raw in batch], return_errors=True)
+            for (id, recipient, digest, raw), response in zip(batch, responses):
+                if isinstance(response, Exception):
+                    ledger.record(campaign, [(recipient, digest, "failed", None, str(response))])
+                    ledger.bury(campaign, [(recipient, digest, raw, error_kind(response), str(response))])
+                    failed += 1
+                else:
+                    ledger.record(campaign, [(recipient, digest, "sent", response.get("id"), None)])
+                    resolved.append(id)
+                    sent += 1
+            ledger.resolve(resolved)
+        for outcome, count in (("sent", sent), ("failed", failed), ("skipped", skipped)):
+            metrics.inc("sales_dead_letters_total", count, outcome=f"replay_{outcome}")
+        return sent, failed, skipped
+
+    # Reads the next batch of contacts, or returns None once the file is used up
+    def read_batch(self, batches, timer):
+        start = time.perf_counter()
+        batch = next(batches, None)
+        timer.add("read", time.perf_counter() - start, 0 if batch is None else len(batch))
+        return batch
+
+    # Returns the rows of a batch worth rendering, with each address normalized
+    def filter_batch(self, batch, path, first, ledger, campaign, suppression=None, timer=None):
+        """
+        first is the file row the batch was read from, so each row can claim its address under its own
+        file and row number, which is how the ledger tells a duplicate from the same row being run again.
+        A batch read with the columnar copy's derived columns uses its stored addresses and flags
+        """
+        timer = timer or StageTimer()
+        with timer.stage("filter", len(batch)):
+            if ROW_FLAGS_COLUMN in batch:
+                # Drops rows flagged on conversion as having no usable address or repeating an earlier row's
+                batch = batch[(batch[ROW_FLAGS_COLUMN] & UNSENDABLE_BITS) == 0]
+                batch = batch.assign(Email=batch[NORMALIZED_EMAIL]).drop(columns=[NORMALIZED_EMAIL, ROW_FLAGS_COLUMN])
+            else:
+                # Normalizes every address, dropping rows without one
+                batch = batch.assign(Email=normalize_email(batch["Email"]))
+                batch = batch[batch["Email"] != ""]
+            # Drops suppressed addresses, which the Bloom filter rules out for most rows without a lookup
+            if suppression is not None and len(batch):
+                batch = batch[~batch["Email"].isin(suppression.contains("email", batch["Email"]))]
+            # Claims each address for its row and drops rows whose address another row already claimed
+            owners = [f"{path}:{first + i}" for i in batch.index]
+            taken = ledger.claim(campaign, list(zip(batch["Email"], owners)))
+            if taken:
+                batch = batch[[(email, owner) not in taken for email, owner in zip(batch["Email"], owners)]]
+        return batch
+
+    # Renders a batch and starts encoding it, returning the batch and a future holding its encoded messages
+    def prepare_batch(self, batch, assembler, encoder=None, timer=None):
+        if batch is None:
+            return None
+        timer = timer or StageTimer()
+        # Skips rendering a batch the filter emptied
+        if not len(batch):
+            encoded = Future()
+            encoded.set_result([])
+            return batch, encoded
+        # Renders every personalized subject and body as whole columns
+        with timer.stage("render", len(batch)):
+            rendered = render_contacts(batch, subject=self.subject, body_text=self.body_text, cache=self.render_cache)
+            rows = list(zip(rendered["Email"], rendered["Subject"], rendered["Body"]))
+        # Encodes in a worker process if there is one
+        if encoder is not None:
+            return batch, encoder.submit(assembler.assemble_many, rows)
+        # Otherwise encodes here and hands back a future that is already done
+        encoded = Future()
+        with timer.stage("encode", len(rows)):
+            encoded.set_result(assembler.assemble_many(rows))
+        return batch, encoded
+
+    # Raises a TemplateError if any uploaded file is missing a column one of the templates references
+    def check_templates(self, *templates):
+        # Iterates through each uploaded contact file
+        for file in self.contacts:
+            # Reads only the header row of the CSV file
+            columns = read_header(file)
+            # Checks the header against every template
+            for template in templates:
+                template.check(columns)
+
+    # Lists the given columns followed by every column the templates reference, each named once
+    def template_columns(self, columns, *templates):
+        return list(dict.fromkeys(columns + [column for template in templates for column in template.columns]))
+
+    # Returns the assembler that holds this campaign's sender and signature
+    def message_assembler(self):
+        return MessageAssembler(self.email, self.create_signature())
+
+    # Generates the encoded Gmail message for each contact in the DataFrame
+    def create_messages(self, df):
+        # Builds the headers, HTML wrapper and signature shared by every message once
+        assembler = self.message_assembler()
+        # Renders every personalized subject and body as whole columns
+        rendered = render_contacts(df, subject=self.subject, body_text=self.body_text, cache=self.render_cache)
+
+        # Iterates through each contact's email address, subject and body
+        for email, subject, body in zip(rendered["Email"], rendered["Subject"], rendered["Body"]):
+            # Creates a dictionary with the encoded message for the API call
+            yield {"raw": assembler.assemble(email, subject, body)}
+
+    # Creates the personalized email body for row i by filling the compiled body template
     def create_body(self, df, i):
-        # Initializes an empty string to store the formatted body
-        body = ""
-        # Splits the body text into a list of lines
-        lines = self.body_text.splitlines()
-        # Iterates through all lines except the last one
-        for x in range(len(lines)-1):
-            # Gets the current line
-            line = lines[x]
-            # Skips the line if it is empty
-            if line == "":
-                continue
-            # Adds a starting HTML paragraph tag to the line
-            new_line = "<p>" + line
-            # Continues replacing placeholders as long as a '{' is found
-            while("{" in new_line):
-                # Extracts the column name from inside the curly braces
-                column_name = new_line[new_line.index("{")+1: new_line.index("}")]
-                # Replaces the placeholder with the corresponding data, formatted with title case
-                new_line = new_line.replace(new_line[new_line.index("{"): new_line.index("}")+1], df[column_name][i].lower().title())
-            # If the current line is the second to last line, appends the last line with a line break
-            if x == len(lines) - 2:
-                new_line += f"<br>{lines[-1]}"
-            # Adds a closing HTML paragraph tag and a newline character
-            new_line += "</p>\n"
-            # Appends the new line to the body string
-            body += new_line
-        # Returns the complete, formatted body string
-        return body
-
-    # Creates the personalized email subject by replacing placeholders with data from the DataFrame
+        # Gets the compiled body template
+        template = compile_body(self.body_text)
+        # Fills each placeholder with the row's value, formatted with title case, unless the cache already has the result
+        values = {column: title_value(df[column].iloc[i]) for column in template.columns}
+        return self.render_cache.render(template, values) if self.render_cache else template.render(values)
+
+    # Creates the personalized email subject for row i by filling the compiled subject template
     def create_subject(self, df, i):
-        # Creates a copy of the subject string
-        new_subject = self.subject
-        # Continues replacing placeholders as long as a '{' is found
-        while("{" in new_subject):
-            # Extracts the column name from inside the curly braces
-            column_name = new_subject[new_subject.index("{")+1: new_subject.index("}")]
-            # Replaces the placeholder with the corresponding data, formatted with title case
-            new_subject = new_subject.replace(new_subject[new_subject.index("{"): new_subject.index("}")+1], df[column_name].tolist()[i].lower().title())
-        # Returns the complete, personalized subject string
-        return new_subject
+        # Gets the compiled subject template
+        template = compile_template(self.subject)
+        # Fills each placeholder with the row's value, formatted with title case, unless the cache already has the result
+        values = {column: title_value(df[column].iloc[i]) for column in template.columns}
+        return self.render_cache.render(template, values) if self.render_cache else template.render(values)
 
     # This function creates the email signature from user input and returns it in html format
     # The reasoning was because the message was formatted strangely if it wasn't in html
@@ -199,260 +425,71 @@ class Sales:
 
     # Generates a list of LinkedIn URLs with personalized messages that can be copied
     def linkedin_list(self):
+        """
+        Returns a generator of HTML chunks making up an ordered list of links, one chunk per block of
+        contacts, so the page can be streamed to the browser while the rest is still being rendered
+        """
+        # Compiles each non-empty line of the message and checks every file has the columns they use before anything is generated
+        templates = compile_lines(self.linkedin_text)
+        self.check_templates(*templates)
+        # Hands the generator the current message text, so changing it mid-stream doesn't affect this list
+        return self.linkedin_items(self.linkedin_text, templates)
+
+    # Yields the ordered list of links block by block, listing each profile once and skipping suppressed profiles
+    def linkedin_items(self, linkedin_text, templates, suppression=None):
         # Initializes a counter for the LinkedIn links
         link_num = 1
-        # Defines a string containing all allowed characters for the message
-        all_alphanumeric = string.ascii_letters + string.digits + " " + "\"\'?!,[]@#$%^&*." # Contains all letters and numbers
-        # Opens the HTML template file in write mode to create the list
-        with open("app\\templates\\linkedin_outreach.html","w") as f:
-            # Writes the starting HTML ordered list tag
-            f.write("<ol class=\"formbold-form-input\">\n")
-            # Iterates through each uploaded contact file
-            for file in self.contacts:
-                # Opens the current contact file, ignoring encoding errors
-                file = open(file.filename,errors="ignore")
-                # Reads the CSV file into a pandas DataFrame
-                df = pd.read_csv(file)
-                # Extracts the 'Person Linkedin Url' column and converts it to a list
-                linkedln_urls = df['Person Linkedin Url'].tolist()
-                # Initializes an empty string to store the list of links
-                linkedin_list = ""
-                # Iterates through the list of LinkedIn URLs
-                for i in range(len(linkedln_urls)):
-                    # Initializes an empty string for the personalized message
-                    message = ""
-                    # Iterates through each line of the provided LinkedIn text
-                    for line in self.linkedin_text.splitlines():
-                        # Skips the line if it is empty
-                        if line == "":
-                            continue
-                        # Continues replacing placeholders as long as a '{' is found
-                        while "{" in line:
-                            # Extracts the column name from inside the curly braces
-                            column_name = line[line.index("{")+1: line.index("}")]
-                            # Gets the value from the DataFrame for the current column and row
-                            val = df[column_name].tolist()[i]
-                            # Replaces the placeholder with the value
-                            line = line.replace(line[line.index("{"): line.index("}")+1], val)
-                        # Iterates through each character in the line to clean it
-                        for char in line:
-                            # If a '/' is found, truncates the line at that point
-                            if char == "/":
-                                line = line[:line.index(char)]
-                                break
-                            # If the character is not alphanumeric, removes it
-                            if char not in all_alphanumeric:
-                                line = line.replace(char, "")
-                        # Adds a new line character after each line
-                        line += "\n\n"
-                        # Appends the formatted line to the message string
-                        message += line
-                    # Replaces smart quotes with standard single quotes
-                    message = message.replace("’","\'")
-                    # Replaces single quotes with a different single quote for consistency
-                    message = message.replace("'","\'")
-                    # Creates an HTML list item with a link that copies the message to the clipboard on click
-                    linkedin_list += f"<li><a href=\"{linkedln_urls[i]}\" onclick = \"navigator.clipboard.writeText(`{message}`)\" target=\"_blank\">Link {link_num}</a></li>\n"
-                    # Increments the link counter
-                    link_num += 1
-                # Writes the generated list of links to the HTML file
-                f.write(linkedin_list)
-            # Adds the closing ordered list tag
-            linkedin_list += "</ol>\n"
-            # Writes a block of CSS to style the generated HTML
-            # CSS pulled from a template on Formbold: https://formbold.com/templates
-            # All credit for this section of styling goes to them
-            f.write("""<style>
-    @import url('https://fonts.googleapis.com/css2?family=Inter:wght@400;500;600;700&display=swap');
-    
-    * {
-    margin: 0;
-    padding: 0;
-    box-sizing: border-box;
-    }
-    
-    body {
-    font-family: 'Inter', sans-serif;
-    }
-    
-    .formbold-mb-3 {
-    margin-bottom: 15px;
-    }
-    
-    .formbold-main-wrapper {
-    display: flex;
-    align-items: center;
-    justify-content: center;
-    padding: 48px;
-    }
-    
-    .formbold-form-wrapper {
-    margin: 0 auto;
-    max-width: 570px;
-    width: 100%;
-    background: white;
-    padding: 40px;
-    }
-    
-    .formbold-img {
-    display: block;
-    margin: 0 auto 45px;
-    }
-    
-    .formbold-input-wrapp>div {
-    display: flex;
-    gap: 20px;
-    }
-    
-    .formbold-input-flex {
-    display: flex;
-    gap: 20px;
-    margin-bottom: 15px;
-    }
-    
-    .formbold-input-flex>div {
-    width: 50%;
-    }
-    
-    .formbold-form-input {
-    width: 100%;
-    padding: 13px 22px;
-    border-radius: 5px;
-    border: 1px solid #dde3ec;
-    background: #ffffff;
-    font-weight: 500;
-    font-size: 16px;
-    color: #536387;
-    outline: none;
-    resize: none;
-    }
-    
-    .formbold-form-input::placeholder,
-    select.formbold-form-input,
-    .formbold-form-input[type='date']::-webkit-datetime-edit-text,
-    .formbold-form-input[type='date']::-webkit-datetime-edit-month-field,
-    .formbold-form-input[type='date']::-webkit-datetime-edit-day-field,
-    .formbold-form-input[type='date']::-webkit-datetime-edit-year-field {
-    color: rgba(83, 99, 135, 0.5);
-    }
-    
-    .formbold-form-input:focus {
-    border-color: #6a64f1;
-    box-shadow: 0px 3px 8px rgba(0, 0, 0, 0.05);
-    }
-    
-    .formbold-form-label {
-    color: #07074D;
-    font-weight: 500;
-    font-size: 14px;
-    line-height: 24px;
-    display: block;
-    margin-bottom: 10px;
-    }
-    
-    .formbold-form-file-flex {
-    display: flex;
-    align-items: center;
-    gap: 20px;
-    }
-    
-    .formbold-form-file-flex .formbold-form-label {
-    margin-bottom: 0;
-    }
-    
-    .formbold-form-file {
-    font-size: 14px;
-    line-height: 24px;
-    color: #536387;
-    }
-    
-    .formbold-form-file::-webkit-file-upload-button {
-    display: none;
-    }
-    
-    .formbold-form-file:before {
-    content: 'Upload file';
-    display: inline-block;
-    background: #EEEEEE;
-    border: 0.5px solid #FBFBFB;
-    box-shadow: inset 0px 0px 2px rgba(0, 0, 0, 0.25);
-    border-radius: 3px;
-    padding: 3px 12px;
-    outline: none;
-    white-space: nowrap;
-    cursor: pointer;
-    color: #637381;
-    font-weight: 500;
-    font-size: 12px;
-    line-height: 16px;
-    margin-right: 20px;
-    }
-    
-    .formbold-btn {
-    text-align: center;
-    width: 100%;
-    font-size: 16px;
-    border-radius: 5px;
-    padding: 14px 25px;
-    border: none;
-    font-weight: 500;
-    background-color: #6a64f1;
-    color: white;
-    cursor: pointer;
-    margin-top: 25px;
-    }
-    
-    .formbold-btn:hover {
-    box-shadow: 0px 3px 8px rgba(0, 0, 0, 0.05);
-    }
-    
-    .formbold-w-45 {
-    width: 45%;
-    }
-    
-    .tooltip {
-    position: relative;
-    display: inline-block;
-    border-bottom: 1px dotted black;
-    }
-    
-    .tooltip .tooltiptext {
-    visibility: hidden;
-    width: 360px;
-    background-color: black;
-    color: #fff;
-    text-align: center;
-    border-radius: 6px;
-    padding: 5px 0;
-    
-    /* Position the tooltip */
-    position: absolute;
-    z-index: 1;
-    top: -5px;
-    left: 105%;
-    }
-    
-    .tooltip:hover .tooltiptext {
-    visibility: visible;
-    }
-    
-    table,
-    th,
-    td {
-    border: 1px solid black;
-    }
-    
-    .vline
-    {
-    position:fixed;
-    top:0;
-    left:50%;
-    bottom:0; margin:0;
-    border:none;
-    border-right:solid 1px black;
-    z-index:10;
-    }""")
-            # Closes the file.
-
-            f.close()
+        # Yields the starting HTML ordered list tag
+        yield "<ol class=\"formbold-form-input\">\n"
+        # Reads only the LinkedIn URL column and the columns the message references
+        columns = self.template_columns(["Person Linkedin Url"], *templates)
+        # Opens the default suppression list unless one was handed in
+        own_suppression = suppression is None
+        suppression = suppression or SuppressionList()
+        # Stores the normalized URL of every profile listed so far, across all files
+        seen = set()
+        # Times reading, filtering and rendering each block
+        timer = StageTimer("linkedin")
+        try:
+            # Streams each uploaded contact file in chunks
+            for file in list(self.contacts):
+                # Also reads each row's normalized URL if the file's columnar copy stores it
+                stored = NORMALIZED_LINKEDIN in read_derived(file)
+                chunks = read_contacts(file, columns + [NORMALIZED_LINKEDIN] if stored else columns)
+                while (df := self.read_batch(chunks, timer)) is not None:
+                    # Drops rows without a profile, duplicates of profiles already listed and suppressed profiles before rendering
+                    with timer.stage("filter", len(df)):
+                        urls = df[NORMALIZED_LINKEDIN] if stored else normalize_linkedin(df["Person Linkedin Url"])
+                        # Probes the set of listed profiles row by row, since isin copies the whole set on every block
+                        listed = pd.Series([url in seen for url in urls], index=urls.index)
+                        keep = (urls != "") & ~urls.duplicated() & ~listed & ~urls.isin(suppression.contains("linkedin", urls))
+                        seen.update(urls[keep])
+                    with timer.stage("render", int(keep.sum())):
+                        block = "".join(self.linkedin_block(df[keep], linkedin_text, link_num))
+                    yield block
+                    link_num += int(keep.sum())
+        finally:
+            if own_suppression:
+                suppression.close()
+            # Publishes this process's metrics
+            shared_registry().flush()
+        # Yields the closing ordered list tag
+        yield "</ol>\n"
 
+    # Yields the list items for one block of contacts, numbered from link_num
+    def linkedin_block(self, df, linkedin_text, link_num):
+        # Skips rendering a block the filter emptied
+        if not len(df):
+            return
+        # Renders the cleaned LinkedIn message for every contact as a whole column
+        rendered = render_contacts(df, linkedin_text=linkedin_text, cache=self.render_cache)
+        # Initializes a list to store the links for this block of contacts
+        linkedin_list = []
+        # Iterates through each contact's LinkedIn URL and message
+        for url, message in zip(rendered["Person Linkedin Url"], rendered["LinkedIn Message"]):
+            # Creates an HTML list item with a link that copies the message to the clipboard on click
+            linkedin_list.append(f"<li><a href=\"{url}\" onclick = \"navigator.clipboard.writeText(`{message}`)\" target=\"_blank\">Link {link_num}</a></li>\n")
+            # Increments the link counter
+            link_num += 1
+        # Yields the links for this block of contacts
+        yield "".join(linkedin_list)
@@ -1,20 +1,57 @@
 # Library to access the Flask application instance 'app' from the 'app' module
 from app import app
 # Library to handle incoming HTTP requests from the Flask library
-from flask import render_template, request
+from flask import Response, jsonify, render_template, request, session, stream_with_context, url_for
+# Library to sanitize filenames for security
+from werkzeug.utils import secure_filename
 # Class to send out emails automatically
 from Sales import Sales
+# Error raised when a message template doesn't match the uploaded contact files
+from message_template import TemplateError, compile_body, compile_template
+# Queue that hands campaigns to the background worker processes
+from jobs import JOBS_DATABASE, JobQueue
+# Stream of a queued campaign's progress as server-sent events
+from progress import STREAM_HEADERS, ProgressStream
+# Send window that spreads a campaign over business hours in each recipient's timezone
+from scheduler import Schedule
+# Cache of rendered sections, turned on by RENDER_CACHE in config.py
+from render_cache import shared_render_cache
 # Library to interact with the operating system
 import os       
-# Library for data manipulation and analysis        
-import pandas as pd
+# Registry that stores each user's campaign outside the web process
+from campaigns import CAMPAIGNS_DATABASE, CampaignRegistry
+# Library to generate a session key when none is configured
+import secrets
+# Indexed store that contact files are imported into
+from contact_store import CONTACTS_DATABASE, REMOVAL_COLUMNS, ContactStore, read_removals
+# Library to read an uploaded removal list as text
+import io
+# Function that converts each upload into a memory-mapped columnar copy once
+from contacts import convert_contacts
+# Check that flags the rows of each upload that can't be emailed or listed, and rejects files missing a required column
+from contact_import import ContactFileError, validate_contacts
+# Library to remove the uploads of a campaign that was turned down
+import shutil
+# Timer that reports how long each stage took, the shared metrics registry and the database every process flushes it into
+from metrics import MetricsStore, StageTimer, shared_registry
 
 # Creates variable to serve as container for name of directory where files will be stored
 UPLOAD_FOLDER = 'uploads'
 # Assigns value to 'UPLOAD_FOLDER' within the application's configuration object
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
-# Creates global variable to store Sales object
-sales = None
+# Assigns the location of the campaign queue database, unless the configuration already set one
+app.config.setdefault('JOBS_DATABASE', JOBS_DATABASE)
+# Assigns the location of the contact store database, unless the configuration already set one
+app.config.setdefault('CONTACTS_DATABASE', CONTACTS_DATABASE)
+# Lets browsers cache static files, such as the outreach page's stylesheet, for a day (config.py can override this)
+app.config['SEND_FILE_MAX_AGE_DEFAULT'] = 86400
+# Assigns the location of the campaign registry database, unless the configuration already set one
+app.config.setdefault('CAMPAIGNS_DATABASE', CAMPAIGNS_DATABASE)
+# Assigns the folder dry runs write their mbox files to, unless the configuration already set one
+app.config.setdefault('SPOOL_FOLDER', 'spool')
+# Signs session cookies with SECRET_KEY from config.py or the environment; every web worker must share the same key
+if not app.config.get('SECRET_KEY'):
+    app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY') or secrets.token_hex()
 
 
 # Renders the 'upload.html' template when the user navigates to the root URL
@@ -31,24 +68,24 @@ def delete_client():
     last_name = request.form['lastname']
     # Retrieves the file path to where the person is stored from the submitted form data
     path = request.form['path']
-    # Iterates over each file in the specified directory path
-    for file in os.listdir(path):
-        # Read the excel file into a pandas DataFrame
-        df = pd.read_csv(path + "\\" + file)
-        # Filter out rows where the specified column matches the value to delete
-        # Iterates through the rows of the 'First Name' column
-        for i in range(len(df['First Name'])):
-            # Checks if the first and last names match the submitted form data
-            if first_name == df['First Name'][i] and last_name == df['Last Name'][i]:
-                # Drops the row with the matching index.
-                df = df.drop(i)
-                # Reset the index after dropping the row
-                # Resets the DataFrame index to ensure it's sequential
-                df = df.reset_index(drop=True)
-                # Writes the updated DataFrame back to the CSV file without the index
-                df.to_csv(path + "\\" + file,index=False)
-                # Returns a success message.
-                return "Successfully removed client!"
+    # Opens the contact store and imports any file in the directory that changed since it was last imported
+    store = ContactStore(app.config['CONTACTS_DATABASE'])
+    timer = StageTimer("delete")
+    try:
+        with timer.stage("import"):
+            sources = store.import_directory(path)
+        # Deletes the person with an indexed lookup on first and last name, then writes back only the files that changed
+        with timer.stage("delete"):
+            changed = store.delete_person(first_name, last_name, sources)
+        with timer.stage("export", len(changed)):
+            for source in changed:
+                store.export_csv(source)
+    finally:
+        store.close()
+        shared_registry().flush()
+    # Returns a success message if the client was found in any file
+    if changed:
+        return "Successfully removed client!"
     # Returns a failure message if the client is not found after iterating through all files
     return "Couldn't find client"
 
@@ -59,33 +96,57 @@ def delete_company():
     company_name = request.form['companyname']
     # Retrieves the file path where people from the company are stored from the submitted form data
     path = request.form['path']
-    # Iterates over each file in the specified directory path
-    for file in os.listdir(path):
-        # Read the excel file into a pandas DataFrame
-        df = pd.read_csv(path + "\\" + file)
-        # Filter out rows where the specified column matches the value to delete
-        # Declares 'ind' as a global variable.
-        global ind
-        # Initializes the index variable 'ind' to 0
-        ind = 0
-        # Iterates through the rows of the 'Company' column
-        for i in range(len(df['Company'])):
-            # Checks if the company name at the current index matches the submitted form data
-            if company_name == df['Company'][ind]:
-                # Drops the row with the matching index
-                df = df.drop(ind)
-                # Reset the index after dropping the row
-                # Resets the DataFrame index to ensure it's sequential
-                df = df.reset_index(drop=True)
-                # Writes the updated DataFrame back to the CSV file without the index
-                df.to_csv(path + "\\" + file,index=False)
-                # Decrements the index to account for the dropped row
-                ind -= 1
-            # Increments the index for the next iteration
-            ind += 1
+    # Opens the contact store and imports any file in the directory that changed since it was last imported
+    store = ContactStore(app.config['CONTACTS_DATABASE'])
+    timer = StageTimer("delete")
+    try:
+        with timer.stage("import"):
+            sources = store.import_directory(path)
+        # Deletes everyone at the company with an indexed lookup, then writes back only the files that changed
+        with timer.stage("delete"):
+            changed = store.delete_company(company_name, sources)
+        with timer.stage("export", len(changed)):
+            for source in changed:
+                store.export_csv(source)
+    finally:
+        store.close()
+        shared_registry().flush()
     # Returns a success message after all matching entries have been processed
     return f"Removed all people from {company_name}!"
 
+# Defines a route for removing a whole list of people, companies or emails in one pass
+@app.route('/contacts-deleted', methods=['POST'])
+def delete_contacts():
+    # Retrieves what the list holds: people, companies or emails
+    kind = request.form.get('kind', 'people')
+    if kind not in REMOVAL_COLUMNS:
+        return jsonify(error=f"Unknown list kind {kind!r}"), 400
+    # Retrieves the file path to where the contacts are stored from the submitted form data
+    path = request.form['path']
+    # Reads the list from an uploaded CSV file if there is one, or from the text box otherwise
+    upload = request.files.get('list')
+    if upload and upload.filename:
+        lines = io.TextIOWrapper(upload.stream, encoding="utf-8", errors="ignore", newline="")
+    else:
+        lines = io.StringIO(request.form.get('entries', ''), newline="")
+    entries = read_removals(lines, kind)
+    # Opens the contact store and imports any file in the directory that changed since it was last imported
+    store = ContactStore(app.config['CONTACTS_DATABASE'])
+    timer = StageTimer("delete")
+    try:
+        with timer.stage("import"):
+            sources = store.import_directory(path)
+        # Deletes every entry in one transaction, then writes each file that changed back once
+        with timer.stage("delete", len(entries)):
+            changed, removed = store.delete_many(sources, **{kind: entries})
+        with timer.stage("export", len(changed)):
+            for source in changed:
+                store.export_csv(source)
+    finally:
+        store.close()
+        shared_registry().flush()
+    return jsonify(removed=removed, files=[os.path.basename(source) for source in changed])
+
 # Defines a route to store the user's information to create a valid email signature and store csv file containing contacts
 @app.route('/action', methods = ['POST'])
 def action():
@@ -99,14 +160,57 @@ def action():
     role = request.form['role']
     # Retrieves the phone # from the submitted form data
     mobile = request.form['phone']
-    # Retrieves the list of uploaded files with the name upload
-    csv = request.files.getlist('upload')
-    # Declares 'sales' as a global variable.
-    global sales
+    # Saves each uploaded file to the upload folder so background workers can read it
+    # Gives the campaign its own ID and upload folder, so reps uploading files with the same name don't overwrite each other
+    campaign_id = CampaignRegistry.new_id()
+    folder = os.path.join(app.config['UPLOAD_FOLDER'], campaign_id)
+    os.makedirs(folder, exist_ok=True)
+    csv = []
+    for file in request.files.getlist('upload'):
+        # Skips the empty part a browser sends when no file was picked, and names that sanitize to nothing
+        name = secure_filename(file.filename or '')
+        if not name:
+            continue
+        path = os.path.join(folder, name)
+        file.save(path)
+        csv.append(path)
+    if not csv:
+        shutil.rmtree(folder, ignore_errors=True)
+        return "Please choose at least one contact file to upload.", 400
+    # Converts each upload to a columnar copy, so sending, listing and importing it read that instead of parsing the CSV again
+    for path in csv:
+        convert_contacts(path)
+    # Checks each upload before anything is imported, sharing the addresses seen so repeats across files are flagged too
+    seen = set()
+    try:
+        reports = [validate_contacts(path, seen).to_dict() for path in csv]
+    except ContactFileError as error:
+        shutil.rmtree(folder, ignore_errors=True)
+        return f"Couldn't import your contacts: {error}", 400
+    # Imports the uploads into the contact store, so later deletes and lookups use its indexes
+    store = ContactStore(app.config['CONTACTS_DATABASE'])
+    try:
+        for path in csv:
+            store.import_csv(path)
+    finally:
+        store.close()
     # Creates an instance of the 'Sales' class with the form data and uploaded files
     sales = Sales(first_name, last_name, email, role, mobile, csv)
-    # Renders the 'action.html' template
-    return render_template('action.html')
+    # Stores the campaign in the registry and remembers its ID in the user's session
+    CampaignRegistry(app.config['CAMPAIGNS_DATABASE']).save(campaign_id, sales)
+    session['campaign_id'] = campaign_id
+    # Renders the 'action.html' template, which sends the campaign ID back with each form
+    return render_template('action.html', campaign_id=campaign_id, reports=reports)
+
+# Loads the campaign a request belongs to, from the form's campaign ID or else the user's session
+def current_campaign():
+    campaign_id = request.values.get('campaign_id') or session.get('campaign_id')
+    sales = CampaignRegistry(app.config['CAMPAIGNS_DATABASE']).load(campaign_id) if campaign_id else None
+    # Renders through the process's cache if config.py sets RENDER_CACHE (True keeps it in memory, a path also keeps it on disk)
+    cache = app.config.get('RENDER_CACHE')
+    if sales is not None and cache:
+        sales.render_cache = shared_render_cache(None if cache is True else cache)
+    return campaign_id, sales
 
 # Defines a route to handle email sending
 @app.route('/email-sent', methods = ['POST'])
@@ -115,23 +219,97 @@ def email_sent():
     subject = request.form['subject']
     # Retrieves the message from the submitted form data
     body_text = request.form['message']
+    # Loads this user's campaign
+    campaign_id, sales = current_campaign()
+    if sales is None:
+        return "Couldn't find your campaign. Please submit your information and contacts first.", 400
     # Assigns the subject to the 'sales' object
     sales.subject = subject
     # Assigns the body text to the 'sales' object
     sales.body_text = body_text
-    # Calls the 'send_email' method of the 'sales' object
-    sales.send_email()
-    # Returns a success message.
-    return "Successfully sent all emails!"
+    # Checks the templates against the uploaded files, reporting problems before anything is queued
+    try:
+        sales.check_templates(compile_template(subject), compile_body(body_text))
+    except TemplateError as error:
+        return f"Couldn't send emails: {error}", 400
+    # Saves the templates with the campaign
+    CampaignRegistry(app.config['CAMPAIGNS_DATABASE']).save(campaign_id, sales)
+    # Writes the whole campaign to an mbox file instead of sending it, and reports how long each stage took
+    if request.form.get('dry_run'):
+        return dry_run(campaign_id, sales)
+    # Queues the campaign for the background workers, within the send window if config.py sets one, and returns its job ID right away
+    job_id = JobQueue(app.config['JOBS_DATABASE']).enqueue(sales, schedule=Schedule.from_config(app.config))
+    return jsonify(job_id=job_id, status_url=f"/jobs/{job_id}", events_url=f"/jobs/{job_id}/events", metrics_url=f"/metrics/{job_id}"), 202
+
+# Runs a campaign through the full pipeline into a fresh mbox file and returns the per-stage timings
+def dry_run(campaign_id, sales):
+    os.makedirs(app.config['SPOOL_FOLDER'], exist_ok=True)
+    spool = os.path.join(app.config['SPOOL_FOLDER'], f"{campaign_id}.mbox")
+    # Starts from an empty file so the spool holds exactly this run
+    if os.path.exists(spool):
+        os.remove(spool)
+    timer = StageTimer("dry-run")
+    sales.send_email(campaign=f"dry-run-{campaign_id}", encode_workers=0, dry_run=spool, timer=timer)
+    return jsonify(spool=spool, stages=timer.summary())
+
+# Defines a route that reports the progress of a queued campaign
+@app.route('/jobs/<job_id>')
+def job_status(job_id):
+    # Looks up the sent, failed and remaining counts for the job
+    status = JobQueue(app.config['JOBS_DATABASE']).status(job_id)
+    # Returns a 404 if there is no job with that ID
+    if status is None:
+        return jsonify(error=f"No job with ID {job_id}"), 404
+    return jsonify(status)
+
+# Defines a route that streams the progress of a queued campaign as server-sent events until it finishes
+@app.route('/jobs/<job_id>/events')
+def job_events(job_id):
+    queue = JobQueue(app.config['JOBS_DATABASE'])
+    # Returns a 404 if there is no job with that ID
+    if queue.status(job_id) is None:
+        return jsonify(error=f"No job with ID {job_id}"), 404
+    return Response(ProgressStream(queue, job_id), mimetype='text/event-stream', headers=STREAM_HEADERS)
+
+# Defines a route that reports every process's metrics in the Prometheus text format
+@app.route('/metrics')
+def metrics():
+    # Publishes the web process's own metrics first, so the response includes them
+    shared_registry().flush()
+    return Response(MetricsStore().prometheus(), mimetype='text/plain; version=0.0.4')
+
+# Defines a route that reports a campaign's stage times and message counts, by job ID or campaign ID
+@app.route('/metrics/<campaign>')
+def campaign_metrics(campaign):
+    summary = MetricsStore().campaign(campaign)
+    # Returns a 404 if nothing was recorded for the campaign
+    if summary is None:
+        return jsonify(error=f"No metrics for campaign {campaign}"), 404
+    return jsonify(summary)
 
 # Defines a route to handle LinkedIn outreach
 @app.route('/linkedin-outreach', methods=['GET', 'POST'])
 def linkedin_outreach():
     # Retrieves the linkedin_message from the submitted form data
     linkedin_text = request.form['linkedin_message']
+    # Loads this user's campaign
+    campaign_id, sales = current_campaign()
+    if sales is None:
+        return "Couldn't find your campaign. Please submit your information and contacts first.", 400
     # Assigns the LinkedIn message to the 'sales' object
     sales.linkedin_text = linkedin_text
-    # Calls the 'linkedin_list' method of the 'sales' object
-    sales.linkedin_list()
-    # Renders the 'linkedin_outreach.html' template
-    return render_template('linkedin_outreach.html')
+    # Saves the message with the campaign
+    CampaignRegistry(app.config['CAMPAIGNS_DATABASE']).save(campaign_id, sales)
+    # Calls the 'linkedin_list' method of the 'sales' object, reporting template problems instead of crashing
+    try:
+        links = sales.linkedin_list()
+    except TemplateError as error:
+        return f"Couldn't generate links: {error}", 400
+    # Streams the page to the browser block by block, with the styling served as a separately cached file
+    return Response(stream_with_context(linkedin_page(links)), mimetype='text/html')
+
+# Wraps the streamed list of links in the page shell that links to the outreach stylesheet
+def linkedin_page(links):
+    yield f"<!DOCTYPE html>\n<html>\n<head>\n<meta charset=\"UTF-8\">\n<link rel=\"stylesheet\" href=\"{url_for('static', filename='outreach.css')}\">\n</head>\n<body>\n"
+    yield from links
+    yield "</body>\n</html>\n"
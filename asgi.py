@@ -0,0 +1,186 @@
+# Library to run views in threads and progress streams on the event loop
+import asyncio
+# Library to bound the threads views run in
+from concurrent.futures import ThreadPoolExecutor
+# Library to encode the error for a job that doesn't exist
+import json
+# Library to read the job ID out of a progress stream's path
+import re
+# Library to pass the server's error stream to the views
+import sys
+# Library to hold each request's body, spilling large uploads to disk
+from tempfile import SpooledTemporaryFile
+# Library to tell a view that its client went away
+import threading
+# The Flask app, whose views are run in threads
+from app import app as flask_app
+# Queue whose campaigns' progress is streamed
+from jobs import JobQueue
+# Stream of a queued campaign's progress as server-sent events
+from progress import STREAM_HEADERS, ProgressStream
+# Function to import the libraries campaigns need in the background once the server starts
+from Sales import warm_up_campaigns
+
+# Matches the path of a job's progress stream
+EVENTS_PATH = re.compile(r"^/jobs/([^/]+)/events$")
+# Defines how much of a request body is held in memory before it is spilled to a temporary file
+BODY_MEMORY_LIMIT = 1024 * 1024
+# Defines how many views run at once unless config.py sets WEB_THREADS
+WEB_THREADS = 8
+# Defines how many threads read job statuses for the progress streams
+STATUS_THREADS = 2
+
+
+# Builds the WSGI environ for an ASGI HTTP request whose body has been read into a file
+def wsgi_environ(scope, body):
+    server = scope.get("server") or ("localhost", 80)
+    environ = {
+        "REQUEST_METHOD": scope["method"],
+        "SCRIPT_NAME": scope.get("root_path", "").encode("utf-8").decode("latin-1"),
+        "PATH_INFO": scope["path"].encode("utf-8").decode("latin-1"),
+        "QUERY_STRING": scope["query_string"].decode("ascii"),
+        "SERVER_NAME": server[0],
+        "SERVER_PORT": str(server[1] or 80),
+        "SERVER_PROTOCOL": f"HTTP/{scope.get('http_version', '1.1')}",
+        "REMOTE_ADDR": (scope.get("client") or ("", 0))[0],
+        "wsgi.version": (1, 0),
+        "wsgi.url_scheme": scope.get("scheme", "http"),
+        "wsgi.input": body,
+        "wsgi.errors": sys.stderr,
+        "wsgi.multithread": True,
+        "wsgi.multiprocess": True,
+        "wsgi.run_once": False,
+    }
+    # Adds each header, joining repeated ones with commas as WSGI servers do
+    for name, value in scope["headers"]:
+        name, value = name.decode("latin-1").upper().replace("-", "_"), value.decode("latin-1")
+        if name not in ("CONTENT_TYPE", "CONTENT_LENGTH"):
+            name = f"HTTP_{name}"
+        environ[name] = f"{environ[name]},{value}" if name in environ else value
+    return environ
+
+
+# Defines the ASGI app that serves the Flask app from an ASGI server such as uvicorn
+class AsgiApp:
+    """
+    Runs each Flask view in a pool of at most threads threads, so a long campaign route only holds one of
+    them and the server keeps accepting requests, and a view streaming a response stops once its client
+    disconnects. Serves /jobs/<job ID>/events on the event loop itself, so the many progress streams one
+    process can host hold no thread while they wait between status checks
+    """
+    # Initializes the thread pools views and status checks run in, and whether to warm up when the server starts
+    def __init__(self, wsgi_app, jobs_database, threads=WEB_THREADS, warm=True):
+        self.wsgi_app = wsgi_app
+        self.warm = warm
+        self.queue = JobQueue(jobs_database)
+        self.views = ThreadPoolExecutor(threads, thread_name_prefix="view")
+        self.statuses = ThreadPoolExecutor(STATUS_THREADS, thread_name_prefix="status")
+
+    # Handles one ASGI connection
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            return await self.lifespan(receive, send)
+        # Turns down WebSocket connections, since progress is streamed over plain HTTP
+        if scope["type"] != "http":
+            return await send({"type": "websocket.close"})
+        match = EVENTS_PATH.match(scope["path"])
+        if match and scope["method"] == "GET":
+            return await self.stream_progress(match.group(1), receive, send)
+        await self.call_view(scope, receive, send)
+
+    # Acknowledges the server starting up, warming up in the background, and shuts the thread pools down when it stops
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                if self.warm:
+                    warm_up_campaigns()
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                self.views.shutdown(wait=False)
+                self.statuses.shutdown(wait=False)
+                return await send({"type": "lifespan.shutdown.complete"})
+
+    # Returns a task that finishes when the client disconnects
+    @staticmethod
+    def watch_disconnect(receive):
+        async def wait():
+            while (await receive())["type"] != "http.disconnect":
+                pass
+        return asyncio.ensure_future(wait())
+
+    # Reads the request body, then runs the Flask view in a thread and sends back what it returns
+    async def call_view(self, scope, receive, send):
+        with SpooledTemporaryFile(BODY_MEMORY_LIMIT) as body:
+            while True:
+                message = await receive()
+                if message["type"] == "http.disconnect":
+                    return
+                body.write(message.get("body", b""))
+                if not message.get("more_body"):
+                    break
+            body.seek(0)
+            # Lets the view stop streaming once the client has gone away
+            gone = threading.Event()
+            disconnected = self.watch_disconnect(receive)
+            disconnected.add_done_callback(lambda task: gone.set())
+            try:
+                loop = asyncio.get_running_loop()
+                await loop.run_in_executor(self.views, self.run_view, loop, wsgi_environ(scope, body), send, gone)
+            finally:
+                disconnected.cancel()
+
+    # Runs the Flask app for one request in a view thread, handing each part of the response to the event loop
+    def run_view(self, loop, environ, send, gone):
+        # Sends a message through the event loop, waiting for it so a slow client slows the view down
+        def send_message(message):
+            asyncio.run_coroutine_threadsafe(send(message), loop).result()
+        response = {}
+        # Stores the status and headers until the first part of the body is ready, as WSGI servers do
+        def start_response(status, headers, exc_info=None):
+            if exc_info and response.get("sent"):
+                raise exc_info[1].with_traceback(exc_info[2])
+            response["start"] = {"type": "http.response.start", "status": int(status.split(" ", 1)[0]),
+                                 "headers": [(name.lower().encode("latin-1"), value.encode("latin-1")) for name, value in headers]}
+            return lambda data: send_message({"type": "http.response.body", "body": data, "more_body": True})
+        chunks = self.wsgi_app(environ, start_response)
+        try:
+            for chunk in chunks:
+                if gone.is_set():
+                    return
+                if not response.get("sent"):
+                    send_message(response["start"])
+                    response["sent"] = True
+                if chunk:
+                    send_message({"type": "http.response.body", "body": chunk, "more_body": True})
+            if not response.get("sent"):
+                send_message(response["start"])
+            send_message({"type": "http.response.body"})
+        finally:
+            # Closes the response, which ends a streaming view's generator early if the client went away
+            if hasattr(chunks, "close"):
+                chunks.close()
+
+    # Streams a job's progress as server-sent events until it finishes or the client disconnects
+    async def stream_progress(self, job_id, receive, send):
+        loop = asyncio.get_running_loop()
+        # Returns a 404 if there is no job with that ID, as the Flask route does
+        if await loop.run_in_executor(self.statuses, self.queue.status, job_id) is None:
+            await send({"type": "http.response.start", "status": 404, "headers": [(b"content-type", b"application/json")]})
+            return await send({"type": "http.response.body", "body": json.dumps({"error": f"No job with ID {job_id}"}).encode()})
+        headers = [(b"content-type", b"text/event-stream")] + [(name.lower().encode(), value.encode()) for name, value in STREAM_HEADERS.items()]
+        await send({"type": "http.response.start", "status": 200, "headers": headers})
+        disconnected = self.watch_disconnect(receive)
+        try:
+            async for event in ProgressStream(self.queue, job_id).events(self.statuses):
+                if disconnected.done():
+                    return
+                await send({"type": "http.response.body", "body": event.encode(), "more_body": True})
+            await send({"type": "http.response.body"})
+        finally:
+            disconnected.cancel()
+
+
+# Creates the ASGI app, served with an ASGI server such as `uvicorn asgi:app`
+app = AsgiApp(flask_app, flask_app.config['JOBS_DATABASE'], flask_app.config.get('WEB_THREADS', WEB_THREADS),
+              flask_app.config.get('WARM_UP', True))
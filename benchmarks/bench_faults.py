@@ -0,0 +1,122 @@
+"""
+Sends a campaign through a fake Gmail service that injects faults, then replays its dead letters against a healthy one
+
+Usage: python benchmarks/bench_faults.py --messages 2000 --error-rate 0.05 --timeout-rate 0.01 --outage 1,3 --invalid 20
+
+The faulty service fails --error-rate of sends with a 500 or 503, times out --timeout-rate of them, fails
+every send during the --outage window of seconds with a 503 and rejects the --invalid addresses with a
+400. Backoff delays are multiplied by --backoff-scale so a run takes seconds rather than minutes. Checks
+that every address but the invalid ones got exactly one message across the campaign and the replay.
+"""
+# Library to read command line options
+import argparse
+# Library to decode sent messages to find who they went to
+import base64
+# Library to count the messages each address got
+from collections import Counter
+# Library to read the recipient out of a message's headers
+from email.parser import BytesHeaderParser
+# Library to let the benchmark import modules from the project root and work in a scratch folder
+import os
+import sys
+# Library for the scratch folder
+import tempfile
+# Library to time the campaign
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Function that writes synthetic Apollo-style contact files
+from synthetic import write_contacts
+# Class that stores user information and sends campaigns
+from Sales import Sales
+# Function that streams contact files
+from contacts import read_contacts
+# Fake Gmail service that injects faults
+from fake_gmail import FakeGmailService
+# Ledger that keeps the dead-letter list
+from ledger import SendLedger
+# Registry the sender counts retries and breaker openings in
+from metrics import shared_registry
+# Classes that send under the rate limiter and circuit breaker
+from sender import CircuitBreaker, GmailSender, TokenBucket
+# List of addresses that must never be emailed
+from suppression import SuppressionList, normalize_email
+
+# Defines the templates and sender profile used for the run
+SUBJECT = "Quick question for {First Name}"
+BODY = "Hi {First Name},\n\nWould you be open to a quick chat?\nThanks,\nJane"
+PROFILE = {"first_name": "Jane", "last_name": "Doe", "email": "jane@example.com", "role": "Founder", "mobile": "5555555555"}
+
+
+# Returns the recipient of every message a fake service accepted
+def recipients(service):
+    return [BytesHeaderParser().parsebytes(base64.urlsafe_b64decode(body["raw"]))["To"] for body in service.sent]
+
+
+# Adds up a counter in the shared registry over every series with the given labels
+def counter(metric, **labels):
+    return sum(value for (name, series, series_labels), value in shared_registry().values.items()
+               if name == metric and series == metric and set(labels.items()) <= set(series_labels))
+
+
+# Builds a sender over a fake service, with no quota and a breaker that cools down quickly
+def make_sender(service, options):
+    return GmailSender(lambda: service, workers=options.workers, limiter=TokenBucket(rate=1e12), max_retries=options.retries,
+                       breaker=CircuitBreaker(threshold=5, cooldown=0.5, max_cooldown=4.0),
+                       sleep=lambda seconds: time.sleep(seconds * options.backoff_scale))
+
+
+# Runs the campaign against the faulty service, replays its dead letters and prints what happened
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--messages", type=int, default=2000, help="number of contacts")
+    parser.add_argument("--workers", type=int, default=8, help="sends in flight at once")
+    parser.add_argument("--error-rate", type=float, default=0.05, help="share of sends that fail with a 500 or 503")
+    parser.add_argument("--timeout-rate", type=float, default=0.01, help="share of sends that time out")
+    parser.add_argument("--outage", default="1,3", help="start and end, in seconds, of a window in which every send fails; empty for none")
+    parser.add_argument("--invalid", type=int, default=20, help="number of addresses rejected as invalid")
+    parser.add_argument("--retries", type=int, default=3, help="retries per message before it goes to the dead-letter list")
+    parser.add_argument("--backoff-scale", type=float, default=0.05, help="factor applied to every backoff delay")
+    parser.add_argument("--latency", type=float, default=0.002, help="seconds each send takes")
+    parser.add_argument("--seed", type=int, default=0, help="seed for which sends fail")
+    args = parser.parse_args()
+
+    scratch = tempfile.mkdtemp(prefix="bench-faults-")
+    path = write_contacts(os.path.join(scratch, "contacts.csv"), args.messages)
+    emails = [email for chunk in read_contacts(path, ["Email"]) for email in normalize_email(chunk["Email"])]
+    invalid = emails[::max(1, len(emails) // args.invalid)][:args.invalid] if args.invalid else []
+    outage = tuple(float(value) for value in args.outage.split(",")) if args.outage else None
+    sales = Sales(**PROFILE, csv=[path], subject=SUBJECT, body_text=BODY)
+    ledger = SendLedger(os.path.join(scratch, "ledger.sqlite3"))
+    suppression = SuppressionList(os.path.join(scratch, "suppression.sqlite3"))
+
+    faulty = FakeGmailService(latency=args.latency, faults=[(args.error_rate / 2, 500), (args.error_rate / 2, 503), (args.timeout_rate, TimeoutError)],
+                              outage=outage, invalid_recipients=invalid, seed=args.seed)
+    start = time.perf_counter()
+    sent, failed, skipped, _ = sales.send_contacts(path, make_sender(faulty, args), ledger, "bench-faults", encoder=None, suppression=suppression)
+    seconds = time.perf_counter() - start
+    dead = ledger.dead_letter_counts("bench-faults")
+    print(f"campaign: {sent} sent, {failed} failed, {skipped} skipped in {seconds:.2f}s; {faulty.injected} faults injected")
+    print(f"retries: {counter('sales_send_retries_total', reason='transient')} transient, "
+          f"{counter('sales_send_retries_total', reason='rate_limit')} rate limit; breaker opened {counter('sales_circuit_opens_total')} times")
+    print(f"dead letters: {dead}")
+
+    healthy = FakeGmailService(latency=args.latency, invalid_recipients=invalid)
+    replayed, failed_again, skipped_again = sales.replay_dead_letters(make_sender(healthy, args), ledger, "bench-faults", suppression)
+    print(f"replay: {replayed} sent, {failed_again} failed again, {skipped_again} skipped; "
+          f"left on the list: {ledger.dead_letter_counts('bench-faults')}")
+    ledger.close()
+    suppression.close()
+
+    # Checks that nobody was emailed twice and only the invalid addresses were never reached
+    counts = Counter(recipients(faulty) + recipients(healthy))
+    duplicates = [email for email, count in counts.items() if count > 1]
+    missing = set(emails) - set(counts) - set(invalid)
+    print(f"check: {len(counts)} of {len(emails)} addresses reached, {len(duplicates)} emailed twice, {len(missing)} valid addresses missed")
+    if duplicates or missing:
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,104 @@
+"""
+Compares building a Gmail service for every send with borrowing pooled keep-alive clients, against a local HTTP stand-in for Gmail
+
+Usage: python benchmarks/bench_gmail_client.py --sends 500 --threads 4
+"""
+# Library to read command line options
+import argparse
+# Library to run sends on several threads
+from concurrent.futures import ThreadPoolExecutor
+# Library for the local stand-in for the Gmail API
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+# Library to let the benchmark import modules from the project root
+import os
+import sys
+# Library to run the stand-in server in the background
+import threading
+# Library to time each path
+import time
+# Library that provides the HTTP connections the clients send over
+import httplib2
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Library to create credentials that don't need a login
+from google.oauth2.credentials import Credentials
+# Library that attaches the access token to every request
+from google_auth_httplib2 import AuthorizedHttp
+# Library to create a service object for the Gmail API from a discovery document
+from googleapiclient.discovery import build_from_document
+# Classes that manage credentials and pool Gmail clients
+from gmail_client import CredentialManager, GmailClientPool, discovery_document
+# Library to read the discovery document that ships with Google's client
+from googleapiclient.discovery_cache import get_static_doc
+
+# Defines the body the stand-in returns for every send
+RESPONSE = b'{"id": "18c0ffee", "threadId": "18c0ffee", "labelIds": ["SENT"]}'
+
+
+# Defines a request handler that answers every send the way Gmail does, over keep-alive connections
+class GmailStandIn(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # Sends the headers and body without waiting on Nagle's algorithm, as Gmail's front end does
+    disable_nagle_algorithm = True
+
+    # Reads the request body and returns a canned response
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(RESPONSE)))
+        self.end_headers()
+        self.wfile.write(RESPONSE)
+
+    # Keeps the benchmark output free of request logs
+    def log_message(self, format, *args):
+        pass
+
+
+# Sends a message with a service that is rebuilt from scratch, the way send_email used to for every file
+def send_with_new_service(endpoint, creds):
+    service = build_from_document(get_static_doc("gmail", "v1"), http=AuthorizedHttp(creds, http=httplib2.Http()), client_options={"api_endpoint": endpoint})
+    return service.users().messages().send(userId="me", body={"raw": "aGk="}).execute()
+
+
+# Sends a message with a client borrowed from the pool
+def send_with_pool(pool):
+    with pool.client() as service:
+        return service.users().messages().send(userId="me", body={"raw": "aGk="}).execute()
+
+
+# Runs count sends on the given number of threads and returns how many seconds they took
+def timed(count, threads, send):
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        list(pool.map(lambda _: send(), range(count)))
+    return time.perf_counter() - start
+
+
+# Starts the stand-in, times both paths and prints sends per second for each
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--sends", type=int, default=500, help="number of messages to send on each path")
+    parser.add_argument("--threads", type=int, default=4, help="number of concurrent senders")
+    args = parser.parse_args()
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), GmailStandIn)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    endpoint = f"http://127.0.0.1:{server.server_port}/"
+    creds = Credentials(token="benchmark")
+
+    pool = GmailClientPool(CredentialManager(credentials=creds), size=args.threads, api_endpoint=endpoint)
+    discovery_document()
+    results = [
+        ("new service per send", timed(args.sends, args.threads, lambda: send_with_new_service(endpoint, creds))),
+        ("pooled keep-alive clients", timed(args.sends, args.threads, lambda: send_with_pool(pool))),
+    ]
+    server.shutdown()
+    print(f"{args.sends} sends on {args.threads} threads")
+    for name, seconds in results:
+        print(f"{name:<28}{seconds:>9.3f}s{args.sends / seconds:>12,.0f} sends/s")
+
+
+if __name__ == "__main__":
+    main()
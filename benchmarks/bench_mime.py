@@ -0,0 +1,92 @@
+"""
+Compares building a MIMEText object for every message with splicing recipients into pre-built MIME bytes
+
+Usage: python benchmarks/bench_mime.py --messages 50000 --processes 4
+"""
+# Library to read command line options
+import argparse
+# Library for encoding binary data into a URL-safe format
+import base64
+# Library to encode batches in worker processes
+from concurrent.futures import ProcessPoolExecutor
+# Class to create text-based email parts
+from email.mime.text import MIMEText
+# Library to let the benchmark import modules from the project root
+import os
+import sys
+# Library to time each assembly path
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Class that stores user information and renders messages
+from Sales import Sales
+# Class that builds each campaign's constant MIME bytes once
+from message_assembly import HTML_CLOSE, HTML_OPEN
+
+# Defines how many messages are handed to a worker process at a time
+BATCH_SIZE = 100
+
+
+# Builds synthetic rendered messages as (to, subject, body) tuples
+def make_rows(messages):
+    return [(f"person{i}@example.com", f"Quick question for First{i % 997}",
+             f"Hi First{i % 997},<br><br>I saw that Company {i % 503} Inc is growing.<br><br>Would you be open to a quick chat?")
+            for i in range(messages)]
+
+
+# Assembles every message the way Sales.create_messages used to, with a new MIMEText object each
+def assemble_mimetext(sender, signature, rows):
+    encoded = []
+    for to, subject, body in rows:
+        message = MIMEText(HTML_OPEN + body + signature + HTML_CLOSE, "html")
+        message["From"] = sender
+        message["To"] = to
+        message["Subject"] = subject
+        encoded.append(base64.urlsafe_b64encode(message.as_bytes()).decode())
+    return encoded
+
+
+# Assembles every message in this process with the pre-built bytes
+def assemble_spliced(assembler, rows):
+    return assembler.assemble_many(rows)
+
+
+# Assembles every message with the pre-built bytes, one batch per task across a process pool
+def assemble_pooled(assembler, rows, processes):
+    batches = [rows[i:i + BATCH_SIZE] for i in range(0, len(rows), BATCH_SIZE)]
+    with ProcessPoolExecutor(processes) as pool:
+        return [raw for encoded in pool.map(assembler.assemble_many, batches) for raw in encoded]
+
+
+# Runs a function once and returns how many seconds it took
+def timed(function, *args):
+    start = time.perf_counter()
+    function(*args)
+    return time.perf_counter() - start
+
+
+# Times each assembly path and prints messages per second for each
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--messages", type=int, default=50000, help="number of synthetic messages to assemble")
+    parser.add_argument("--processes", type=int, default=os.cpu_count(), help="worker processes for the pooled path")
+    args = parser.parse_args()
+
+    rows = make_rows(args.messages)
+    sales = Sales("Jane", "Doe", "jane@example.com", "Founder", "5555555555", [])
+    assembler = sales.message_assembler()
+    signature = sales.create_signature()
+
+    results = [
+        ("MIMEText per message", timed(assemble_mimetext, sales.email, signature, rows)),
+        ("pre-built bytes", timed(assemble_spliced, assembler, rows)),
+        (f"pre-built bytes, {args.processes} processes", timed(assemble_pooled, assembler, rows, args.processes)),
+    ]
+    print(f"{args.messages} messages")
+    for name, seconds in results:
+        print(f"{name:<32}{seconds:>9.3f}s{args.messages / seconds:>14,.0f} messages/s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,73 @@
+"""
+Compares rendering a contact list row by row with rendering it as whole columns
+
+Usage: python benchmarks/bench_render.py --rows 100000
+"""
+# Library to read command line options
+import argparse
+# Library to let the benchmark import modules from the project root
+import os
+import sys
+# Library to time each rendering path
+import time
+# Library for data manipulation and analysis
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Class that stores user information and renders messages
+from Sales import Sales
+# Function to render a whole contact list as columns
+from bulk_render import render_contacts
+
+# Defines the templates used for every run
+SUBJECT = "Quick question for {First Name} at {Company Name for Emails}"
+BODY = "Hi {First Name},\n\nI saw that {Company Name for Emails} is growing in {Company City}.\n\nWould you be open to a quick chat?\nThanks,\nMe"
+LINKEDIN = "Hi {First Name}, I came across your profile at {Company Name for Emails}!\n\nLet's connect: {Person Linkedin Url}"
+
+
+# Builds a DataFrame of synthetic contacts shaped like an Apollo export
+def make_contacts(rows):
+    return pd.DataFrame({
+        "First Name": [f"FIRST{i % 997}" for i in range(rows)],
+        "Last Name": [f"last{i % 991}" for i in range(rows)],
+        "Email": [f"person{i}@example.com" for i in range(rows)],
+        "Company Name for Emails": [f"company {i % 503} inc" for i in range(rows)],
+        "Company City": [f"city {i % 101}" for i in range(rows)],
+        "Person Linkedin Url": [f"http://www.linkedin.com/in/person{i}" for i in range(rows)],
+    })
+
+
+# Renders every subject and body one row at a time with Sales.create_subject and Sales.create_body
+def render_per_row(sales, df):
+    return [(sales.create_subject(df, i), sales.create_body(df, i)) for i in range(len(df))]
+
+
+# Runs a function once and returns how many seconds it took
+def timed(function, *args, **kwargs):
+    start = time.perf_counter()
+    function(*args, **kwargs)
+    return time.perf_counter() - start
+
+
+# Times both rendering paths and prints rows per second for each
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--rows", type=int, default=100000, help="number of synthetic contacts to render")
+    args = parser.parse_args()
+
+    df = make_contacts(args.rows)
+    sales = Sales("Jane", "Doe", "jane@example.com", "Founder", "5555555555", [], subject=SUBJECT, body_text=BODY, linkedin_text=LINKEDIN)
+
+    results = [
+        ("per-row subject + body", timed(render_per_row, sales, df)),
+        ("vectorized subject + body", timed(render_contacts, df, subject=SUBJECT, body_text=BODY)),
+        ("vectorized linkedin", timed(render_contacts, df, linkedin_text=LINKEDIN)),
+    ]
+    print(f"{args.rows} rows")
+    for name, seconds in results:
+        print(f"{name:<28}{seconds:>9.3f}s{args.rows / seconds:>14,.0f} rows/s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,93 @@
+"""
+Measures how long a fresh process takes to import the app's entry modules, and how much memory it holds afterwards
+
+Usage: python benchmarks/bench_startup.py --modules Sales jobs app.views --runs 5 --warm
+
+Each run starts a new interpreter, imports one module and records the seconds the import took, the
+process's peak resident memory and which heavy libraries it loaded. It then reads and renders a small
+contact file, the work the first campaign does, and records how long that took and the memory after it.
+With --warm, the run first waits for warm_up_campaigns to finish, as a worker that has been up for a
+moment would. Importing app.views needs a config.py on the path, as run.py does; run from its folder.
+"""
+# Library to read command line options
+import argparse
+# Library to pass each run's results back to the benchmark
+import json
+# Library to let the benchmark import modules from the project root
+import os
+import sys
+# Library to report the middle run of each module
+import statistics
+# Library to start a fresh interpreter for every run
+import subprocess
+# Library for the scratch folder
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Function that writes synthetic Apollo-style contact files
+from synthetic import write_contacts
+
+# Defines the project root each run imports from
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# Defines the libraries a run reports as loaded, since they account for most of the import time
+HEAVY = ("pandas", "numpy", "pyarrow", "httplib2", "googleapiclient.discovery", "google_auth_oauthlib", "aiosmtplib")
+# Defines the code each fresh interpreter runs, with the module, contact file and --warm passed as arguments
+RUN = """
+import importlib, json, os, resource, sys, time
+sys.path[:0] = [os.getcwd(), {root!r}]
+name, path, warm = sys.argv[1], sys.argv[2], sys.argv[3] == "1"
+# Reads peak resident memory in megabytes; Linux reports kilobytes and macOS bytes
+def rss():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024 if sys.platform == "darwin" else 1024)
+start = time.perf_counter()
+importlib.import_module(name)
+result = {{"import": time.perf_counter() - start, "import_rss": rss(), "loaded": [m for m in {heavy!r} if m in sys.modules]}}
+from Sales import Sales, warm_up_campaigns
+if warm:
+    warm_up_campaigns().join()
+start = time.perf_counter()
+sales = Sales("Jane", "Doe", "jane@example.com", "Founder", "5555555555", [path], subject="Hi {{First Name}}", body_text="Hi {{First Name}} at {{Company Name for Emails}}")
+sales.check_templates()
+from contacts import read_contacts
+from bulk_render import render_contacts
+for chunk in read_contacts(path):
+    render_contacts(chunk, sales.subject, sales.body_text)
+result["first_campaign"] = time.perf_counter() - start
+result["campaign_rss"] = rss()
+print(json.dumps(result))
+"""
+
+
+# Runs one module's import in a fresh interpreter and returns what it measured
+def run_once(module, path, warm):
+    code = RUN.format(root=ROOT, heavy=HEAVY)
+    output = subprocess.run([sys.executable, "-c", code, module, path, "1" if warm else "0"], capture_output=True, text=True, check=True)
+    return json.loads(output.stdout.strip().splitlines()[-1])
+
+
+# Runs every module several times and prints the median of each measurement
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--modules", nargs="+", default=["Sales", "jobs", "app.views"], help="modules to import")
+    parser.add_argument("--runs", type=int, default=5, help="fresh processes per module")
+    parser.add_argument("--rows", type=int, default=100, help="contacts in the file the first campaign reads")
+    parser.add_argument("--warm", action="store_true", help="wait for the background warm-up before the first campaign")
+    args = parser.parse_args()
+
+    path = write_contacts(os.path.join(tempfile.mkdtemp(prefix="bench-startup-"), "contacts.csv"), args.rows)
+    for module in args.modules:
+        try:
+            runs = [run_once(module, path, args.warm) for _ in range(args.runs)]
+        except subprocess.CalledProcessError as error:
+            print(f"{module}: run failed\n{error.stderr.strip().splitlines()[-1]}")
+            continue
+        median = {key: statistics.median(run[key] for run in runs) for key in ("import", "import_rss", "first_campaign", "campaign_rss")}
+        print(f"{module}: import {median['import'] * 1000:.0f} ms, {median['import_rss']:.0f} MB; "
+              f"first campaign {median['first_campaign'] * 1000:.0f} ms, {median['campaign_rss']:.0f} MB; "
+              f"loaded at import: {', '.join(runs[0]['loaded']) or 'none'}")
+
+
+if __name__ == "__main__":
+    main()
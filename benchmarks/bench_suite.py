@@ -0,0 +1,354 @@
+"""
+Times each Sales method and Flask route on synthetic contact files of several sizes and saves the results as JSON
+
+Usage: python benchmarks/bench_suite.py --sizes 1000,10000,100000 --output results.json --compare previous.json
+
+Sends go to a FakeGmailService with the rate limiter opened up, so the numbers measure this app rather
+than Gmail's quota. Every case runs twice in a fresh folder: once for time, once under tracemalloc for
+peak memory, since tracing slows the code down. The routes are skipped if the app can't be imported,
+for example when there is no config.py.
+"""
+# Library to read command line options
+import argparse
+# Library to time each case inside its own setup and cleanup
+from contextlib import contextmanager
+# Library to save and load results
+import json
+# Library to let the benchmark import modules from the project root and work in a scratch folder
+import os
+import sys
+# Library to record the machine the results came from
+import platform
+# Library to copy contact files and clear scratch folders
+import shutil
+# Library to record the commit the results came from
+import subprocess
+# Library for the scratch folders
+import tempfile
+# Library to time each case
+import time
+# Library to measure each case's peak memory
+import tracemalloc
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+# Library for data manipulation and analysis
+import pandas as pd
+# Function that writes synthetic Apollo-style contact files
+from synthetic import write_contacts
+# Class that stores user information and renders messages
+from Sales import Sales
+# Store, ledger, suppression list and senders the cases run against
+from contact_store import ContactStore
+from contacts import convert_contacts, read_contacts
+from fake_gmail import FakeGmailService
+from ledger import SendLedger
+from message_template import compile_body, compile_template
+from sender import GmailSender, TokenBucket
+from suppression import SuppressionList
+
+# Defines the templates used for every run
+SUBJECT = "Quick question for {First Name} at {Company Name for Emails}"
+BODY = "Hi {First Name},\n\nI saw that {Company Name for Emails} is growing in {Company City}.\n\nWould you be open to a quick chat?\nThanks,\nJane"
+LINKEDIN = "Hi {First Name}, I came across your profile at {Company Name for Emails}!\n\nLet's connect: {Person Linkedin Url}"
+# Defines the sender profile used for every run
+PROFILE = {"first_name": "Jane", "last_name": "Doe", "email": "jane@example.com", "role": "Founder", "mobile": "5555555555"}
+
+
+# Returns the first contact in a file, whose name and company the delete cases remove
+def first_contact(path):
+    return pd.read_csv(path, dtype=str, keep_default_na=False, nrows=1).iloc[0]
+
+
+# Returns a campaign over the given contact file
+def make_sales(path):
+    return Sales(**PROFILE, csv=[path], subject=SUBJECT, body_text=BODY, linkedin_text=LINKEDIN)
+
+
+# Times checking every file's header against the templates
+@contextmanager
+def check_templates(path, rows, options):
+    sales = make_sales(path)
+    yield lambda: sales.check_templates(compile_template(SUBJECT), compile_body(BODY)), rows
+
+
+# Times rendering bodies one row at a time, capped because it is far slower than the whole-column path
+@contextmanager
+def create_body(path, rows, options):
+    sales = make_sales(path)
+    count = min(rows, options.per_row_limit)
+    df = pd.read_csv(path, dtype=str, keep_default_na=False, nrows=count)
+    yield lambda: [sales.create_body(df, i) for i in range(count)], count
+
+
+# Times rendering and encoding every message
+@contextmanager
+def create_messages(path, rows, options):
+    sales = make_sales(path)
+    df = pd.read_csv(path, dtype=str, keep_default_na=False)
+    yield lambda: list(sales.create_messages(df)), rows
+
+
+# Times sending a whole file to a fake Gmail service, including filtering and the ledger
+@contextmanager
+def send_contacts(path, rows, options):
+    sales = make_sales(path)
+    sender = GmailSender(lambda: FakeGmailService(), workers=8, limiter=TokenBucket(rate=1e12))
+    ledger, suppression = SendLedger(), SuppressionList()
+    try:
+        yield lambda: sales.send_contacts(path, sender, ledger, "benchmark", suppression=suppression), rows
+    finally:
+        ledger.close()
+        suppression.close()
+
+
+# Times a dry run that writes the whole campaign to an mbox file
+@contextmanager
+def send_email_dry_run(path, rows, options):
+    sales = make_sales(path)
+    yield lambda: sales.send_email(dry_run="spool.mbox", encode_workers=0), rows
+
+
+# Times building the whole LinkedIn list
+@contextmanager
+def linkedin_list(path, rows, options):
+    sales = make_sales(path)
+    yield lambda: "".join(sales.linkedin_list()), rows
+
+
+# Times reading every column of a file by parsing the CSV
+@contextmanager
+def read_csv_contacts(path, rows, options):
+    yield lambda: sum(len(chunk) for chunk in read_contacts(path)), rows
+
+
+# Times converting a copy of a file to its columnar copy, as /action does with each upload
+@contextmanager
+def convert_columnar(path, rows, options):
+    path = shutil.copy(path, "contacts.csv")
+    yield lambda: convert_contacts(path), rows
+
+
+# Times reading every column of a file from its memory-mapped columnar copy
+@contextmanager
+def read_columnar_contacts(path, rows, options):
+    path = shutil.copy(path, "contacts.csv")
+    convert_contacts(path)
+    yield lambda: sum(len(chunk) for chunk in read_contacts(path)), rows
+
+
+# Times importing a file into the contact store
+@contextmanager
+def import_contacts(path, rows, options):
+    store = ContactStore()
+    try:
+        yield lambda: store.import_csv(path), rows
+    finally:
+        store.close()
+
+
+# Times deleting one company from an imported file and writing the file back
+@contextmanager
+def delete_company(path, rows, options):
+    # Works on a copy, since the delete writes the file back
+    path = shutil.copy(path, "contacts.csv")
+    store = ContactStore()
+    source = store.import_csv(path)
+    company = first_contact(path)["Company"]
+    # Deletes every contact at the company, then writes back the file
+    def run():
+        for changed in store.delete_company(company, [source]):
+            store.export_csv(changed)
+    try:
+        yield run, rows
+    finally:
+        store.close()
+
+
+# Returns a test client for the app, or None if the app can't be imported
+def test_client():
+    try:
+        from app import app
+    except Exception as error:
+        print(f"Skipping the routes: {error}")
+        return None
+    return app.test_client()
+
+
+# Returns a test client that has already uploaded the contact file and so has a campaign in its session
+def uploaded_client(path):
+    client = test_client()
+    if client is not None:
+        with open(path, "rb") as upload:
+            client.post("/action", data={"firstname": "Jane", "lastname": "Doe", "email": "jane@example.com", "role": "Founder",
+                                         "phone": "5555555555", "upload": (upload, "contacts.csv")})
+    return client
+
+
+# Times uploading a contact file, which saves it and imports it into the contact store
+@contextmanager
+def route_action(path, rows, options):
+    client = test_client()
+    # Uploads the file and reads the response
+    def run():
+        with open(path, "rb") as upload:
+            return client.post("/action", data={"firstname": "Jane", "lastname": "Doe", "email": "jane@example.com", "role": "Founder",
+                                                "phone": "5555555555", "upload": (upload, "contacts.csv")}).data
+    yield (run if client else None), rows
+
+
+# Times queueing a campaign, which counts the rows of every file
+@contextmanager
+def route_email_sent(path, rows, options):
+    client = uploaded_client(path)
+    yield (lambda: client.post("/email-sent", data={"subject": SUBJECT, "message": BODY}).data) if client else None, rows
+
+
+# Times a dry run through the route
+@contextmanager
+def route_email_sent_dry_run(path, rows, options):
+    client = uploaded_client(path)
+    yield (lambda: client.post("/email-sent", data={"subject": SUBJECT, "message": BODY, "dry_run": "1"}).data) if client else None, rows
+
+
+# Times streaming the whole LinkedIn page
+@contextmanager
+def route_linkedin_outreach(path, rows, options):
+    client = uploaded_client(path)
+    yield (lambda: client.post("/linkedin-outreach", data={"linkedin_message": LINKEDIN}).data) if client else None, rows
+
+
+# Times deleting a company from a folder of contact files
+@contextmanager
+def route_company_deleted(path, rows, options):
+    client = test_client()
+    os.makedirs("contacts", exist_ok=True)
+    shutil.copy(path, "contacts")
+    company = first_contact(path)["Company"]
+    yield (lambda: client.post("/company-deleted", data={"companyname": company, "path": "contacts"}).data) if client else None, rows
+
+
+# Times deleting a person from a folder of contact files
+@contextmanager
+def route_person_deleted(path, rows, options):
+    client = test_client()
+    os.makedirs("contacts", exist_ok=True)
+    shutil.copy(path, "contacts")
+    person = first_contact(path)
+    yield (lambda: client.post("/person-deleted", data={"firstname": person["First Name"], "lastname": person["Last Name"], "path": "contacts"}).data) if client else None, rows
+
+
+# Defines every case in the order they run
+CASES = [
+    ("Sales.check_templates", check_templates),
+    ("Sales.create_body per row", create_body),
+    ("Sales.create_messages", create_messages),
+    ("Sales.send_contacts fake gmail", send_contacts),
+    ("Sales.send_email dry run", send_email_dry_run),
+    ("Sales.linkedin_list", linkedin_list),
+    ("read_contacts csv", read_csv_contacts),
+    ("convert_contacts", convert_columnar),
+    ("read_contacts columnar", read_columnar_contacts),
+    ("ContactStore.import_csv", import_contacts),
+    ("ContactStore.delete_company", delete_company),
+    ("POST /action", route_action),
+    ("POST /email-sent", route_email_sent),
+    ("POST /email-sent dry run", route_email_sent_dry_run),
+    ("POST /linkedin-outreach", route_linkedin_outreach),
+    ("POST /company-deleted", route_company_deleted),
+    ("POST /person-deleted", route_person_deleted),
+]
+
+
+# Runs a case once in a fresh scratch folder, returning its seconds and row count, or its peak memory when trace is True
+def run_case(case, path, rows, options, trace=False):
+    scratch = tempfile.mkdtemp(prefix="bench-")
+    cwd = os.getcwd()
+    os.chdir(scratch)
+    try:
+        with case(path, rows, options) as (run, count):
+            if run is None:
+                return None
+            if trace:
+                tracemalloc.start()
+            start = time.perf_counter()
+            run()
+            seconds = time.perf_counter() - start
+            if trace:
+                peak = tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+                return peak
+            return seconds, count
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(scratch, ignore_errors=True)
+
+
+# Returns the commit the working tree is on, or None outside a git checkout
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], cwd=ROOT, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+# Prints how each case changed against an earlier results file
+def compare(results, baseline_path):
+    with open(baseline_path) as baseline_file:
+        baseline = {(result["case"], result["rows"]): result for result in json.load(baseline_file)["results"]}
+    print(f"\nCompared with {baseline_path}")
+    print(f"{'case':<34}{'rows':>9}{'time':>10}{'peak memory':>14}")
+    for result in results:
+        before = baseline.get((result["case"], result["rows"]))
+        if before is None:
+            continue
+        time_ratio = result["seconds"] / before["seconds"] if before["seconds"] else float("nan")
+        peak = f"{result['peak_bytes'] / before['peak_bytes']:>13.2f}x" if result.get("peak_bytes") and before.get("peak_bytes") else f"{'':>14}"
+        print(f"{result['case']:<34}{result['rows']:>9}{time_ratio:>9.2f}x{peak}")
+
+
+# Generates the contact files, runs every case at every size and saves the results
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--sizes", default="1000,10000,100000", help="comma-separated contact counts, such as 1000,10000,100000,1000000")
+    parser.add_argument("--cases", default="", help="run only the cases whose names contain this text")
+    parser.add_argument("--per-row-limit", type=int, default=10000, help="most rows to render one at a time with create_body")
+    parser.add_argument("--no-memory", action="store_true", help="skip the tracemalloc pass")
+    parser.add_argument("--output", default=os.path.join(ROOT, "benchmarks", "results", f"bench-{time.strftime('%Y%m%d-%H%M%S')}.json"),
+                        help="where to save the results")
+    parser.add_argument("--compare", help="an earlier results file to compare against")
+    args = parser.parse_args()
+
+    sizes = [int(size) for size in args.sizes.split(",")]
+    cases = [(name, case) for name, case in CASES if args.cases.lower() in name.lower()]
+    data = tempfile.mkdtemp(prefix="bench-data-")
+    results = []
+    print(f"{'case':<34}{'rows':>9}{'seconds':>10}{'rows/s':>12}{'peak MiB':>10}")
+    try:
+        for size in sizes:
+            path = write_contacts(os.path.join(data, f"contacts-{size}.csv"), size)
+            for name, case in cases:
+                timing = run_case(case, path, size, args)
+                if timing is None:
+                    continue
+                seconds, count = timing
+                peak = None if args.no_memory else run_case(case, path, size, args, trace=True)
+                results.append({"case": name, "rows": count, "seconds": round(seconds, 6),
+                                "rows_per_second": round(count / seconds, 1) if seconds else None, "peak_bytes": peak})
+                peak_text = f"{peak / 2 ** 20:>10.1f}" if peak is not None else f"{'':>10}"
+                print(f"{name:<34}{count:>9}{seconds:>10.3f}{count / seconds if seconds else 0:>12,.0f}{peak_text}")
+    finally:
+        shutil.rmtree(data, ignore_errors=True)
+
+    os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+    with open(args.output, "w") as output:
+        json.dump({"created_at": time.strftime("%Y-%m-%dT%H:%M:%S%z"), "commit": git_commit(), "python": platform.python_version(),
+                   "platform": platform.platform(), "sizes": sizes, "results": results}, output, indent=2)
+    print(f"\nSaved {len(results)} results to {args.output}")
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,119 @@
+"""
+Compares sending through the Gmail API with sending over persistent SMTP connections, against local stand-ins for both
+
+Usage: python benchmarks/bench_transports.py --messages 1000 --workers 4 --latency 0.02
+
+Needs aiosmtplib and aiosmtpd for the SMTP side. --latency adds the same server-side delay to every
+send on both stand-ins. The Gmail API path runs without its quota limiter so both transports are
+measured on their own; the quota itself caps the Gmail API at 2.5 sends per second per account.
+"""
+# Library to read command line options
+import argparse
+# Library for the SMTP stand-in's delay
+import asyncio
+# Library for the local stand-in for the Gmail API
+from http.server import ThreadingHTTPServer
+# Library to let the benchmark import modules from the project root
+import os
+# Library to find a free port for the SMTP stand-in
+import socket
+import sys
+# Library to run the Gmail stand-in in the background
+import threading
+# Library to time each transport
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Library to create credentials that don't need a login
+from google.oauth2.credentials import Credentials
+# Library for the local SMTP stand-in
+from aiosmtpd.controller import Controller
+# Request handler that answers sends the way Gmail does
+from bench_gmail_client import GmailStandIn
+# Classes that manage credentials and pool Gmail clients
+from gmail_client import CredentialManager, GmailClientPool, discovery_document
+# Class that builds each campaign's constant MIME bytes once
+from message_assembly import MessageAssembler
+# Classes that send through the Gmail API and over SMTP
+from sender import GMAIL_QUOTA_UNITS_PER_SECOND, SEND_QUOTA_COST, GmailSender, TokenBucket
+from smtp_sender import SmtpSender
+
+
+# Defines an SMTP handler that accepts every message after an optional delay
+class SmtpStandIn:
+    # Initializes the handler with how long each message takes to accept
+    def __init__(self, latency):
+        self.latency = latency
+        self.received = 0
+
+    # Accepts a message
+    async def handle_DATA(self, server, session, envelope):
+        await asyncio.sleep(self.latency)
+        self.received += 1
+        return "250 2.0.0 OK queued"
+
+
+# Defines a Gmail API handler that answers every send after a delay
+def gmail_stand_in(latency):
+    class DelayedGmailStandIn(GmailStandIn):
+        def do_POST(self):
+            time.sleep(latency)
+            super().do_POST()
+    return DelayedGmailStandIn
+
+
+# Returns a local port nothing is listening on
+def free_port():
+    with socket.socket() as probe:
+        probe.bind(("127.0.0.1", 0))
+        return probe.getsockname()[1]
+
+
+# Sends every message with a sender, closes it and returns how many seconds that took
+def timed(sender, messages):
+    start = time.perf_counter()
+    responses = sender.send_all(messages, return_errors=True)
+    seconds = time.perf_counter() - start
+    sender.close()
+    failures = [response for response in responses if isinstance(response, Exception)]
+    if failures:
+        raise SystemExit(f"{len(failures)} sends failed, the first with: {failures[0]!r}")
+    return seconds
+
+
+# Starts both stand-ins, times both transports and prints messages per second for each
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--messages", type=int, default=1000, help="number of messages to send on each transport")
+    parser.add_argument("--workers", type=int, default=4, help="threads for the Gmail API, connections for SMTP")
+    parser.add_argument("--latency", type=float, default=0.02, help="seconds each stand-in takes to accept a message")
+    args = parser.parse_args()
+
+    assembler = MessageAssembler("jane@example.com", "<p>Jane</p>")
+    messages = [{"raw": raw} for raw in assembler.assemble_many(
+        [(f"person{i}@example.com", f"Quick question {i}", f"Hi person {i}") for i in range(args.messages)])]
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), gmail_stand_in(args.latency))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    pool = GmailClientPool(CredentialManager(credentials=Credentials(token="benchmark")), size=args.workers,
+                           api_endpoint=f"http://127.0.0.1:{server.server_port}/")
+    discovery_document()
+    smtp = SmtpStandIn(args.latency)
+    controller = Controller(smtp, hostname="127.0.0.1", port=free_port())
+    controller.start()
+
+    results = [
+        ("gmail api, no quota", timed(GmailSender(pool, workers=args.workers, limiter=TokenBucket(rate=1e9)), messages)),
+        ("smtp", timed(SmtpSender("127.0.0.1", controller.port, connections=args.workers, start_tls=False), messages)),
+    ]
+    server.shutdown()
+    controller.stop()
+    print(f"{args.messages} messages, {args.workers} workers, {args.latency * 1000:.0f}ms per message")
+    for name, seconds in results:
+        print(f"{name:<24}{seconds:>9.3f}s{args.messages / seconds:>12,.1f} messages/s")
+    print(f"{'gmail api quota':<24}{'':>10}{GMAIL_QUOTA_UNITS_PER_SECOND / SEND_QUOTA_COST:>12,.1f} messages/s")
+
+
+if __name__ == "__main__":
+    main()
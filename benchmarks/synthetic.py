@@ -0,0 +1,50 @@
+"""
+Writes synthetic Apollo-style contact CSVs for the benchmarks
+
+Usage: python benchmarks/synthetic.py --rows 100000 contacts.csv
+"""
+# Library to read command line options
+import argparse
+# Library to write the CSV in bounded chunks
+import csv
+# Library to pick reproducible names and companies
+import random
+
+# Defines the columns of an Apollo export that the app's templates and routes use
+COLUMNS = ["First Name", "Last Name", "Title", "Company", "Company Name for Emails", "Email", "Person Linkedin Url", "Company City"]
+# Defines the values names, titles, companies and cities are drawn from
+FIRST_NAMES = ["ALEX", "jordan", "Sam", "taylor", "Morgan", "casey", "Riley", "jamie", "Avery", "quinn", "Dana", "Robin"]
+LAST_NAMES = ["smith", "Nguyen", "GARCIA", "patel", "Kim", "o'brien", "Müller", "Rossi", "cohen", "Silva", "Haddad", "Larsen"]
+TITLES = ["Founder", "CEO", "VP Engineering", "Head of Sales", "Data Scientist", "CTO"]
+CITIES = ["boston", "New York", "SAN FRANCISCO", "austin", "Chicago", "Seattle", "Denver"]
+# Defines how many companies the contacts are spread over
+COMPANIES = 5000
+
+
+# Yields one synthetic contact row at a time, the same rows for the same seed
+def contact_rows(rows, seed=0):
+    generator = random.Random(seed)
+    for i in range(rows):
+        company = generator.randrange(COMPANIES)
+        first, last = generator.choice(FIRST_NAMES), generator.choice(LAST_NAMES)
+        yield [first, last, generator.choice(TITLES), f"Company {company}", f"company {company} inc",
+               f"{first.lower()}.{i}@company{company}.example.com", f"http://www.linkedin.com/in/{first.lower()}-{i}", generator.choice(CITIES)]
+
+
+# Writes a contact CSV with the given number of rows
+def write_contacts(path, rows, seed=0):
+    with open(path, "w", newline="") as output:
+        writer = csv.writer(output)
+        writer.writerow(COLUMNS)
+        writer.writerows(contact_rows(rows, seed))
+    return path
+
+
+# Writes a contact CSV when this file is run directly
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("path", help="where to write the CSV")
+    parser.add_argument("--rows", type=int, default=10000, help="number of contacts")
+    parser.add_argument("--seed", type=int, default=0, help="seed for the names and companies")
+    args = parser.parse_args()
+    write_contacts(args.path, args.rows, args.seed)
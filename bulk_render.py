@@ -0,0 +1,89 @@
+# Function that defers heavy libraries until the first function that needs them runs
+from lazy import lazy_import
+# Library for data manipulation and analysis, imported the first time a contact file is read or rendered
+pd = lazy_import("pandas")
+# Library to strip disallowed characters from LinkedIn messages in one vectorized pass
+import re
+# Library for common string operations
+import string
+# Functions to parse message templates once per campaign
+from message_template import compile_body, compile_lines, compile_template
+
+# Defines a string containing all allowed characters for a LinkedIn message
+LINKEDIN_ALPHANUMERIC = string.ascii_letters + string.digits + " " + "\"\'?!,[]@#$%^&*."
+# Matches any character that isn't allowed in a LinkedIn message
+LINKEDIN_DISALLOWED = re.compile("[^" + re.escape(LINKEDIN_ALPHANUMERIC) + "]")
+
+
+# Converts a column to strings, treating empty cells as empty strings
+def text_column(series):
+    return series.fillna("").astype(str)
+
+
+# Converts a column to title case, the way names and companies are written in emails
+def title_column(series):
+    return text_column(series).str.lower().str.title()
+
+
+# Converts one cell to title case like title_column, treating empty and numeric cells the same way
+def title_value(value):
+    return "" if pd.isna(value) else str(value).lower().title()
+
+
+# Cleans a rendered LinkedIn line by cutting it at the first '/' and removing characters LinkedIn doesn't accept
+def clean_linkedin_line(series):
+    return series.str.split("/", n=1).str[0].str.replace(LINKEDIN_DISALLOWED, "", regex=True)
+
+
+# Renders the subject, body and LinkedIn message for every contact in the DataFrame as whole columns
+def render_contacts(df, subject=None, body_text=None, linkedin_text=None, cache=None):
+    """
+    Returns a DataFrame with the Email and Person Linkedin Url of each contact alongside the rendered
+    Subject, Body and LinkedIn Message columns for whichever templates were given
+
+    If cache is a RenderCache, rows it has already rendered with the same template are taken from it,
+    and only the other rows are title-cased, rendered and cleaned
+    """
+    # Starts the output with the columns that identify each recipient
+    rendered = pd.DataFrame({column: df[column] for column in ("Email", "Person Linkedin Url") if column in df.columns}, index=df.index)
+    # Gets the compiled templates for the email, if there is one
+    email_templates = []
+    if subject is not None:
+        email_templates.append(("Subject", compile_template(subject)))
+    if body_text is not None:
+        email_templates.append(("Body", compile_body(body_text)))
+    # Title-cases each referenced column once, shared by the subject and the body
+    titled = {}
+    for name, template in email_templates:
+        template.check(df.columns)
+        # Looks each row up by its raw values, title-casing only the rows the cache hasn't rendered before
+        if cache:
+            rendered[name] = cache.render_series(template, df, df.index, prepare=title_column)
+            continue
+        for column in template.columns:
+            if column not in titled:
+                titled[column] = title_column(df[column])
+        # Renders the template for every contact at once
+        rendered[name] = template.render_series(titled, df.index)
+
+    # Renders the LinkedIn message line by line, since each line is cleaned separately
+    if linkedin_text is not None:
+        # Gets the compiled template for each non-empty line of the message
+        templates = compile_lines(linkedin_text)
+        # Converts each referenced column to strings once, unless the cache converts only the rows it misses
+        columns = {}
+        for template in templates:
+            template.check(df.columns)
+            for column in template.columns:
+                if column not in columns and not cache:
+                    columns[column] = text_column(df[column])
+        # Joins the cleaned lines, following each one with a blank line
+        message = pd.Series("", index=df.index, dtype=object)
+        for template in templates:
+            if cache:
+                line = cache.render_series(template, df, df.index, prepare=text_column, finish=clean_linkedin_line)
+            else:
+                line = clean_linkedin_line(template.render_series(columns, df.index))
+            message = message + line + "\n\n"
+        rendered["LinkedIn Message"] = message
+    return rendered
@@ -0,0 +1,71 @@
+# Library to store each campaign's sender profile and templates
+import json
+# Library for the campaign registry shared by every web worker
+import sqlite3
+# Library to timestamp campaigns
+import time
+# Library to generate campaign IDs
+import uuid
+# Class that stores user information and renders messages
+from Sales import Sales
+
+# Defines the default location of the campaign registry
+CAMPAIGNS_DATABASE = "campaigns.sqlite3"
+
+# Defines the table of campaigns
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS campaigns (
+    id TEXT PRIMARY KEY,
+    profile TEXT NOT NULL,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL
+);
+"""
+
+
+# Defines the registry that keeps every rep's campaign outside the web process
+class CampaignRegistry:
+    """
+    Stores each campaign's sender profile, uploaded file paths and templates under its own ID, so any
+    web worker can serve any request and reps running campaigns at the same time never overwrite each other
+    """
+    # Initializes the registry and creates its table if it doesn't exist yet
+    def __init__(self, path=CAMPAIGNS_DATABASE):
+        # Stores the location of the registry database
+        self.path = path
+        db = self.connect()
+        try:
+            db.executescript(SCHEMA)
+        finally:
+            db.close()
+
+    # Opens a connection in autocommit mode with write-ahead logging so workers don't block each other
+    def connect(self):
+        db = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        db.execute("PRAGMA journal_mode=WAL")
+        return db
+
+    # Returns a new, unused campaign ID
+    @staticmethod
+    def new_id():
+        return uuid.uuid4().hex
+
+    # Saves a campaign under its ID, replacing what was stored before
+    def save(self, campaign_id, sales):
+        now = time.time()
+        db = self.connect()
+        try:
+            db.execute("""INSERT INTO campaigns (id, profile, created_at, updated_at) VALUES (?, ?, ?, ?)
+                          ON CONFLICT (id) DO UPDATE SET profile = excluded.profile, updated_at = excluded.updated_at""",
+                       (campaign_id, json.dumps(sales.to_dict()), now, now))
+        finally:
+            db.close()
+
+    # Loads a campaign by its ID, or returns None if there is no campaign with that ID
+    def load(self, campaign_id):
+        db = self.connect()
+        try:
+            row = db.execute("SELECT profile FROM campaigns WHERE id = ?", (campaign_id,)).fetchone()
+        finally:
+            db.close()
+        return Sales(**json.loads(row[0])) if row else None
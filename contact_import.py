@@ -0,0 +1,99 @@
+# Library to keep flagged row numbers in compact arrays instead of lists of Python ints
+from array import array
+# Library to name each file in its report
+import os
+# Function that defers heavy libraries until the first function that needs them runs
+from lazy import lazy_import
+# Library to find the flagged rows of each chunk without a Python loop
+np = lazy_import("numpy")
+# Functions to stream contact files in bounded chunks, from their columnar copy when there is one, and the derived columns it stores
+from contacts import (EMAIL_COLUMN, FLAG_BITS, LINKEDIN_COLUMN, NORMALIZED_EMAIL, ROW_FLAGS_COLUMN, UNSENDABLE_FLAGS,
+                      derive_columns, read_contacts, read_derived, read_header)
+
+# Defines the columns every uploaded contact file must have
+REQUIRED_COLUMNS = (EMAIL_COLUMN, LINKEDIN_COLUMN)
+# Defines what each flag on a row means
+ROW_FLAGS = {
+    "missing_email": "no email address",
+    "invalid_email": "an email address without an @",
+    "duplicate_email": "an email address an earlier row already lists",
+    "missing_linkedin": "no LinkedIn profile URL",
+}
+# Defines how many flagged lines of each kind a report lists
+SAMPLE_SIZE = 10
+# Defines how many rows are checked at a time
+VALIDATION_CHUNK_SIZE = 10000
+
+
+# Defines the error raised when an uploaded contact file can't be used at all
+class ContactFileError(ValueError):
+    pass
+
+
+# Defines the result of checking one contact file
+class ImportReport:
+    """
+    Counts a file's rows and keeps the number of every row flagged with each problem in an array of
+    unsigned ints, a few bytes per flagged row however large the file is
+    """
+    __slots__ = ("path", "rows", "flagged")
+
+    # Initializes an empty report for a file
+    def __init__(self, path):
+        self.path = path
+        self.rows = 0
+        self.flagged = {flag: array("I") for flag in ROW_FLAGS}
+
+    # Returns how many rows can be emailed
+    @property
+    def sendable(self):
+        return self.rows - sum(len(self.flagged[flag]) for flag in UNSENDABLE_FLAGS)
+
+    # Returns the report as a plain dictionary, listing the first few flagged lines of the file for each problem
+    def to_dict(self):
+        # Numbers lines the way a spreadsheet does, counting the header as line 1
+        return {"file": os.path.basename(self.path), "rows": self.rows, "sendable": self.sendable,
+                "problems": [{"flag": flag, "description": description, "count": len(self.flagged[flag]),
+                              "lines": [row + 2 for row in self.flagged[flag][:SAMPLE_SIZE]]}
+                             for flag, description in ROW_FLAGS.items() if self.flagged[flag]]}
+
+
+# Checks a contact file has the columns the app needs and flags the rows that can't be emailed or listed on LinkedIn
+def validate_contacts(path, seen=None, required=REQUIRED_COLUMNS):
+    """
+    Raises a ContactFileError if a required column is missing. Otherwise reads each row's flags and
+    normalized address from the columnar copy, or works them out from the address and profile columns
+    when there isn't one, and returns an ImportReport. Pass the same seen set for every file of a
+    campaign to also flag addresses earlier files list
+    """
+    columns = read_header(path)
+    missing = [column for column in required if column not in columns]
+    if missing:
+        raise ContactFileError(f"{os.path.basename(path)} is missing the column{'s' if len(missing) > 1 else ''} {', '.join(missing)}")
+    seen = set() if seen is None else seen
+    report = ImportReport(path)
+    # Reads the stored columns if the copy has them, or else the source columns to derive them from
+    derived = read_derived(path)
+    stored = ROW_FLAGS_COLUMN in derived
+    if stored:
+        wanted = [name for name in (NORMALIZED_EMAIL, ROW_FLAGS_COLUMN) if name in derived]
+    else:
+        wanted = [column for column in (EMAIL_COLUMN, LINKEDIN_COLUMN) if column in columns]
+    # Remembers this file's addresses apart from earlier files', since repeats within the file are already flagged
+    local = set()
+    for chunk in read_contacts(path, wanted, chunksize=VALIDATION_CHUNK_SIZE):
+        rows = chunk if stored else derive_columns(chunk, local)
+        flags = rows[ROW_FLAGS_COLUMN].to_numpy()
+        if NORMALIZED_EMAIL in rows:
+            emails = rows[NORMALIZED_EMAIL]
+            valid = (emails != "").to_numpy(dtype=bool)
+            # Flags addresses an earlier file lists
+            earlier = valid & np.fromiter((email in seen for email in emails), bool, len(emails))
+            flags = flags | np.where(earlier, FLAG_BITS["duplicate_email"], 0).astype(flags.dtype)
+            if stored:
+                local.update(emails[valid])
+        for flag, bit in FLAG_BITS.items():
+            report.flagged[flag].extend((np.flatnonzero(flags & bit) + report.rows).tolist())
+        report.rows += len(chunk)
+    seen.update(local)
+    return report
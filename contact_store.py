@@ -0,0 +1,202 @@
+# Library to store each contact's full row
+import json
+# Library to check whether a contact file changed and to write files atomically
+import os
+# Library for the embedded contact database
+import sqlite3
+# Library to create the temporary file a contact file is exported into
+import tempfile
+# Library to write contact files and read removal lists
+import csv
+# Functions to stream contact files in bounded chunks
+from contacts import convert_contacts, read_contacts, read_header
+
+# Defines the default location of the contact database
+CONTACTS_DATABASE = "contacts.sqlite3"
+
+# Defines the table of imported files and the table of contacts, indexed by the fields deletes look up
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS sources (
+    path TEXT PRIMARY KEY,
+    columns TEXT NOT NULL,
+    mtime REAL NOT NULL,
+    size INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS contacts (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    source TEXT NOT NULL REFERENCES sources(path),
+    row INTEGER NOT NULL,
+    first_name TEXT,
+    last_name TEXT,
+    company TEXT,
+    email TEXT,
+    data TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS contacts_name ON contacts (first_name, last_name);
+CREATE INDEX IF NOT EXISTS contacts_company ON contacts (company);
+CREATE INDEX IF NOT EXISTS contacts_email ON contacts (email);
+CREATE INDEX IF NOT EXISTS contacts_source ON contacts (source, row);
+CREATE INDEX IF NOT EXISTS contacts_email_nocase ON contacts (email COLLATE NOCASE);
+"""
+
+# Defines the temporary tables a bulk delete loads its lists into, so each list is matched with one indexed join
+BULK_SCHEMA = """
+CREATE TEMP TABLE IF NOT EXISTS bulk_people (first_name TEXT NOT NULL, last_name TEXT NOT NULL, PRIMARY KEY (first_name, last_name));
+CREATE TEMP TABLE IF NOT EXISTS bulk_companies (company TEXT PRIMARY KEY);
+CREATE TEMP TABLE IF NOT EXISTS bulk_emails (email TEXT PRIMARY KEY COLLATE NOCASE);
+CREATE TEMP TABLE IF NOT EXISTS bulk_ids (id INTEGER PRIMARY KEY);
+"""
+
+# Maps the indexed fields to the CSV columns they are read from
+INDEXED_COLUMNS = {"first_name": "First Name", "last_name": "Last Name", "company": "Company", "email": "Email"}
+# Maps each kind of removal list to the CSV columns its entries are read from
+REMOVAL_COLUMNS = {"people": ("First Name", "Last Name"), "companies": ("Company",), "emails": ("Email",)}
+
+
+# Reads a removal list of the given kind from lines of CSV text, one entry per line
+def read_removals(lines, kind):
+    """
+    The list may be a contact file with its header row, such as an Apollo export, or bare lines like
+    "First,Last" for people. Returns the distinct entries, as (first name, last name) pairs for people and as
+    strings otherwise, skipping blank ones
+    """
+    columns = REMOVAL_COLUMNS[kind]
+    rows = csv.reader(lines)
+    header = next(rows, [])
+    # Reads the entries from the matching columns if the first row is a header, or from the first columns otherwise
+    if all(column in header for column in columns):
+        positions = [header.index(column) for column in columns]
+    else:
+        positions = list(range(len(columns)))
+        rows = [header, *rows]
+    entries = {tuple(row[i].strip() if i < len(row) else "" for i in positions) for row in rows}
+    return [entry if len(columns) > 1 else entry[0] for entry in entries if all(entry)]
+
+
+# Defines the embedded store that uploaded contact files are imported into
+class ContactStore:
+    """
+    Keeps contacts in SQLite with indexes on name, company and email, so deletes are indexed lookups;
+    CSV files are only read on import and written on export
+    """
+    # Opens the contact database and creates its tables if they don't exist yet
+    def __init__(self, path=CONTACTS_DATABASE):
+        # Stores the location of the contact database
+        self.path = path
+        self.db = sqlite3.connect(path, timeout=30, isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.executescript(SCHEMA)
+
+    # Closes the connection to the contact database
+    def close(self):
+        self.db.close()
+
+    # Returns the modification time and size that identify the current version of a file
+    @staticmethod
+    def _version(path):
+        stat = os.stat(path)
+        return stat.st_mtime, stat.st_size
+
+    # Imports a contact file, replacing its earlier import, unless it hasn't changed since then
+    def import_csv(self, path):
+        # Identifies the file by its absolute path
+        source = os.path.abspath(path)
+        mtime, size = self._version(source)
+        known = self.db.execute("SELECT mtime, size FROM sources WHERE path = ?", (source,)).fetchone()
+        if known == (mtime, size):
+            return source
+        columns = list(read_header(source))
+        self.db.execute("BEGIN IMMEDIATE")
+        try:
+            # Replaces everything imported from an older version of the file
+            self.db.execute("DELETE FROM contacts WHERE source = ?", (source,))
+            self.db.execute("INSERT OR REPLACE INTO sources (path, columns, mtime, size) VALUES (?, ?, ?, ?)", (source, json.dumps(columns), mtime, size))
+            # Streams the file in chunks, storing the indexed fields alongside the full row
+            row = 0
+            for chunk in read_contacts(source):
+                records = chunk.to_dict("records")
+                self.db.executemany("INSERT INTO contacts (source, row, first_name, last_name, company, email, data) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                                    [(source, row + i, *[record.get(column) for column in INDEXED_COLUMNS.values()], json.dumps(record))
+                                     for i, record in enumerate(records)])
+                row += len(records)
+            self.db.execute("COMMIT")
+        except Exception:
+            self.db.execute("ROLLBACK")
+            raise
+        return source
+
+    # Imports every contact file in a directory
+    def import_directory(self, path):
+        return [self.import_csv(os.path.join(path, file)) for file in sorted(os.listdir(path)) if file.lower().endswith(".csv")]
+
+    # Deletes the contacts matching a WHERE clause, limited to the given sources, and returns the sources that changed
+    def _delete(self, where, parameters, sources):
+        placeholders = ", ".join("?" * len(sources))
+        self.db.execute("BEGIN IMMEDIATE")
+        try:
+            changed = [row[0] for row in self.db.execute(f"SELECT DISTINCT source FROM contacts WHERE ({where}) AND source IN ({placeholders})", (*parameters, *sources))]
+            self.db.execute(f"DELETE FROM contacts WHERE ({where}) AND source IN ({placeholders})", (*parameters, *sources))
+            self.db.execute("COMMIT")
+        except Exception:
+            self.db.execute("ROLLBACK")
+            raise
+        return changed
+
+    # Deletes every contact with the given first and last name from the given sources
+    def delete_person(self, first_name, last_name, sources):
+        return self._delete("first_name = ? AND last_name = ?", (first_name, last_name), sources)
+
+    # Deletes every contact at the given company from the given sources
+    def delete_company(self, company, sources):
+        return self._delete("company = ?", (company,), sources)
+
+    # Deletes every contact matching any of the given people, companies or emails from the given sources in one transaction
+    def delete_many(self, sources, people=(), companies=(), emails=()):
+        """
+        people is a list of (first name, last name) pairs; emails match regardless of case. Returns the
+        sources that changed and the number of contacts removed
+        """
+        placeholders = ", ".join("?" * len(sources))
+        self.db.executescript(BULK_SCHEMA)
+        self.db.execute("BEGIN IMMEDIATE")
+        try:
+            # Loads each list into its temporary table
+            for table in ("bulk_people", "bulk_companies", "bulk_emails", "bulk_ids"):
+                self.db.execute(f"DELETE FROM temp.{table}")
+            self.db.executemany("INSERT OR IGNORE INTO temp.bulk_people VALUES (?, ?)", people)
+            self.db.executemany("INSERT OR IGNORE INTO temp.bulk_companies VALUES (?)", [(company,) for company in companies])
+            self.db.executemany("INSERT OR IGNORE INTO temp.bulk_emails VALUES (?)", [(email,) for email in emails])
+            # Collects the matching contacts with one join per list, walking the list and looking each entry up on its index
+            for table, match in (("bulk_people", "c.first_name = b.first_name AND c.last_name = b.last_name"),
+                                 ("bulk_companies", "c.company = b.company"),
+                                 ("bulk_emails", "c.email = b.email COLLATE NOCASE")):
+                self.db.execute(f"INSERT OR IGNORE INTO temp.bulk_ids SELECT c.id FROM temp.{table} AS b CROSS JOIN contacts AS c ON {match} "
+                                f"WHERE c.source IN ({placeholders})", sources)
+            changed = [row[0] for row in self.db.execute("SELECT DISTINCT source FROM contacts WHERE id IN (SELECT id FROM temp.bulk_ids)")]
+            removed = self.db.execute("DELETE FROM contacts WHERE id IN (SELECT id FROM temp.bulk_ids)").rowcount
+            self.db.execute("COMMIT")
+        except Exception:
+            self.db.execute("ROLLBACK")
+            raise
+        return changed, removed
+
+    # Writes a source's remaining contacts back to its CSV file in one atomic step
+    def export_csv(self, source):
+        columns = json.loads(self.db.execute("SELECT columns FROM sources WHERE path = ?", (source,)).fetchone()[0])
+        # Writes to a temporary file next to the original, then moves it into place
+        handle, temporary = tempfile.mkstemp(dir=os.path.dirname(source), suffix=".csv")
+        try:
+            with os.fdopen(handle, "w", newline="") as output:
+                writer = csv.DictWriter(output, fieldnames=columns)
+                writer.writeheader()
+                for (data,) in self.db.execute("SELECT data FROM contacts WHERE source = ? ORDER BY row", (source,)):
+                    writer.writerow(json.loads(data))
+            os.replace(temporary, source)
+        finally:
+            if os.path.exists(temporary):
+                os.remove(temporary)
+        # Remembers the exported version so the next import doesn't read the file again
+        mtime, size = self._version(source)
+        self.db.execute("UPDATE sources SET mtime = ?, size = ? WHERE path = ?", (mtime, size, source))
+        # Replaces the file's columnar copy, so campaigns sending from it keep skipping the CSV parse
+        convert_contacts(source)
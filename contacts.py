@@ -0,0 +1,215 @@
+# Library to key each file's columnar copy by a hash of its content
+import hashlib
+# Library to find and replace columnar copies next to the files they were converted from
+import os
+# Library to write columnar copies under a temporary name before moving them into place
+import tempfile
+# Library to remember each file version's hash for the life of the process
+from functools import lru_cache
+# Function that defers heavy libraries until the first function that needs them runs
+from lazy import lazy_import
+# Library for data manipulation and analysis, imported the first time a contact file is read or rendered
+pd = lazy_import("pandas")
+# Library to build each chunk's row flags without a Python loop
+np = lazy_import("numpy")
+# Library to store and memory-map columnar copies of contact files; without it, files are always read as CSV
+try:
+    pa = lazy_import("pyarrow")
+except ImportError:
+    pa = None
+# Functions that normalize addresses and profile URLs the same way the send and LinkedIn stages compare them
+from suppression import normalize_email, normalize_linkedin
+
+# Defines how many rows are read into memory at a time
+CHUNK_SIZE = 1000
+# Defines the folder, next to each contact file, that its columnar copy is kept in
+COLUMNAR_FOLDER = ".columnar"
+# Defines the column addresses are read from and the column LinkedIn profiles are read from
+EMAIL_COLUMN = "Email"
+LINKEDIN_COLUMN = "Person Linkedin Url"
+# Defines the columns a columnar copy stores after the file's own: each row's normalized address and profile URL, and its flags
+NORMALIZED_EMAIL = "_normalized_email"
+NORMALIZED_LINKEDIN = "_normalized_linkedin"
+ROW_FLAGS_COLUMN = "_row_flags"
+DERIVED_COLUMNS = (NORMALIZED_EMAIL, NORMALIZED_LINKEDIN, ROW_FLAGS_COLUMN)
+# Defines the bit each problem sets in a row's flags
+FLAG_BITS = {"missing_email": 1, "invalid_email": 2, "duplicate_email": 4, "missing_linkedin": 8}
+# Defines the flags that keep a row from being emailed, and the bits they set
+UNSENDABLE_FLAGS = ("missing_email", "invalid_email", "duplicate_email")
+UNSENDABLE_BITS = sum(FLAG_BITS[flag] for flag in UNSENDABLE_FLAGS)
+
+
+# Opens a contact CSV file, ignoring characters that can't be decoded
+def open_contacts(path):
+    return open(path, errors="ignore", newline="")
+
+
+# Returns the hash of a file's content, computed once per version of the file
+@lru_cache(maxsize=1024)
+def content_hash(path, mtime, size):
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, "rb") as contacts_file:
+        while block := contacts_file.read(1 << 20):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+# Returns where the columnar copy of the current version of a contact file is kept
+def columnar_path(path):
+    stat = os.stat(path)
+    folder, name = os.path.split(os.path.abspath(path))
+    return os.path.join(folder, COLUMNAR_FOLDER, f"{name}.{content_hash(path, stat.st_mtime_ns, stat.st_size)}.arrow")
+
+
+# Returns the columns derive_columns adds for a file with the given header
+def derived_names(columns):
+    # Adds none to a file whose own columns already use their names
+    if any(name in columns for name in DERIVED_COLUMNS):
+        return []
+    names = [name for column, name in ((EMAIL_COLUMN, NORMALIZED_EMAIL), (LINKEDIN_COLUMN, NORMALIZED_LINKEDIN)) if column in columns]
+    return names + [ROW_FLAGS_COLUMN] if names else []
+
+
+# Returns the normalized address and profile URL of every row in a chunk, and a byte of FLAG_BITS for its problems
+def derive_columns(chunk, seen):
+    """
+    seen holds the addresses of earlier rows, so a repeat is flagged as a duplicate, and is updated with
+    this chunk's addresses. Only the columns the chunk has the source column for are returned
+    """
+    derived = {}
+    flags = np.zeros(len(chunk), np.uint8)
+    if EMAIL_COLUMN in chunk:
+        emails = normalize_email(chunk[EMAIL_COLUMN])
+        blank = (chunk[EMAIL_COLUMN].fillna("").astype(str).str.strip() == "").to_numpy(dtype=bool)
+        valid = (emails != "").to_numpy(dtype=bool)
+        # Flags repeats within the chunk and addresses already seen, then remembers this chunk's addresses
+        repeated = emails.duplicated().to_numpy(dtype=bool) | np.fromiter((email in seen for email in emails), bool, len(emails))
+        flags[blank] |= FLAG_BITS["missing_email"]
+        flags[~blank & ~valid] |= FLAG_BITS["invalid_email"]
+        flags[valid & repeated] |= FLAG_BITS["duplicate_email"]
+        seen.update(emails[valid])
+        derived[NORMALIZED_EMAIL] = emails
+    if LINKEDIN_COLUMN in chunk:
+        urls = normalize_linkedin(chunk[LINKEDIN_COLUMN])
+        flags[(urls == "").to_numpy(dtype=bool)] |= FLAG_BITS["missing_linkedin"]
+        derived[NORMALIZED_LINKEDIN] = urls
+    derived[ROW_FLAGS_COLUMN] = pd.Series(flags, index=chunk.index)
+    return pd.DataFrame(derived, index=chunk.index)
+
+
+# Converts a contact file into an Arrow IPC file once, so later reads memory-map it instead of parsing the CSV
+def convert_contacts(path):
+    """
+    Stores every column as text, exactly as read_contacts reads the CSV, followed by the derived columns,
+    so later stages read each row's normalized address, profile URL and flags instead of normalizing them
+    again. Removes copies of older versions of the file. Returns the path of the copy, or None if pyarrow
+    isn't installed
+    """
+    if pa is None:
+        return None
+    target = columnar_path(path)
+    if os.path.exists(target):
+        return target
+    folder = os.path.dirname(target)
+    os.makedirs(folder, exist_ok=True)
+    columns = read_header(path)
+    derived = derived_names(columns)
+    schema = pa.schema([(column, pa.large_string()) for column in columns] +
+                       [(name, pa.uint8() if name == ROW_FLAGS_COLUMN else pa.large_string()) for name in derived])
+    # Remembers every address in the file, so repeats in later chunks are flagged too
+    seen = set()
+    # Streams the CSV into a temporary file next to the copy, then moves it into place
+    handle, temporary = tempfile.mkstemp(dir=folder, suffix=".arrow")
+    try:
+        with os.fdopen(handle, "wb") as output, pa.ipc.new_file(output, schema) as writer:
+            for chunk in read_contacts(path, chunksize=CHUNK_SIZE * 10):
+                if derived:
+                    chunk = pd.concat([chunk, derive_columns(chunk, seen)[derived]], axis=1)
+                writer.write_table(pa.Table.from_pandas(chunk, schema=schema, preserve_index=False))
+        os.replace(temporary, target)
+    finally:
+        if os.path.exists(temporary):
+            os.remove(temporary)
+    # Removes the copies of older versions of the file
+    prefix = os.path.basename(path) + "."
+    for name in os.listdir(folder):
+        if name.startswith(prefix) and name.endswith(".arrow") and os.path.join(folder, name) != target:
+            os.remove(os.path.join(folder, name))
+    return target
+
+
+# Memory-maps the columnar copy of a contact file, or returns None if the current version hasn't been converted
+def open_columnar(path):
+    if pa is None:
+        return None
+    target = columnar_path(path)
+    if not os.path.exists(target):
+        return None
+    return pa.ipc.open_file(pa.memory_map(target)).read_all()
+
+
+# Returns the derived columns the columnar copy of a contact file holds, or none if the file is read as CSV
+def read_derived(path):
+    table = open_columnar(path)
+    return [] if table is None else [name for name in table.column_names if name in DERIVED_COLUMNS]
+
+
+# Returns the column names in the header row of a contact file
+def read_header(path):
+    table = open_columnar(path)
+    if table is not None:
+        return pd.Index([name for name in table.column_names if name not in DERIVED_COLUMNS])
+    with open_contacts(path) as contacts_file:
+        return pd.read_csv(contacts_file, nrows=0).columns
+
+
+# Reads a contact file in chunks of at most chunksize rows, so memory stays flat however large the file is
+def read_contacts(path, columns=None, chunksize=CHUNK_SIZE, start=0, stop=None):
+    """
+    Yields DataFrames holding only the given columns (or every column) as strings, covering rows start to stop.
+    Reads the file's columnar copy if it has one, touching only the pages of the columns and rows asked for.
+    The copy's derived columns are only read when asked for by name
+    """
+    table = open_columnar(path)
+    if table is not None:
+        yield from read_columnar(table, columns, chunksize, start, stop)
+        return
+    # Leaves empty cells as empty strings so every value can be treated as text
+    with open_contacts(path) as contacts_file:
+        reader = pd.read_csv(contacts_file, usecols=columns, dtype=str, keep_default_na=False, chunksize=chunksize,
+                             skiprows=range(1, start + 1), nrows=None if stop is None else stop - start)
+        with reader:
+            for chunk in reader:
+                # Skips the empty chunk pandas returns when start is past the last row
+                if len(chunk):
+                    yield chunk
+
+
+# Yields the chunks read_contacts would read from the CSV, from its memory-mapped columnar copy
+def read_columnar(table, columns, chunksize, start, stop):
+    names = table.column_names
+    if columns is not None:
+        # Keeps the columns in file order, as read_csv's usecols does, accepting names or positions
+        wanted = {names[column] if isinstance(column, int) else column for column in columns}
+        missing = wanted.difference(names)
+        if missing:
+            raise ValueError(f"Usecols do not match columns, columns expected but not found: {sorted(missing)}")
+        table = table.select([name for name in names if name in wanted])
+    elif any(name in DERIVED_COLUMNS for name in names):
+        table = table.select([name for name in names if name not in DERIVED_COLUMNS])
+    stop = table.num_rows if stop is None else min(stop, table.num_rows)
+    # Numbers each chunk's rows from start onwards, as read_csv does
+    for first in range(start, stop, chunksize):
+        chunk = table.slice(first, min(chunksize, stop - first)).to_pandas()
+        chunk.index = pd.RangeIndex(first - start, first - start + len(chunk))
+        yield chunk
+
+
+# Counts the rows in a contact file without keeping them in memory
+def count_contacts(path):
+    # Reads the row count from the columnar copy's metadata if there is one
+    table = open_columnar(path)
+    if table is not None:
+        return table.num_rows
+    # Reads just the first column, since only the number of rows matters
+    return sum(len(chunk) for chunk in read_contacts(path, columns=[0]))
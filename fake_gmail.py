@@ -0,0 +1,138 @@
+# Library to decode messages to find who they are addressed to
+import base64
+# Library to read the recipient out of a message's headers
+from email.parser import BytesHeaderParser
+# Library to parse the JSON body of fake error responses
+import json
+# Library to decide which sends a fault is injected into, the same way for the same seed
+import random
+# Library to guard the fake service's shared state across worker threads
+import threading
+# Library to add simulated network latency
+import time
+# Library that builds the response object Google's client attaches to errors
+import httplib2
+# Library to handle errors from Google's API
+from googleapiclient.errors import HttpError
+
+# Maps the HTTP statuses faults are injected as to the reason Gmail gives for them
+FAULT_REASONS = {400: "invalidArgument", 403: "forbidden", 429: "rateLimitExceeded", 500: "backendError", 502: "badGateway", 503: "backendError"}
+
+
+# Builds an HttpError that looks like the one Gmail returns for the given status and reason
+def make_http_error(status, reason):
+    # Creates the response object with the status code
+    resp = httplib2.Response({"status": status})
+    # Creates a JSON body in the same shape Gmail uses for errors
+    content = json.dumps({"error": {"code": status, "message": reason, "errors": [{"reason": reason}]}}).encode()
+    return HttpError(resp, content)
+
+
+# Defines a deterministic stand-in for the Gmail API service so the send engine can be tested offline
+class FakeGmailService:
+    """
+    Mimics service.users().messages().send(userId, body).execute() with a configurable latency and quota,
+    and injects faults to test how the send engine copes with them: faults is a list of (rate, fault) pairs,
+    where fault is an HTTP status such as 503 or an exception class such as TimeoutError, raised for that
+    share of sends; every send during outage, a (start, end) pair of seconds after the fake was created,
+    fails with a 503; and sends to invalid_recipients fail with a 400, as for a bad address
+    """
+    # Initializes the fake with a per-call latency, an optional per-second quota in Gmail quota units and the faults to inject
+    def __init__(self, latency=0.0, quota_units=None, send_cost=100, clock=time.monotonic, sleep=time.sleep, faults=(), outage=None,
+                 invalid_recipients=(), seed=0):
+        # Stores the number of seconds each send takes
+        self.latency = latency
+        # Stores the quota units allowed per second, or None to never rate limit
+        self.quota_units = quota_units
+        # Stores the quota cost of one send
+        self.send_cost = send_cost
+        # Stores the clock and sleep functions
+        self.clock = clock
+        self.sleep = sleep
+        # Stores every message that was accepted, in the order it was accepted
+        self.sent = []
+        # Stores the number of sends that were rejected with a rate limit error
+        self.rate_limited = 0
+        # Stores the faults to inject, the outage and the recipients whose address is rejected
+        self.faults = list(faults)
+        self.outage = outage
+        self.invalid_recipients = {recipient.lower() for recipient in invalid_recipients}
+        # Stores the seeded generator that picks the sends faults are injected into
+        self.random = random.Random(seed)
+        # Stores the time the fake was created, which the outage is measured from
+        self.created = clock()
+        # Stores the number of faults injected so far
+        self.injected = 0
+        # Stores the second currently being counted against the quota and the units used in it
+        self.window = None
+        self.window_units = 0
+        # Guards the counters so several threads can share the fake
+        self.lock = threading.Lock()
+
+    # Mirrors service.users()
+    def users(self):
+        return self
+
+    # Mirrors service.users().messages()
+    def messages(self):
+        return self
+
+    # Mirrors service.users().messages().send(), returning an object with an execute() method
+    def send(self, userId, body):
+        return _FakeRequest(self, body)
+
+    # Accepts or rejects one message, the same way the real API would
+    def _execute(self, body):
+        # Simulates the network round trip
+        if self.latency:
+            self.sleep(self.latency)
+        with self.lock:
+            self._inject(body)
+            # Starts counting a new second if the current one has passed
+            second = int(self.clock())
+            if second != self.window:
+                self.window = second
+                self.window_units = 0
+            # Rejects the send with a 429 if it would go over the quota for this second
+            if self.quota_units is not None and self.window_units + self.send_cost > self.quota_units:
+                self.rate_limited += 1
+                raise make_http_error(429, "rateLimitExceeded")
+            self.window_units += self.send_cost
+            # Records the message and hands back a response shaped like Gmail's
+            self.sent.append(body)
+            message_id = f"{len(self.sent):016x}"
+            return {"id": message_id, "threadId": message_id, "labelIds": ["SENT"]}
+
+
+    # Raises the fault chosen for this send, if any; called with the lock held
+    def _inject(self, body):
+        fault = None
+        if self.outage is not None and self.outage[0] <= self.clock() - self.created < self.outage[1]:
+            fault = 503
+        elif self.invalid_recipients:
+            recipient = BytesHeaderParser().parsebytes(base64.urlsafe_b64decode(body["raw"]))["To"]
+            if recipient and recipient.lower() in self.invalid_recipients:
+                fault = 400
+        if fault is None:
+            for rate, candidate in self.faults:
+                if self.random.random() < rate:
+                    fault = candidate
+                    break
+        if fault is None:
+            return
+        self.injected += 1
+        if isinstance(fault, int):
+            raise make_http_error(fault, FAULT_REASONS.get(fault, "backendError"))
+        raise fault("Injected fault")
+
+
+# Defines the request object returned by FakeGmailService.send()
+class _FakeRequest:
+    # Stores the service and the message body to send
+    def __init__(self, service, body):
+        self.service = service
+        self.body = body
+
+    # Sends the message through the fake service
+    def execute(self):
+        return self.service._execute(self.body)
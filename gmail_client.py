@@ -0,0 +1,190 @@
+# Library to hand out Gmail clients to worker threads one at a time
+import queue
+# Library to keep the pool and credentials safe to share between threads
+import threading
+# Library to parse and cache the Gmail discovery document
+import json
+# Library for interacting with the file system
+import os
+# Library to release a borrowed client even if the send fails
+from contextlib import contextmanager
+# Library to check how soon the access token expires
+from datetime import datetime, timedelta
+# Library to cache the shared pool for the whole process
+from functools import lru_cache
+# Functions that defer Google's client libraries until a campaign needs them, and import them ahead of time in the background
+from lazy import lazy_import, warm_up
+# Library that provides the keep-alive HTTP connections the clients send over
+httplib2 = lazy_import("httplib2")
+# Library to attach the access token to every request
+google_auth_httplib2 = lazy_import("google_auth_httplib2")
+# Library to make requests to Google's API
+google_requests = lazy_import("google.auth.transport.requests")
+# Library to manage user authentication and authorization
+google_credentials = lazy_import("google.oauth2.credentials")
+# Library to handle the OAuth 2.0 authorization flow for desktop apps
+oauth_flow = lazy_import("google_auth_oauthlib.flow")
+# Library to create a service object for the Gmail API from a discovery document
+api_discovery = lazy_import("googleapiclient.discovery")
+# Library to read the discovery document that ships with Google's client
+static_discovery = lazy_import("googleapiclient.discovery_cache")
+
+# Defines the list of authorization scopes required to access the user's Gmail account
+SCOPES = ["https://mail.google.com/", "https://www.googleapis.com/auth/gmail.settings.sharing", "https://www.googleapis.com/auth/gmail.settings.basic"]
+# Defines the file that stores the user's access and refresh tokens
+TOKEN_FILE = "token.json"
+# Defines the OAuth client secrets downloaded from the Google Cloud Console
+CLIENT_SECRETS_FILE = "credentials.json"
+# Defines where the Gmail discovery document is cached
+DISCOVERY_CACHE = os.path.join(".cache", "gmail-v1.json")
+# Defines how long before expiry the access token is refreshed
+REFRESH_MARGIN = timedelta(minutes=5)
+
+
+# Defines the manager that loads the user's credentials once and keeps them fresh
+class CredentialManager:
+    """
+    Loads token.json once per process and refreshes the access token shortly before it expires,
+    so no send ever waits on a refresh after a 401
+    """
+    # Initializes the manager with the token and client secret files, or with credentials that are already loaded
+    def __init__(self, token_file=TOKEN_FILE, client_secrets=CLIENT_SECRETS_FILE, scopes=SCOPES, credentials=None):
+        # Stores the file the tokens are loaded from and saved to
+        self.token_file = token_file
+        # Stores the OAuth client secrets used if the user has to log in
+        self.client_secrets = client_secrets
+        # Stores the scopes to request
+        self.scopes = scopes
+        # Stores the loaded credentials, which are shared by every client
+        self.creds = credentials
+        # Guards loading and refreshing so only one thread does it at a time
+        self.lock = threading.Lock()
+
+    # Checks whether the access token is missing, expired or about to expire
+    def _stale(self):
+        if not self.creds.valid:
+            return True
+        # Credentials without an expiry never need refreshing
+        return self.creds.expiry is not None and self.creds.expiry - datetime.utcnow() < REFRESH_MARGIN
+
+    # Returns valid credentials, loading, refreshing or logging in only when needed
+    def credentials(self):
+        with self.lock:
+            # Loads credentials from the token file the first time they are needed
+            if self.creds is None and os.path.exists(self.token_file):
+                self.creds = google_credentials.Credentials.from_authorized_user_file(self.token_file, self.scopes)
+            # Returns the credentials as they are if the access token has plenty of time left
+            if self.creds is not None and not self._stale():
+                return self.creds
+            # Refreshes the access token if a refresh token exists
+            if self.creds is not None and self.creds.refresh_token:
+                self.creds.refresh(google_requests.Request())
+            # Otherwise, runs the authorization flow to get new credentials
+            else:
+                flow = oauth_flow.InstalledAppFlow.from_client_secrets_file(self.client_secrets, self.scopes)
+                self.creds = flow.run_local_server(port=0)
+            # Writes the new credentials to the token file for future use
+            with open(self.token_file, "w") as token:
+                token.write(self.creds.to_json())
+            return self.creds
+
+
+# Loads the Gmail discovery document, parsing it once and caching it on disk
+@lru_cache(maxsize=None)
+def discovery_document(path=DISCOVERY_CACHE):
+    # Reads the cached copy if there is one
+    if os.path.exists(path):
+        with open(path) as cached:
+            return json.load(cached)
+    # Otherwise uses the copy bundled with Google's client, or downloads it
+    document = static_discovery.get_static_doc("gmail", "v1")
+    if document is None:
+        response, document = httplib2.Http(timeout=30).request(api_discovery.V2_DISCOVERY_URI.format(api="gmail", apiVersion="v1"))
+    # Saves it for the next process
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w") as cached:
+        cached.write(document if isinstance(document, str) else document.decode())
+    return json.loads(document)
+
+
+# Defines a pool that lends out service objects, one borrower at a time, reusing them between sends
+class ServicePool:
+    """
+    Builds at most size services with factory and hands each to one thread at a time, since a
+    Google API service object is not thread-safe
+    """
+    # Initializes the pool with the function that builds a service and the most services to build
+    def __init__(self, factory, size=8):
+        # Stores the function used to build a new service
+        self.factory = factory
+        # Stores the most services the pool will build
+        self.size = size
+        # Stores services that aren't currently borrowed
+        self.idle = queue.LifoQueue()
+        # Counts the services built so far
+        self.built = 0
+        # Guards the count of services built
+        self.lock = threading.Lock()
+
+    # Lends a service for the duration of a with block, building one if none is idle and the pool isn't full
+    @contextmanager
+    def client(self):
+        try:
+            service = self.idle.get_nowait()
+        except queue.Empty:
+            with self.lock:
+                build_one = self.built < self.size
+                self.built += build_one
+            # Waits for a service to come back if the pool is already full
+            service = self.factory() if build_one else self.idle.get()
+        try:
+            yield service
+        finally:
+            self.idle.put(service)
+
+
+# Defines the pool of authorized Gmail clients shared by every sender in the process
+class GmailClientPool(ServicePool):
+    """
+    Each client keeps its own keep-alive HTTP connection and shares one set of credentials
+    """
+    # Initializes the pool with the credential manager, pool size, request timeout and optional API endpoint
+    def __init__(self, credentials=None, size=8, timeout=30, api_endpoint=None, discovery_cache=DISCOVERY_CACHE):
+        super().__init__(self._build, size)
+        # Stores the manager that keeps the shared credentials fresh
+        self.credentials = credentials or CredentialManager()
+        # Stores the timeout for each request
+        self.timeout = timeout
+        # Stores an alternative API endpoint, such as a local stand-in for Gmail
+        self.api_endpoint = api_endpoint
+        # Stores where the discovery document is cached
+        self.discovery_cache = discovery_cache
+
+    # Builds a Gmail service from the cached discovery document over its own keep-alive connection
+    def _build(self):
+        http = google_auth_httplib2.AuthorizedHttp(self.credentials.credentials(), http=httplib2.Http(timeout=self.timeout))
+        options = {"api_endpoint": self.api_endpoint} if self.api_endpoint else None
+        return api_discovery.build_from_document(discovery_document(self.discovery_cache), http=http, client_options=options)
+
+    # Lends a client, refreshing the shared access token first if it is about to expire
+    @contextmanager
+    def client(self):
+        self.credentials.credentials()
+        with super().client() as service:
+            yield service
+
+
+# Returns the Gmail client pool shared by the whole process, creating it the first time
+@lru_cache(maxsize=None)
+def shared_client_pool():
+    return GmailClientPool()
+
+
+# Imports Google's client libraries in a background thread, and loads the Gmail discovery document too if discovery is True
+def warm_up_client(discovery=True, discovery_cache=DISCOVERY_CACHE):
+    """
+    Returns the thread, so the first campaign a process runs doesn't wait on imports or on parsing the
+    discovery document. The SMTP transport logs in with the same credentials, so it warms up without discovery
+    """
+    return warm_up(httplib2, google_auth_httplib2, google_requests, google_credentials, api_discovery,
+                   then=(lambda: discovery_document(discovery_cache)) if discovery else None)
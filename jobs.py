@@ -0,0 +1,401 @@
+"""
+Runs email campaigns in background worker processes, fed by a local SQLite queue
+
+Start workers alongside the app with run.py, or on their own with: python jobs.py --workers 4
+"""
+# Library to read command line options
+import argparse
+# Library to add up the outcomes of a task's batches as they settle
+from collections import Counter
+# Library to store campaign profiles in the queue
+import json
+# Library to run each worker in its own process
+import multiprocessing
+# Library to name each worker after its process
+import os
+# Library for the local job queue
+import sqlite3
+# Library to measure throughput and wait between polls
+import time
+# Library to generate job IDs
+import uuid
+# Function to count the rows of a contact file in bounded chunks
+from contacts import count_contacts
+# Send window that holds each task until business hours in its recipients' timezone
+from scheduler import Schedule
+# Class that stores user information and renders messages
+from Sales import Sales, warm_up_campaigns
+# Ledger that lets an interrupted task resume without sending duplicates
+from ledger import LEDGER_DATABASE, SendLedger
+# Kinds of send errors a replay retries by default, and the rate limiter every worker sending as one account shares
+from sender import RETRYABLE, SharedTokenBucket
+# List of addresses that must never be emailed
+from suppression import SUPPRESSION_DATABASE, SuppressionList
+# Classes that time each stage, record metrics and save each campaign's summary
+from metrics import METRICS_DATABASE, MetricsStore, StageTimer, shared_registry
+# Cache of rendered sections shared by the tasks a worker runs, optionally kept on disk between runs
+from render_cache import shared_render_cache
+
+# Defines the default location of the queue database
+JOBS_DATABASE = "jobs.sqlite3"
+# Defines how many contacts each task covers, which is the unit of work a worker claims
+TASK_SIZE = 200
+# Defines how many times a task is run before the rows it never settled are counted as failed
+MAX_TASK_ATTEMPTS = 3
+# Defines how long a task that raised waits before it is run again, in seconds, multiplied by the attempts so far
+TASK_RETRY_DELAY = 30
+
+# Defines the tables that hold campaigns and the chunks of rows each one is split into
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    profile TEXT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'queued',
+    total INTEGER NOT NULL DEFAULT 0,
+    sent INTEGER NOT NULL DEFAULT 0,
+    failed INTEGER NOT NULL DEFAULT 0,
+    skipped INTEGER NOT NULL DEFAULT 0,
+    schedule TEXT,
+    created_at REAL NOT NULL,
+    started_at REAL,
+    finished_at REAL
+);
+CREATE TABLE IF NOT EXISTS tasks (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    job_id TEXT NOT NULL REFERENCES jobs(id),
+    path TEXT NOT NULL,
+    start INTEGER NOT NULL,
+    stop INTEGER NOT NULL,
+    status TEXT NOT NULL DEFAULT 'queued',
+    worker TEXT,
+    zone TEXT,
+    size INTEGER,
+    not_before REAL NOT NULL DEFAULT 0,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    settled INTEGER NOT NULL DEFAULT 0,
+    error TEXT
+);
+CREATE INDEX IF NOT EXISTS tasks_status ON tasks (status, id);
+"""
+# Defines the columns added since the first version of the queue, so older queue databases can be upgraded in place
+MIGRATIONS = [
+    ("jobs", "skipped", "INTEGER NOT NULL DEFAULT 0"),
+    ("jobs", "schedule", "TEXT"),
+    ("tasks", "zone", "TEXT"),
+    ("tasks", "size", "INTEGER"),
+    ("tasks", "not_before", "REAL NOT NULL DEFAULT 0"),
+    ("tasks", "attempts", "INTEGER NOT NULL DEFAULT 0"),
+    ("tasks", "settled", "INTEGER NOT NULL DEFAULT 0"),
+    ("tasks", "error", "TEXT"),
+]
+# Defines the index workers claim due tasks through, earliest first, which needs the migrated columns
+DUE_INDEX = "CREATE INDEX IF NOT EXISTS tasks_due ON tasks (status, not_before, id)"
+
+
+# Defines the SQLite-backed queue shared by the web app and the worker processes
+class JobQueue:
+    """
+    Stores campaigns as jobs split into tasks of TASK_SIZE rows, so several workers can share one campaign
+
+    A campaign queued with a Schedule is split into tasks per recipient timezone, and each task is held
+    until the send window opens in its timezone; workers always claim the task that has been due longest
+    """
+    # Initializes the queue and creates its tables if they don't exist yet
+    def __init__(self, path=JOBS_DATABASE):
+        # Stores the location of the queue database
+        self.path = path
+        db = self.connect()
+        try:
+            db.executescript(SCHEMA)
+            # Adds the columns that queues created by earlier versions are missing
+            for table, column, definition in MIGRATIONS:
+                if column not in [existing["name"] for existing in db.execute(f"PRAGMA table_info({table})")]:
+                    db.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+            db.execute(DUE_INDEX)
+        finally:
+            db.close()
+
+    # Opens a connection in autocommit mode with write-ahead logging so readers don't block the workers
+    def connect(self):
+        db = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        db.row_factory = sqlite3.Row
+        db.execute("PRAGMA journal_mode=WAL")
+        return db
+
+    # Adds a campaign to the queue and returns its job ID, holding its sends to the schedule's window if one is given
+    def enqueue(self, sales, task_size=TASK_SIZE, schedule=None):
+        # Generates a new job ID
+        job_id = uuid.uuid4().hex
+        # Splits every contact file into tasks of at most task_size rows
+        tasks = []
+        for path in sales.contacts:
+            if schedule is None:
+                # Counts the rows in the file without loading it into memory
+                rows = count_contacts(path)
+                tasks += [(job_id, path, start, min(start + task_size, rows), None, min(task_size, rows - start), 0)
+                          for start in range(0, rows, task_size)]
+                continue
+            # Splits the file by recipient timezone and holds each task until the window opens in its timezone
+            opens = {}
+            for start, stop, zone, size in schedule.partition(path, task_size):
+                if zone not in opens:
+                    opens[zone] = schedule.next_open(zone)
+                tasks.append((job_id, path, start, stop, zone, size, opens[zone]))
+        db = self.connect()
+        try:
+            # Stores the job and its tasks together so workers never see a half-written campaign
+            db.execute("BEGIN IMMEDIATE")
+            # A campaign with no contacts is finished as soon as it is queued
+            db.execute("INSERT INTO jobs (id, profile, status, total, schedule, created_at) VALUES (?, ?, ?, ?, ?, ?)",
+                       (job_id, json.dumps(sales.to_dict()), "queued" if tasks else "done", sum(task[5] for task in tasks),
+                        json.dumps(schedule.to_dict()) if schedule else None, time.time()))
+            db.executemany("INSERT INTO tasks (job_id, path, start, stop, zone, size, not_before) VALUES (?, ?, ?, ?, ?, ?, ?)", tasks)
+            db.execute("COMMIT")
+        finally:
+            db.close()
+        return job_id
+
+    # Takes the queued task that has been due longest for a worker, or returns None if no task is due
+    def claim(self, worker):
+        db = self.connect()
+        try:
+            # Locks the database for writing so two workers can't claim the same task
+            db.execute("BEGIN IMMEDIATE")
+            task = db.execute("SELECT * FROM tasks WHERE status = 'queued' AND not_before <= ? ORDER BY not_before, id LIMIT 1", (time.time(),)).fetchone()
+            if task is None:
+                db.execute("COMMIT")
+                return None
+            db.execute("UPDATE tasks SET status = 'running', worker = ? WHERE id = ?", (worker, task["id"]))
+            # Marks the job as started the first time one of its tasks is claimed
+            db.execute("UPDATE jobs SET status = 'running', started_at = COALESCE(started_at, ?) WHERE id = ?", (time.time(), task["job_id"]))
+            job = db.execute("SELECT profile, schedule FROM jobs WHERE id = ?", (task["job_id"],)).fetchone()
+            db.execute("COMMIT")
+        finally:
+            db.close()
+        # Returns the task along with the campaign it belongs to and the schedule it is sent on, if any
+        return dict(task, profile=json.loads(job["profile"]), schedule=Schedule(**json.loads(job["schedule"])) if job["schedule"] else None)
+
+    # Puts tasks that were left running by workers that have stopped back on the queue
+    def requeue_running(self):
+        db = self.connect()
+        try:
+            db.execute("UPDATE tasks SET status = 'queued', worker = NULL WHERE status = 'running'")
+        finally:
+            db.close()
+
+    # Records the outcome of a task and closes the job once all of its tasks are done
+    def finish(self, task, sent, failed, skipped=0, resume_at=None, error=None):
+        """
+        resume_at puts a task the send window closed on back on the queue until that time; running it
+        again picks up where it stopped. error counts the run as a failed attempt and keeps why it failed
+        """
+        db = self.connect()
+        try:
+            db.execute("BEGIN IMMEDIATE")
+            if error is not None:
+                db.execute("UPDATE tasks SET attempts = attempts + 1, error = ? WHERE id = ?", (str(error), task["id"]))
+            if resume_at is None:
+                db.execute("UPDATE tasks SET status = 'done', settled = settled + ? WHERE id = ?", (sent + failed + skipped, task["id"]))
+            else:
+                db.execute("UPDATE tasks SET status = 'queued', worker = NULL, not_before = ?, settled = settled + ? WHERE id = ?",
+                           (resume_at, sent + failed + skipped, task["id"]))
+            db.execute("UPDATE jobs SET sent = sent + ?, failed = failed + ?, skipped = skipped + ? WHERE id = ?", (sent, failed, skipped, task["job_id"]))
+            # Closes the job if no task is left queued or running
+            db.execute("""UPDATE jobs SET status = 'done', finished_at = ? WHERE id = ? AND NOT EXISTS (
+                              SELECT 1 FROM tasks WHERE job_id = ? AND status != 'done')""", (time.time(), task["job_id"], task["job_id"]))
+            db.execute("COMMIT")
+        finally:
+            db.close()
+
+    # Records a run of a task that raised, counting the rows it settled and either retrying it at retry_at or closing it
+    def fail(self, task, sent, failed, skipped, error, retry_at=None):
+        """
+        A retried task resumes from its checkpoint, and the ledger's claims and sends keep it from emailing
+        anyone twice. Pass retry_at=None once the task is out of attempts; the task is then done, with the
+        error kept for whoever looks into it
+        """
+        self.finish(task, sent, failed, skipped, retry_at, error)
+
+    # Returns the campaign profile a job was queued with, or None if there is no job with that ID
+    def profile(self, job_id):
+        db = self.connect()
+        try:
+            job = db.execute("SELECT profile FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        finally:
+            db.close()
+        return json.loads(job["profile"]) if job else None
+
+    # Moves messages a replay of the job's dead letters sent from its failed count to its sent count
+    def record_replay(self, job_id, sent):
+        db = self.connect()
+        try:
+            db.execute("UPDATE jobs SET sent = sent + ?, failed = MAX(failed - ?, 0) WHERE id = ?", (sent, sent, job_id))
+        finally:
+            db.close()
+
+    # Returns the progress of a job, or None if there is no job with that ID
+    def status(self, job_id):
+        db = self.connect()
+        try:
+            job = db.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+            # Finds when the next task held for its send window is due
+            next_send = db.execute("SELECT MIN(not_before) FROM tasks WHERE job_id = ? AND status = 'queued'", (job_id,)).fetchone()[0]
+        finally:
+            db.close()
+        if job is None:
+            return None
+        # Measures throughput from the first claimed task until the job finished, or until now if it's still running
+        elapsed = ((job["finished_at"] or time.time()) - job["started_at"]) if job["started_at"] else 0
+        return {
+            "job_id": job_id,
+            "status": job["status"],
+            "total": job["total"],
+            "sent": job["sent"],
+            "failed": job["failed"],
+            "skipped": job["skipped"],
+            "remaining": job["total"] - job["sent"] - job["failed"] - job["skipped"],
+            "messages_per_second": round(job["sent"] / elapsed, 3) if elapsed else 0.0,
+            # Reports when sending resumes if every remaining task is waiting for its send window
+            "next_send_at": next_send if next_send and next_send > time.time() else None,
+        }
+
+
+# Sends the rows covered by one task and returns how many were sent, how many failed and how many were skipped
+def run_task(task, service_factory=None, threads=4, ledger_path=LEDGER_DATABASE, transport="gmail", suppression_path=SUPPRESSION_DATABASE,
+             metrics_path=METRICS_DATABASE, deadline=None, render_cache=None, tally=None, path=JOBS_DATABASE):
+    """
+    tally, if given, is a Counter the task's settled outcomes are added to as each batch settles (see
+    Sales.send_contacts), so the caller still has them if the task raises. Sends are paced by a rate
+    limiter kept in the queue database at path, shared by every worker sending as the same account
+    """
+    # Rebuilds the campaign from the profile stored with the job
+    sales = Sales(**task["profile"])
+    # Renders through the worker's cache if there is one (True keeps it in memory, a path also keeps it on disk)
+    if render_cache:
+        sales.render_cache = shared_render_cache(None if render_cache is True else render_cache)
+    limiter = SharedTokenBucket(path, sales.email)
+    sender = sales.create_sender(transport, service_factory, threads, limiter)
+    # Sends the task's rows under the job ID, so a task that is run again skips everything already sent
+    ledger = SendLedger(ledger_path)
+    # Skips addresses on the suppression list, and addresses other tasks of the job already claimed
+    suppression = SuppressionList(suppression_path)
+    timer = StageTimer()
+    tally = Counter() if tally is None else tally
+    try:
+        sales.send_contacts(task["path"], sender, ledger, task["job_id"], task["start"], task["stop"], timer=timer, suppression=suppression,
+                            schedule=task.get("schedule"), zone=task.get("zone"), deadline=deadline, tally=tally)
+    finally:
+        sent, failed, skipped = tally["sent"], tally["failed"], tally["skipped"]
+        sender.close()
+        limiter.close()
+        ledger.close()
+        suppression.close()
+        # Adds the task's stage times and counts to the job's summary, and publishes this worker's metrics
+        MetricsStore(metrics_path).add_campaign(task["job_id"], timer, sent=sent, failed=failed, skipped=skipped)
+        shared_registry().flush(metrics_path)
+    return sent, failed, skipped
+
+
+# Sends a job's dead letters again and returns how many were sent, failed again and were skipped
+def replay_job(job_id, path=JOBS_DATABASE, service_factory=None, threads=4, ledger_path=LEDGER_DATABASE, transport="gmail",
+               suppression_path=SUPPRESSION_DATABASE, metrics_path=METRICS_DATABASE, kinds=RETRYABLE):
+    queue = JobQueue(path)
+    profile = queue.profile(job_id)
+    if profile is None:
+        raise ValueError(f"No job with ID {job_id}")
+    # Rebuilds the campaign from the profile stored with the job, to send as the same account
+    sales = Sales(**profile)
+    # Shares the account's quota with any workers sending as it at the same time
+    limiter = SharedTokenBucket(path, sales.email)
+    sender = sales.create_sender(transport, service_factory, threads, limiter)
+    ledger = SendLedger(ledger_path)
+    suppression = SuppressionList(suppression_path)
+    try:
+        sent, failed, skipped = sales.replay_dead_letters(sender, ledger, job_id, suppression, kinds)
+    finally:
+        sender.close()
+        limiter.close()
+        ledger.close()
+        suppression.close()
+        shared_registry().flush(metrics_path)
+    queue.record_replay(job_id, sent)
+    return sent, failed, skipped
+
+
+# Claims and runs tasks until stopped, waiting poll seconds whenever the queue is empty
+def run_worker(path=JOBS_DATABASE, service_factory=None, threads=4, poll=1.0, ledger_path=LEDGER_DATABASE, transport="gmail", render_cache=None):
+    # Opens the shared queue and names this worker after its process
+    queue = JobQueue(path)
+    worker = f"worker-{os.getpid()}"
+    # Imports what sending needs while the worker waits for its first task
+    warm_up_campaigns(transport)
+    while True:
+        task = queue.claim(worker)
+        # Waits for new work if the queue is empty
+        if task is None:
+            time.sleep(poll)
+            continue
+        # Stops the task when the send window closes in its timezone, and holds it until the window next opens
+        schedule = task["schedule"]
+        deadline = schedule.closes(task["zone"]) if schedule else None
+        if deadline is not None and deadline <= time.time():
+            queue.finish(task, 0, 0, 0, resume_at=schedule.next_open(task["zone"]))
+            continue
+        tally = Counter()
+        try:
+            sent, failed, skipped = run_task(task, service_factory, threads, ledger_path, transport, deadline=deadline,
+                                             render_cache=render_cache, tally=tally, path=path)
+        except Exception as error:
+            attempts = task["attempts"] + 1
+            # Counts the retry or the failure under the error's name and publishes it straight away; the message is kept with the task
+            metrics = shared_registry()
+            metrics.inc("sales_task_retries_total" if attempts < MAX_TASK_ATTEMPTS else "sales_task_failures_total", error=type(error).__name__)
+            metrics.flush()
+            # Runs the task again later, from its checkpoint, counting only the batches this run settled
+            if attempts < MAX_TASK_ATTEMPTS:
+                queue.fail(task, tally["sent"], tally["failed"], tally["skipped"], error, retry_at=time.time() + TASK_RETRY_DELAY * attempts)
+                continue
+            # Otherwise closes it, counting what the ledger recorded as sent in the batch it stopped in and every row it never settled as failed
+            size = task["size"] or task["stop"] - task["start"]
+            unsettled = size - task["settled"] - tally["sent"] - tally["failed"] - tally["skipped"] - tally["unsettled"]
+            queue.fail(task, tally["sent"] + tally["unsettled"], tally["failed"] + max(unsettled, 0), tally["skipped"], error)
+            continue
+        # Requeues the task if the window closed before it finished; running it again skips what it already sent
+        resume_at = schedule.next_open(task["zone"]) if deadline is not None and time.time() >= deadline else None
+        queue.finish(task, sent, failed, skipped, resume_at)
+
+
+# Starts a pool of worker processes that run queued campaigns in the background
+def start_workers(count, path=JOBS_DATABASE, service_factory=None, threads=4, ledger_path=LEDGER_DATABASE, transport="gmail", render_cache=None):
+    """
+    Workers sending as the same account share one rate limiter, kept in the queue database, so
+    together they send at the account's quota however many of them there are
+    """
+    # Resumes tasks a previous pool was in the middle of; the ledger keeps them from sending duplicates
+    JobQueue(path).requeue_running()
+    workers = []
+    for _ in range(count):
+        process = multiprocessing.Process(target=run_worker, args=(path, service_factory, threads, 1.0, ledger_path, transport, render_cache), daemon=True)
+        process.start()
+        workers.append(process)
+    return workers
+
+
+# Runs a pool of workers in the foreground when this file is run directly
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Runs queued email campaigns")
+    parser.add_argument("--workers", type=int, default=2, help="number of worker processes")
+    parser.add_argument("--threads", type=int, default=4, help="number of sends in flight per worker")
+    parser.add_argument("--database", default=JOBS_DATABASE, help="path to the queue database")
+    parser.add_argument("--transport", default="gmail", choices=["gmail", "smtp", "auto"], help="how messages are delivered")
+    parser.add_argument("--render-cache", nargs="?", const=True, help="reuse rendered sections across campaigns, kept on disk if a path is given")
+    parser.add_argument("--replay", metavar="JOB_ID", help="send a job's failed messages again instead of running workers")
+    parser.add_argument("--all-errors", action="store_true", help="with --replay, also resend messages that failed permanently, such as bad addresses")
+    args = parser.parse_args()
+    if args.replay:
+        sent, failed, skipped = replay_job(args.replay, args.database, threads=args.threads, transport=args.transport,
+                                           kinds=None if args.all_errors else RETRYABLE)
+        print(f"Replayed job {args.replay}: {sent} sent, {failed} failed again, {skipped} skipped")
+    else:
+        for process in start_workers(args.workers, args.database, threads=args.threads, transport=args.transport, render_cache=args.render_cache):
+            process.join()
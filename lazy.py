@@ -0,0 +1,57 @@
+# Library to import a module the first time it is used
+import importlib
+# Library to find a module without importing it, so a missing optional dependency is still reported up front
+import importlib.util
+# Library to check whether a module has already been imported
+import sys
+# Library to start warm-up imports in the background
+import threading
+# Library to give the stand-in the type of a module
+import types
+
+
+# Defines a stand-in for a module that imports it the first time one of its attributes is read
+class LazyModule(types.ModuleType):
+    """
+    Lets a module be named at the top of a file, as the rest of this project does, without paying for
+    the import until a function actually uses it. Once imported, the module's attributes are copied onto
+    the stand-in so later lookups cost the same as on the module itself. Importing goes through
+    importlib, whose per-module locks make the first use safe from several threads at once
+    """
+    # Reads an attribute of the module, importing it first if this is the first attribute read
+    def __getattr__(self, attribute):
+        module = importlib.import_module(self.__name__)
+        self.__dict__.update(vars(module))
+        return getattr(module, attribute)
+
+
+# Returns a module as it is if it has already been imported, or else a stand-in that imports it on first use
+def lazy_import(name):
+    """
+    Raises ImportError straight away if the module's top-level package isn't installed, so optional
+    dependencies can still be checked with try/except ImportError where they are named. Only the top-level
+    package is looked up, since finding a submodule would import the package it belongs to
+    """
+    package = name.partition(".")[0]
+    if name not in sys.modules and importlib.util.find_spec(package) is None:
+        raise ImportError(f"No module named '{package}'", name=package)
+    return sys.modules.get(name) or LazyModule(name)
+
+
+# Imports modules in a daemon thread, so the first request that needs them doesn't wait, and returns the thread
+def warm_up(*modules, then=None):
+    """
+    modules are stand-ins from lazy_import or module names. then, if given, is called once they are all
+    imported, for work such as loading a discovery document. Errors are left to the first real use to raise
+    """
+    def run():
+        try:
+            for module in modules:
+                importlib.import_module(module if isinstance(module, str) else module.__name__)
+            if then:
+                then()
+        except Exception:
+            pass
+    thread = threading.Thread(target=run, name="warm-up", daemon=True)
+    thread.start()
+    return thread
@@ -0,0 +1,153 @@
+# Library to hash message content
+import hashlib
+# Library for the local send ledger
+import sqlite3
+# Library to timestamp each entry
+import time
+
+# Defines the default location of the ledger database
+LEDGER_DATABASE = "ledger.sqlite3"
+
+# Defines the append-only table of send attempts, the table of how far each file has been sent, the table of which
+# row claimed each recipient, and the dead-letter list of messages that failed, kept whole so they can be sent again
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS sends (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    campaign TEXT NOT NULL,
+    recipient TEXT NOT NULL,
+    content_hash TEXT NOT NULL,
+    status TEXT NOT NULL,
+    message_id TEXT,
+    error TEXT,
+    created_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS sends_key ON sends (campaign, recipient, content_hash, status);
+CREATE TABLE IF NOT EXISTS checkpoints (
+    campaign TEXT NOT NULL,
+    key TEXT NOT NULL,
+    rows INTEGER NOT NULL,
+    PRIMARY KEY (campaign, key)
+);
+CREATE TABLE IF NOT EXISTS recipients (
+    campaign TEXT NOT NULL,
+    recipient TEXT NOT NULL,
+    owner TEXT NOT NULL,
+    PRIMARY KEY (campaign, recipient)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS dead_letters (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    campaign TEXT NOT NULL,
+    recipient TEXT NOT NULL,
+    content_hash TEXT NOT NULL,
+    raw TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    error TEXT,
+    attempts INTEGER NOT NULL DEFAULT 1,
+    created_at REAL NOT NULL,
+    resolved_at REAL,
+    UNIQUE (campaign, recipient, content_hash)
+);
+"""
+
+
+# Hashes an encoded message so the ledger can tell whether the same content was already sent
+def content_hash(raw):
+    return hashlib.sha256(raw.encode()).hexdigest()
+
+
+# Defines the durable record of every send, used to resume campaigns without sending duplicates
+class SendLedger:
+    """
+    Appends one entry per send attempt, keyed by campaign, recipient and content hash, and keeps a
+    checkpoint of how many rows of each contact file are settled so a rerun can skip straight past them
+    """
+    # Opens the ledger database in write-ahead logging mode and creates its tables if they don't exist yet
+    def __init__(self, path=LEDGER_DATABASE):
+        # Stores the location of the ledger database
+        self.path = path
+        self.db = sqlite3.connect(path, timeout=30, isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        # Lets the OS flush the log on its own schedule, which WAL keeps safe against corruption
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.executescript(SCHEMA)
+
+    # Closes the connection to the ledger database
+    def close(self):
+        self.db.close()
+
+    # Returns how many rows of a contact file have already been settled for a campaign
+    def checkpoint(self, campaign, key):
+        row = self.db.execute("SELECT rows FROM checkpoints WHERE campaign = ? AND key = ?", (campaign, key)).fetchone()
+        return row[0] if row else 0
+
+    # Returns the (recipient, content hash) pairs that were already sent for a campaign
+    def already_sent(self, campaign, keys):
+        sent = set()
+        for recipient, digest in keys:
+            if self.db.execute("SELECT 1 FROM sends WHERE campaign = ? AND recipient = ? AND content_hash = ? AND status = 'sent' LIMIT 1",
+                               (campaign, recipient, digest)).fetchone():
+                sent.add((recipient, digest))
+        return sent
+
+    # Appends the outcome of one or more sends
+    def record(self, campaign, entries):
+        """
+        entries is a list of (recipient, content hash, status, message ID, error) tuples
+        """
+        now = time.time()
+        self.db.executemany("INSERT INTO sends (campaign, recipient, content_hash, status, message_id, error, created_at) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                            [(campaign, *entry, now) for entry in entries])
+
+    # Claims each recipient for the contact row that first listed them and returns the entries whose recipient another row already claimed
+    def claim(self, campaign, entries):
+        """
+        entries is a list of (recipient, owner) tuples, where owner identifies the file and row; a row that
+        claimed a recipient keeps the claim if it is run again, so a resumed campaign still reaches them
+        """
+        owners = {}
+        self.db.execute("BEGIN IMMEDIATE")
+        try:
+            self.db.executemany("INSERT OR IGNORE INTO recipients (campaign, recipient, owner) VALUES (?, ?, ?)",
+                                [(campaign, recipient, owner) for recipient, owner in entries])
+            recipients = list({recipient for recipient, _ in entries})
+            for i in range(0, len(recipients), 500):
+                chunk = recipients[i:i + 500]
+                owners.update(self.db.execute(f"SELECT recipient, owner FROM recipients WHERE campaign = ? AND recipient IN ({', '.join('?' * len(chunk))})",
+                                              (campaign, *chunk)))
+            self.db.execute("COMMIT")
+        except Exception:
+            self.db.execute("ROLLBACK")
+            raise
+        return {(recipient, owner) for recipient, owner in entries if owners.get(recipient) != owner}
+
+    # Adds failed messages to the dead-letter list, or counts another attempt at a message already on it
+    def bury(self, campaign, entries):
+        """
+        entries is a list of (recipient, content hash, encoded message, error kind, error) tuples
+        """
+        now = time.time()
+        self.db.executemany("""INSERT INTO dead_letters (campaign, recipient, content_hash, raw, kind, error, created_at) VALUES (?, ?, ?, ?, ?, ?, ?)
+                               ON CONFLICT (campaign, recipient, content_hash) DO UPDATE SET
+                               kind = excluded.kind, error = excluded.error, attempts = attempts + 1, resolved_at = NULL""",
+                            [(campaign, *entry, now) for entry in entries])
+
+    # Returns a campaign's unresolved dead letters of the given error kinds (or every kind) as (ID, recipient, content hash, encoded message) tuples
+    def dead_letters(self, campaign, kinds=None):
+        kinds = list(kinds or [])
+        where = f" AND kind IN ({', '.join('?' * len(kinds))})" if kinds else ""
+        return self.db.execute(f"SELECT id, recipient, content_hash, raw FROM dead_letters WHERE campaign = ? AND resolved_at IS NULL{where} ORDER BY id",
+                               (campaign, *kinds)).fetchall()
+
+    # Returns how many of a campaign's dead letters are unresolved, by error kind
+    def dead_letter_counts(self, campaign):
+        return dict(self.db.execute("SELECT kind, COUNT(*) FROM dead_letters WHERE campaign = ? AND resolved_at IS NULL GROUP BY kind", (campaign,)))
+
+    # Marks dead letters as resolved, once they were sent or no longer need to be
+    def resolve(self, ids):
+        now = time.time()
+        self.db.executemany("UPDATE dead_letters SET resolved_at = ? WHERE id = ?", [(now, id) for id in ids])
+
+    # Moves a file's checkpoint forward once every row before it has been recorded
+    def advance(self, campaign, key, rows):
+        self.db.execute("INSERT INTO checkpoints (campaign, key, rows) VALUES (?, ?, ?) ON CONFLICT (campaign, key) DO UPDATE SET rows = excluded.rows",
+                        (campaign, key, rows))
@@ -0,0 +1,50 @@
+# Library for encoding binary data into a URL-safe format
+import base64
+# Library to encode subjects that aren't plain ASCII
+from email.header import Header
+
+# Defines the opening of the HTML document every email body is wrapped in
+HTML_OPEN = "<!DOCTYPE html>\n<html>\n<body>\n"
+# Defines the closing of the HTML document every email body is wrapped in
+HTML_CLOSE = "\n</body>\n</html>"
+
+
+# Removes line breaks from a header value so contact data can't add headers of its own
+def header_value(value):
+    return str(value).replace("\r", " ").replace("\n", " ")
+
+
+# Defines the stage that turns rendered subjects and bodies into Gmail-ready messages
+class MessageAssembler:
+    """
+    Builds the MIME headers, HTML wrapper and signature once per campaign and splices each recipient's
+    address, subject and body into them, instead of building a MIMEText object for every message
+    """
+    # Builds the bytes that are the same in every message of the campaign
+    def __init__(self, sender, signature):
+        # Stores the headers shared by every message, in the order MIMEText writes them
+        self.head = ('Content-Type: text/html; charset="utf-8"\nMIME-Version: 1.0\nContent-Transfer-Encoding: base64\n'
+                     f"From: {header_value(sender)}\n").encode()
+        # Stores the HTML that goes before each body
+        self.body_open = HTML_OPEN.encode()
+        # Stores the signature and the HTML that goes after each body
+        self.body_close = (signature + HTML_CLOSE).encode()
+
+    # Encodes a subject as-is if it is plain ASCII, or as an RFC 2047 encoded word if it isn't
+    @staticmethod
+    def encode_subject(subject):
+        subject = header_value(subject)
+        if subject.isascii() and len(subject) < 900:
+            return subject
+        return Header(subject, "utf-8").encode()
+
+    # Assembles one message and returns it as the URL-safe base64 string the Gmail API expects
+    def assemble(self, to, subject, body):
+        # Encodes the body in 76-character base64 lines, as MIMEText does
+        payload = base64.encodebytes(self.body_open + body.encode() + self.body_close)
+        headers = f"To: {header_value(to)}\nSubject: {self.encode_subject(subject)}\n\n".encode()
+        return base64.urlsafe_b64encode(self.head + headers + payload).decode()
+
+    # Assembles a list of (to, subject, body) tuples, so a whole batch can be handed to a worker process at once
+    def assemble_many(self, rows):
+        return [self.assemble(to, subject, body) for to, subject, body in rows]
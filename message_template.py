@@ -0,0 +1,121 @@
+# Function that defers heavy libraries until the first function that needs them runs
+from lazy import lazy_import
+# Library for data manipulation and analysis, imported the first time a contact file is read or rendered
+pd = lazy_import("pandas")
+# Library to find {Column Name} placeholders in message text
+import re
+# Library to cache compiled templates so the same text is only parsed once
+from functools import lru_cache
+
+# Matches a placeholder such as {First Name} and captures the column name inside the braces
+PLACEHOLDER = re.compile(r"\{([^{}]*)\}")
+
+
+# Defines the error raised when a template can't be compiled or doesn't match the contact file
+class TemplateError(ValueError):
+    pass
+
+
+# Defines a message template that is parsed once and then rendered for every contact
+class CompiledTemplate:
+    """
+    Parses {Column Name} placeholders out of message text once, so rendering a row is a single format call
+    """
+    # Parses the text into literal pieces and the column referenced by each placeholder
+    def __init__(self, text):
+        # Stores the original template text
+        self.text = text
+        # Stores the column name of each placeholder, in the order they appear
+        self.placeholders = []
+        # Stores the literal text around the placeholders, one more piece than there are placeholders
+        self.literals = []
+        # Builds a str.format pattern with a positional field where each placeholder was
+        pattern = ""
+        position = 0
+        for match in PLACEHOLDER.finditer(text):
+            # Keeps the literal text before the placeholder, escaping its braces so str.format leaves them alone
+            self.literals.append(text[position:match.start()])
+            pattern += self._escape(self.literals[-1]) + "{" + str(len(self.placeholders)) + "}"
+            self.placeholders.append(match.group(1))
+            position = match.end()
+        # Rejects an opening brace that is never closed instead of failing halfway through a send
+        rest = text[position:]
+        if "{" in rest:
+            raise TemplateError(f"Unclosed placeholder in template: {rest[rest.index('{'):]!r}")
+        self.literals.append(rest)
+        pattern += self._escape(rest)
+        # Stores the bound format method used to render a row
+        self.format = pattern.format
+        # Stores each referenced column once, in the order it first appears
+        self.columns = tuple(dict.fromkeys(self.placeholders))
+
+    # Doubles braces in literal text so they are not read as format fields
+    @staticmethod
+    def _escape(text):
+        return text.replace("{", "{{").replace("}", "}}")
+
+    # Raises a TemplateError if the template uses a column the contact file doesn't have
+    def check(self, columns):
+        missing = [column for column in self.columns if column not in columns]
+        if missing:
+            raise TemplateError(f"Template references columns that are not in the contact file: {', '.join(missing)}")
+
+    # Renders the template for a single contact from a mapping of column name to value
+    def render(self, values):
+        return self.format(*[values[column] for column in self.placeholders])
+
+    # Renders the template for every contact from pre-extracted column lists, in one pass
+    def render_rows(self, columns, count):
+        # Returns the plain text for every row if there are no placeholders to fill
+        if not self.placeholders:
+            return [self.text] * count
+        # Zips the referenced columns so each row's values go straight into the format call
+        return [self.format(*row) for row in zip(*[columns[column] for column in self.placeholders])]
+
+    # Renders the template for every contact at once by concatenating whole pandas string columns
+    def render_series(self, columns, index):
+        # Starts every row with the literal text before the first placeholder
+        result = pd.Series(self.literals[0], index=index, dtype=object)
+        # Appends each placeholder's column and the literal text that follows it
+        for column, literal in zip(self.placeholders, self.literals[1:]):
+            result = result + columns[column] + literal
+        return result
+
+
+# Compiles template text, reusing the compiled template when the same text is seen again
+@lru_cache(maxsize=64)
+def compile_template(text):
+    return CompiledTemplate(text)
+
+
+# Compiles the email body, wrapping each line in HTML paragraph tags before parsing placeholders
+@lru_cache(maxsize=64)
+def compile_body(text):
+    # Initializes an empty string to store the formatted body
+    body = ""
+    # Splits the body text into a list of lines
+    lines = text.splitlines()
+    # Iterates through all lines except the last one
+    for x in range(len(lines)-1):
+        # Gets the current line
+        line = lines[x]
+        # Skips the line if it is empty
+        if line == "":
+            continue
+        # Adds a starting HTML paragraph tag to the line
+        new_line = "<p>" + line
+        # If the current line is the second to last line, appends the last line with a line break
+        if x == len(lines) - 2:
+            new_line += f"<br>{lines[-1]}"
+        # Adds a closing HTML paragraph tag and a newline character
+        new_line += "</p>\n"
+        # Appends the new line to the body string
+        body += new_line
+    # Parses the placeholders in the finished HTML body
+    return CompiledTemplate(body)
+
+
+# Compiles each non-empty line of a LinkedIn message into its own template
+@lru_cache(maxsize=64)
+def compile_lines(text):
+    return tuple(CompiledTemplate(line) for line in text.splitlines() if line != "")
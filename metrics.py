@@ -0,0 +1,256 @@
+# Library to time each stage of the send pipeline
+import time
+# Library to keep stage totals safe to update from several threads
+import threading
+# Library to store metric labels
+import json
+# Library for the metrics database shared by every process
+import sqlite3
+# Library to time a block of code with a with statement
+from contextlib import contextmanager
+# Library to share one registry across the process
+from functools import lru_cache
+
+
+# Defines the default location of the metrics database shared by the web app and the workers
+METRICS_DATABASE = "metrics.sqlite3"
+# Defines the histogram buckets, in seconds, for API round trips and pipeline stages
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+# Describes each metric for the /metrics endpoint
+METRIC_HELP = {
+    "sales_stage_seconds": ("histogram", "Time spent in one batch of a pipeline stage"),
+    "sales_stage_items_total": ("counter", "Rows or messages handled by a pipeline stage"),
+    "sales_send_seconds": ("histogram", "Round trip of one send to the transport"),
+    "sales_rate_limit_wait_seconds": ("histogram", "Time a send waited on the rate limiter"),
+    "sales_send_retries_total": ("counter", "Sends retried after a rate limit error, server or network error, dropped connection or temporary refusal"),
+    "sales_send_errors_total": ("counter", "Sends that failed for good"),
+    "sales_circuit_opens_total": ("counter", "Times the circuit breaker held every send because the API kept failing"),
+    "sales_dead_letters_total": ("counter", "Failed messages added to the dead-letter list, or replayed from it, per outcome"),
+    "sales_messages_total": ("counter", "Messages handled per outcome: sent, failed or skipped"),
+    "sales_render_cache_total": ("counter", "Rendered sections found in the render cache (hit) or rendered (miss)"),
+    "sales_task_retries_total": ("counter", "Queued tasks put back on the queue after raising, per error"),
+    "sales_task_failures_total": ("counter", "Queued tasks given up on after raising on every attempt, per error"),
+}
+
+# Defines the table of metric series added up across processes and the table of per-campaign totals
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS series (
+    metric TEXT NOT NULL,
+    name TEXT NOT NULL,
+    labels TEXT NOT NULL,
+    value REAL NOT NULL,
+    PRIMARY KEY (name, labels)
+);
+CREATE TABLE IF NOT EXISTS campaign_totals (
+    campaign TEXT NOT NULL,
+    name TEXT NOT NULL,
+    value REAL NOT NULL,
+    updated_at REAL NOT NULL,
+    PRIMARY KEY (campaign, name)
+);
+"""
+
+
+# Defines a timer that adds up how long each stage of a campaign takes and how many items it handled
+class StageTimer:
+    """
+    Keeps a running total of seconds and items per stage name, such as read, render, encode and send,
+    and records each measurement in the registry under the pipeline's name
+    """
+    # Initializes the timer with no stages recorded
+    def __init__(self, pipeline="email", registry=None):
+        # Stores the name the registry files this timer's stages under, such as email, linkedin or delete
+        self.pipeline = pipeline
+        # Stores the registry each measurement is also recorded in
+        self.registry = registry or shared_registry()
+        # Stores the total seconds spent in each stage, in the order the stages were first seen
+        self.seconds = {}
+        # Stores the total items each stage handled
+        self.items = {}
+        # Guards the totals so worker threads can add to them
+        self.lock = threading.Lock()
+
+    # Adds a duration and item count to a stage's totals
+    def add(self, name, seconds, items=0):
+        with self.lock:
+            self.seconds[name] = self.seconds.get(name, 0.0) + seconds
+            self.items[name] = self.items.get(name, 0) + items
+        self.registry.observe("sales_stage_seconds", seconds, pipeline=self.pipeline, stage=name)
+        self.registry.inc("sales_stage_items_total", items, pipeline=self.pipeline, stage=name)
+
+    # Times the body of a with block and adds it to a stage
+    @contextmanager
+    def stage(self, name, items=0):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - start, items)
+
+    # Returns each stage's seconds, items and items per second
+    def summary(self):
+        with self.lock:
+            return {name: {"seconds": round(seconds, 6), "items": self.items[name],
+                           "per_second": round(self.items[name] / seconds, 1) if seconds else 0.0}
+                    for name, seconds in self.seconds.items()}
+
+    # Formats the summary as a table, one stage per line
+    def report(self):
+        lines = [f"{'stage':<10}{'seconds':>12}{'items':>10}{'items/s':>14}"]
+        for name, stage in self.summary().items():
+            lines.append(f"{name:<10}{stage['seconds']:>12.3f}{stage['items']:>10}{stage['per_second']:>14,.1f}")
+        return "\n".join(lines)
+
+
+# Escapes a label value as the Prometheus text format requires: backslashes, double quotes and newlines
+def escape_label(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+# Formats label pairs the way Prometheus writes them, such as {stage="read"}
+def format_labels(labels):
+    return "{" + ",".join(f'{key}="{escape_label(value)}"' for key, value in labels) + "}" if labels else ""
+
+
+# Defines the in-process counters and histograms that the hot paths update
+class MetricsRegistry:
+    """
+    Adds up counts and histogram buckets in memory, which is cheap enough for every send, until
+    flush moves them into the metrics database where every process's numbers are added together
+    """
+    # Initializes an empty registry
+    def __init__(self):
+        # Stores each series' value since the last flush, keyed by (metric, series name, sorted labels)
+        self.values = {}
+        # Guards the values so worker threads can update them
+        self.lock = threading.Lock()
+
+    # Adds to a counter
+    def inc(self, metric, value=1, **labels):
+        key = (metric, metric, tuple(sorted(labels.items())))
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + value
+
+    # Records one duration in a histogram, adding it to every bucket it fits in
+    def observe(self, metric, seconds, **labels):
+        labels = tuple(sorted(labels.items()))
+        with self.lock:
+            for bound in LATENCY_BUCKETS:
+                if seconds <= bound:
+                    key = (metric, f"{metric}_bucket", labels + (("le", str(bound)),))
+                    self.values[key] = self.values.get(key, 0) + 1
+            for name, value in ((f"{metric}_bucket", 1), (f"{metric}_sum", seconds), (f"{metric}_count", 1)):
+                key = (metric, name, labels + ((("le", "+Inf"),) if name.endswith("_bucket") else ()))
+                self.values[key] = self.values.get(key, 0) + value
+
+    # Times the body of a with block into a histogram
+    @contextmanager
+    def time(self, metric, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(metric, time.perf_counter() - start, **labels)
+
+    # Adds everything recorded since the last flush to the metrics database and starts counting from zero
+    def flush(self, path=METRICS_DATABASE):
+        with self.lock:
+            values, self.values = self.values, {}
+        if values:
+            MetricsStore(path).add(values)
+
+
+# Returns the registry shared by the whole process, creating it the first time
+@lru_cache(maxsize=None)
+def shared_registry():
+    return MetricsRegistry()
+
+
+# Defines the metrics database every process flushes into
+class MetricsStore:
+    """
+    Keeps the running totals of every series, for the /metrics endpoint, and each campaign's stage
+    totals and message counts, for its summary
+    """
+    # Initializes the store and creates its tables if they don't exist yet
+    def __init__(self, path=METRICS_DATABASE):
+        # Stores the location of the metrics database
+        self.path = path
+        db = self.connect()
+        try:
+            db.executescript(SCHEMA)
+        finally:
+            db.close()
+
+    # Opens a connection in autocommit mode with write-ahead logging so processes don't block each other
+    def connect(self):
+        db = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        db.execute("PRAGMA journal_mode=WAL")
+        return db
+
+    # Adds the values flushed from a registry to the running totals
+    def add(self, values):
+        db = self.connect()
+        try:
+            db.executemany("""INSERT INTO series (metric, name, labels, value) VALUES (?, ?, ?, ?)
+                              ON CONFLICT (name, labels) DO UPDATE SET value = value + excluded.value""",
+                           [(metric, name, json.dumps(labels), value) for (metric, name, labels), value in values.items()])
+        finally:
+            db.close()
+
+    # Adds a run's stage totals and message counts to a campaign's summary
+    def add_campaign(self, campaign, timer=None, **counts):
+        totals = dict(counts)
+        for stage, summary in (timer.summary() if timer else {}).items():
+            totals[f"{stage}_seconds"] = summary["seconds"]
+            totals[f"{stage}_items"] = summary["items"]
+        now = time.time()
+        db = self.connect()
+        try:
+            db.executemany("""INSERT INTO campaign_totals (campaign, name, value, updated_at) VALUES (?, ?, ?, ?)
+                              ON CONFLICT (campaign, name) DO UPDATE SET value = value + excluded.value, updated_at = excluded.updated_at""",
+                           [(campaign, name, value, now) for name, value in totals.items()])
+        finally:
+            db.close()
+
+    # Returns a campaign's stage totals and message counts, with rows per second for each stage, or None if nothing was recorded
+    def campaign(self, campaign):
+        db = self.connect()
+        try:
+            rows = dict(db.execute("SELECT name, value FROM campaign_totals WHERE campaign = ?", (campaign,)).fetchall())
+        finally:
+            db.close()
+        if not rows:
+            return None
+        stages = {}
+        for name in rows:
+            if name.endswith("_seconds"):
+                stage = name[:-len("_seconds")]
+                seconds, items = rows[name], rows.get(f"{stage}_items", 0)
+                stages[stage] = {"seconds": round(seconds, 6), "items": int(items), "per_second": round(items / seconds, 1) if seconds else 0.0}
+        counts = {name: int(value) for name, value in rows.items() if not name.endswith(("_seconds", "_items"))}
+        return {"campaign": campaign, **counts, "stages": stages}
+
+    # Renders every series in the Prometheus text exposition format
+    def prometheus(self):
+        db = self.connect()
+        try:
+            rows = db.execute("SELECT metric, name, labels, value FROM series ORDER BY metric, name, labels").fetchall()
+        finally:
+            db.close()
+        # Sorts each histogram's buckets by their upper bound, with +Inf last
+        def order(row):
+            labels = dict(json.loads(row[2]))
+            bound = labels.pop("le", None)
+            return row[0], sorted(labels.items()), row[1], float(bound) if bound else 0.0
+        lines = []
+        metric = None
+        for row in sorted(rows, key=order):
+            if row[0] != metric:
+                metric = row[0]
+                kind, help_text = METRIC_HELP.get(metric, ("untyped", metric))
+                lines += [f"# HELP {metric} {help_text}", f"# TYPE {metric} {kind}"]
+            value = row[3]
+            lines.append(f"{row[1]}{format_labels(json.loads(row[2]))} {int(value) if float(value).is_integer() else value}")
+        return "\n".join(lines) + "\n"
@@ -0,0 +1,74 @@
+# Library to wait between status checks without holding a thread
+import asyncio
+# Library to encode each status as event data
+import json
+# Library to wait between status checks in a thread
+import time
+
+# Defines how often a progress stream checks its job's status, in seconds
+PROGRESS_INTERVAL = 1.0
+# Defines how long a progress stream goes without a change before it sends a comment that keeps proxies from closing it
+KEEPALIVE_INTERVAL = 15.0
+# Defines the headers every progress stream is sent with, so browsers and proxies pass each event on as it comes
+STREAM_HEADERS = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+
+
+# Returns a server-sent event carrying a JSON message
+def sse_event(event, data):
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+# Defines the server-sent event stream of a queued campaign's progress
+class ProgressStream:
+    """
+    Reads a job's status every interval seconds and sends a progress event whenever its counts change,
+    a keep-alive comment when they haven't changed for keepalive seconds, and a done event once every
+    task has finished, which ends the stream. Iterate over it from a thread, or over events() from an
+    event loop, which checks the status in an executor and holds no thread while it waits
+    """
+    # Initializes the stream for a job in a queue
+    def __init__(self, queue, job_id, interval=PROGRESS_INTERVAL, keepalive=KEEPALIVE_INTERVAL):
+        self.queue = queue
+        self.job_id = job_id
+        self.interval = interval
+        self.keepalive = keepalive
+        # Stores the counts last sent, and how long they have gone unchanged
+        self.last = None
+        self.quiet = 0.0
+
+    # Returns the events for the job's latest status and whether the stream is over
+    def step(self, status):
+        if status is None:
+            return [sse_event("error", {"error": f"No job with ID {self.job_id}"})], True
+        if status["status"] == "done":
+            return [sse_event("done", status)], True
+        # Compares everything but the rate, which changes with the clock while the counts stand still
+        counts = {key: value for key, value in status.items() if key != "messages_per_second"}
+        if counts != self.last:
+            self.last, self.quiet = counts, 0.0
+            return [sse_event("progress", status)], False
+        self.quiet += self.interval
+        if self.quiet >= self.keepalive:
+            self.quiet = 0.0
+            return [": keep-alive\n\n"], False
+        return [], False
+
+    # Yields the stream's events, sleeping in the calling thread between status checks
+    def __iter__(self):
+        while True:
+            events, over = self.step(self.queue.status(self.job_id))
+            yield from events
+            if over:
+                return
+            time.sleep(self.interval)
+
+    # Yields the stream's events, checking the status in an executor and sleeping on the event loop in between
+    async def events(self, executor=None):
+        loop = asyncio.get_running_loop()
+        while True:
+            events, over = self.step(await loop.run_in_executor(executor, self.queue.status, self.job_id))
+            for event in events:
+                yield event
+            if over:
+                return
+            await asyncio.sleep(self.interval)
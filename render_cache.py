@@ -0,0 +1,215 @@
+# Library to hash each template into a fixed-size key for the on-disk cache
+import hashlib
+# Library for the optional on-disk cache
+import sqlite3
+# Library to guard the cache when several threads render at once
+import threading
+# Library to record when each template on disk was last used
+import time
+# Library to keep templates and entries in the order they were used or added
+from collections import OrderedDict
+# Library to share one cache across the process
+from functools import lru_cache
+# Function that defers heavy libraries until the first function that needs them runs
+from lazy import lazy_import
+# Library for data manipulation and analysis, imported the first time a contact file is read or rendered
+pd = lazy_import("pandas")
+# Registry that counts cache hits and misses
+from metrics import shared_registry
+
+# Defines how many characters of rendered text the in-memory cache holds before evicting entries
+MEMORY_LIMIT = 64 * 1024 * 1024
+# Defines how many entries the on-disk cache holds before evicting those of the least recently used templates
+DISK_LIMIT = 1_000_000
+# Separates the template text from the names of the steps applied around it, and a row's values from each other on disk
+SEPARATOR = "\x1f"
+
+# Defines the table of templates on disk, with when each was last used, and the table of their rendered rows
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS templates (
+    template BLOB PRIMARY KEY,
+    used REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS renders (
+    template BLOB NOT NULL,
+    row TEXT NOT NULL,
+    value TEXT NOT NULL,
+    PRIMARY KEY (template, row)
+) WITHOUT ROWID;
+"""
+
+
+# Returns the qualified name of a function, or an empty string if there is none
+def function_name(function):
+    return f"{function.__module__}.{function.__qualname__}" if function else ""
+
+
+# Returns the key a row is cached under: its one value, or the tuple of its values when a template references several columns
+def row_key(values):
+    return values[0] if len(values) == 1 else tuple(values)
+
+
+# Returns the text a row's key is stored under on disk
+def row_text(key):
+    return SEPARATOR.join(map(str, key)) if isinstance(key, tuple) else str(key)
+
+
+# Defines a cache of rendered template sections, so rows a campaign already rendered aren't rendered again
+class RenderCache:
+    """
+    Keys each rendered section (a subject, a body or one LinkedIn line) by the template text and the raw
+    values of the columns it references, so editing one section or one row only re-renders what changed,
+    and rows that hit skip title-casing and cleaning as well. Keeps up to memory_limit characters in
+    memory and, if path is given, up to disk_limit entries in SQLite so later processes start warm
+
+    Each template has its own table in memory keyed by the row's values, so a lookup is one dictionary
+    probe; the first time a process uses a template, everything on disk for it is loaded in one query.
+    When memory is full, entries of the least recently used template go first, oldest first; when the
+    disk is full, the least recently used templates are dropped from it whole
+    """
+    # Initializes an empty cache, opening the on-disk cache if a path is given
+    def __init__(self, path=None, memory_limit=MEMORY_LIMIT, disk_limit=DISK_LIMIT):
+        # Stores each template's rendered text by row values, least recently used template first
+        self.sections = OrderedDict()
+        # Stores the most characters of rendered text kept in memory, and how many are kept now
+        self.memory_limit = memory_limit
+        self.size = 0
+        # Stores the most entries kept on disk
+        self.disk_limit = disk_limit
+        # Guards the sections and the database connection
+        self.lock = threading.Lock()
+        # Opens the on-disk cache, shared between threads under the lock
+        self.db = None
+        if path is not None:
+            self.db = sqlite3.connect(path, timeout=30, isolation_level=None, check_same_thread=False)
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.executescript(SCHEMA)
+
+    # Closes the on-disk cache
+    def close(self):
+        if self.db is not None:
+            self.db.close()
+
+    # Returns the text that identifies a template and the steps applied before and after rendering it
+    @staticmethod
+    def _prefix(template, prepare=None, finish=None):
+        return SEPARATOR.join((template.text, function_name(prepare), function_name(finish)))
+
+    # Returns the on-disk key of a template
+    @staticmethod
+    def _digest(prefix):
+        return hashlib.blake2b(prefix.encode(), digest_size=16).digest()
+
+    # Returns a template's table, loading it from disk the first time, and marks the template as the most recently used
+    def _section(self, prefix):
+        section = self.sections.get(prefix)
+        if section is None:
+            section = self.sections[prefix] = OrderedDict()
+            if self.db is not None:
+                digest = self._digest(prefix)
+                self._remember(section, {row_key(row.split(SEPARATOR)): value for row, value in
+                                         self.db.execute("SELECT row, value FROM renders WHERE template = ?", (digest,))})
+                # Marks the template as used, so the disk keeps what campaigns still render
+                self.db.execute("INSERT OR REPLACE INTO templates (template, used) VALUES (?, ?)", (digest, time.time()))
+        self.sections.move_to_end(prefix)
+        return section
+
+    # Adds rendered text to a template's table, evicting the oldest entries of the least recently used templates once memory is full
+    def _remember(self, section, rendered):
+        self.size += sum(len(value) for key, value in rendered.items() if key not in section)
+        section.update(rendered)
+        while self.size > self.memory_limit:
+            prefix, oldest = next(iter(self.sections.items()))
+            if oldest:
+                self.size -= len(oldest.popitem(last=False)[1])
+            elif oldest is section:
+                break
+            else:
+                del self.sections[prefix]
+
+    # Looks rows up in a template's table, returning the text for each row or None where it missed
+    def _lookup(self, prefix, keys):
+        with self.lock:
+            return list(map(self._section(prefix).get, keys))
+
+    # Stores newly rendered text for a template in memory and on disk
+    def _store(self, prefix, rendered):
+        with self.lock:
+            self._remember(self._section(prefix), rendered)
+            if self.db is None or not rendered:
+                return
+            digest = self._digest(prefix)
+            self.db.execute("BEGIN IMMEDIATE")
+            try:
+                self.db.execute("INSERT OR REPLACE INTO templates (template, used) VALUES (?, ?)", (digest, time.time()))
+                self.db.executemany("INSERT OR REPLACE INTO renders (template, row, value) VALUES (?, ?, ?)",
+                                    [(digest, row_text(key), value) for key, value in rendered.items()])
+                # Drops the least recently used templates other than this one while the disk holds more than its limit
+                count = self.db.execute("SELECT COUNT(*) FROM renders").fetchone()[0]
+                for (oldest,) in self.db.execute("SELECT template FROM templates WHERE template != ? ORDER BY used", (digest,)).fetchall():
+                    if count <= self.disk_limit:
+                        break
+                    count -= self.db.execute("DELETE FROM renders WHERE template = ?", (oldest,)).rowcount
+                    self.db.execute("DELETE FROM templates WHERE template = ?", (oldest,))
+                self.db.execute("COMMIT")
+            except Exception:
+                self.db.execute("ROLLBACK")
+                raise
+
+    # Renders a template for one contact from a mapping of column name to value, unless it was rendered before
+    def render(self, template, values):
+        if not template.columns:
+            return template.render(values)
+        prefix = self._prefix(template)
+        key = row_key([values[column] for column in template.columns])
+        value = self._lookup(prefix, [key])[0]
+        shared_registry().inc("sales_render_cache_total", outcome="hit" if value is not None else "miss")
+        if value is None:
+            value = template.render(values)
+            self._store(prefix, {key: value})
+        return value
+
+    # Renders a template for every contact like CompiledTemplate.render_series, only rendering rows it hasn't seen
+    def render_series(self, template, columns, index, prepare=None, finish=None):
+        """
+        columns holds the raw values rows are keyed by. prepare is applied to each referenced column of
+        the rows that missed before rendering, such as title-casing, and finish to their rendered text
+        before it is cached, such as the LinkedIn line cleaner, so a hit skips both
+        """
+        # Renders a template without placeholders directly, since it is the same for every row
+        if not template.columns:
+            rendered = template.render_series({}, index)
+            return finish(rendered) if finish else rendered
+        prefix = self._prefix(template, prepare, finish)
+        values = [columns[column].tolist() for column in template.columns]
+        keys = values[0] if len(values) == 1 else list(zip(*values))
+        found = self._lookup(prefix, keys)
+        # Renders only the rows that missed, as whole columns
+        missing = [i for i, value in enumerate(found) if value is None]
+        metrics = shared_registry()
+        metrics.inc("sales_render_cache_total", len(keys) - len(missing), outcome="hit")
+        metrics.inc("sales_render_cache_total", len(missing), outcome="miss")
+        if not missing:
+            return pd.Series(found, index=index)
+        # Takes every row as it is when none of them hit, such as the first time a template is used
+        everything = len(missing) == len(keys)
+        missed = {column: columns[column] if everything else columns[column].iloc[missing] for column in template.columns}
+        if prepare:
+            missed = {column: prepare(series) for column, series in missed.items()}
+        rendered = template.render_series(missed, index if everything else index[missing])
+        if finish:
+            rendered = finish(rendered)
+        if everything:
+            self._store(prefix, dict(zip(keys, rendered.tolist())))
+            return rendered
+        new = {}
+        for i, value in zip(missing, rendered.tolist()):
+            found[i] = new[keys[i]] = value
+        self._store(prefix, new)
+        return pd.Series(found, index=index)
+
+
+# Returns the render cache shared by the whole process for a database path (None keeps it in memory only)
+@lru_cache(maxsize=None)
+def shared_render_cache(path=None):
+    return RenderCache(path)
@@ -1,8 +1,18 @@
 # library to run the app
 from app import app
+# function to start the background workers that send queued campaigns
+from jobs import start_workers
+# function to import the libraries campaigns need in the background, so the first upload doesn't wait on them
+from Sales import warm_up_campaigns
 
 #runs the app
 if __name__ == '__main__':
+    # starts the worker processes before the web server so queued campaigns are picked up right away
+    start_workers(app.config.get('SEND_WORKERS', 2), app.config['JOBS_DATABASE'], transport=app.config.get('SEND_TRANSPORT', 'gmail'),
+                  render_cache=app.config.get('RENDER_CACHE'))
+    # warms up after the workers have started, so no worker is forked while an import is half done (WARM_UP = False in config.py turns it off)
+    if app.config.get('WARM_UP', True):
+        warm_up_campaigns()
     app.run()
 
 
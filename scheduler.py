@@ -0,0 +1,163 @@
+# Library to read and write local times in each recipient's timezone
+from datetime import datetime, time as clock_time, timedelta, timezone
+# Library to cache parsed timezones
+from functools import lru_cache
+# Library to read UTC offsets such as GMT-8 or +05:30
+import re
+# Library to read the current time
+import time
+# Library for the IANA timezone database
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
+# Functions to stream contact files in bounded chunks
+from contacts import read_contacts, read_header
+
+# Defines the day names a send window's days are written with, in the order datetime numbers them
+DAY_NAMES = ["mon", "tue", "wed", "thu", "fri", "sat", "sun"]
+# Matches a UTC offset, with or without a UTC or GMT prefix
+OFFSET = re.compile(r"^(?:utc|gmt)?\s*([+-])(\d{1,2})(?::?(\d{2}))?$", re.IGNORECASE)
+# Defines how many rows of the timezone column are read at a time when a campaign is queued
+PARTITION_CHUNK_SIZE = 10000
+
+
+# Returns the canonical name of a timezone written as an IANA name or a UTC offset, or None if it isn't one
+@lru_cache(maxsize=1024)
+def zone_key(value):
+    value = str(value).strip()
+    if value.upper() in ("UTC", "GMT", "Z"):
+        return "UTC"
+    match = OFFSET.match(value)
+    if match:
+        sign, hours, minutes = match.groups()
+        offset = timedelta(hours=int(hours), minutes=int(minutes or 0))
+        if offset >= timedelta(hours=24):
+            return None
+        return str(timezone(-offset if sign == "-" else offset))
+    try:
+        return ZoneInfo(value).key if value else None
+    except (ZoneInfoNotFoundError, ValueError):
+        return None
+
+
+# Returns the tzinfo for a canonical timezone name returned by zone_key
+@lru_cache(maxsize=1024)
+def zone_info(key):
+    if key == "UTC":
+        return timezone.utc
+    match = OFFSET.match(key)
+    if match:
+        sign, hours, minutes = match.groups()
+        offset = timedelta(hours=int(hours), minutes=int(minutes or 0))
+        return timezone(-offset if sign == "-" else offset)
+    return ZoneInfo(key)
+
+
+# Reads a list of days such as "Mon-Fri" or "Mon,Wed,Fri" into datetime weekday numbers
+def parse_days(days):
+    numbers = set()
+    for part in days.lower().replace(" ", "").split(","):
+        first, _, last = part.partition("-")
+        if first[:3] not in DAY_NAMES or (last and last[:3] not in DAY_NAMES):
+            raise ValueError(f"Unknown day in {days!r}; expected names like Mon-Fri or Mon,Wed,Fri")
+        first = DAY_NAMES.index(first[:3])
+        last = DAY_NAMES.index(last[:3]) if last else first
+        # Counts forward from the first day, so a range like Sun-Thu wraps around the week
+        numbers.update((first + i) % 7 for i in range((last - first) % 7 + 1))
+    return frozenset(numbers)
+
+
+# Defines the business-hour window a campaign's emails are sent in, in each recipient's own timezone
+class Schedule:
+    """
+    Sends only between start and end on the given days. Each recipient's local time is read from the
+    column of their row, when there is one and it holds an IANA name or UTC offset, and is the default
+    timezone otherwise
+    """
+    # Initializes the window from times like "09:00", days like "Mon-Fri", a default timezone and an optional column
+    def __init__(self, start="09:00", end="17:00", days="Mon-Fri", timezone="UTC", column=None):
+        # Stores the settings as given, so the schedule can be saved with the job
+        self.settings = {"start": start, "end": end, "days": days, "timezone": timezone, "column": column}
+        # Stores the local times the window opens and closes
+        self.start = clock_time.fromisoformat(start)
+        self.end = clock_time.fromisoformat(end)
+        if self.start >= self.end:
+            raise ValueError(f"The send window must open before it closes, not {start}-{end}")
+        # Stores the weekdays the window is open on
+        self.days = parse_days(days)
+        # Stores the timezone of recipients whose row doesn't name one
+        self.default = zone_key(timezone)
+        if self.default is None:
+            raise ValueError(f"Unknown timezone {timezone!r}")
+        # Stores the column recipients' timezones are read from, if any
+        self.column = column
+
+    # Builds the schedule from the app's configuration, or returns None if no send window is configured
+    @classmethod
+    def from_config(cls, config):
+        window = config.get("SEND_WINDOW")
+        if not window:
+            return None
+        start, _, end = window.partition("-")
+        return cls(start.strip(), end.strip(), config.get("SEND_DAYS", "Mon-Fri"), config.get("SEND_TIMEZONE", "UTC"),
+                   config.get("SEND_TIMEZONE_COLUMN"))
+
+    # Returns the settings the schedule was built from
+    def to_dict(self):
+        return dict(self.settings)
+
+    # Returns the timezone of each value in a column, falling back to the default timezone
+    def zone_keys(self, values):
+        # Parses each distinct value once, since a contact list repeats a handful of timezones
+        keys = {value: zone_key(value) or self.default for value in values.unique()}
+        return values.map(keys)
+
+    # Returns the times the current window opens and closes in a timezone, or those of the next window if none is open
+    def window(self, zone=None, now=None):
+        now = time.time() if now is None else now
+        tz = zone_info(zone or self.default)
+        today = datetime.fromtimestamp(now, tz).date()
+        # Looks at most a week ahead, which always reaches a day the window is open on
+        for ahead in range(8):
+            day = today + timedelta(days=ahead)
+            if day.weekday() not in self.days:
+                continue
+            closes = datetime.combine(day, self.end, tz).timestamp()
+            if now < closes:
+                return datetime.combine(day, self.start, tz).timestamp(), closes
+
+    # Returns the earliest time at or after now when emails may be sent in a timezone
+    def next_open(self, zone=None, now=None):
+        now = time.time() if now is None else now
+        return max(now, self.window(zone, now)[0])
+
+    # Returns the time the open window closes in a timezone, or now if the window is closed
+    def closes(self, zone=None, now=None):
+        now = time.time() if now is None else now
+        opens, closes = self.window(zone, now)
+        return closes if opens <= now else now
+
+    # Splits a contact file into ranges of rows of at most size recipients who share a timezone
+    def partition(self, path, size):
+        """
+        Yields (start, stop, zone, count) for each range, where zone is None when the file has no timezone
+        column and every row is in the default timezone. Each range covers count rows of its zone and may
+        span rows of other zones, which the task for that range leaves to the tasks of their own zone
+        """
+        if self.column is None or self.column not in read_header(path):
+            rows = sum(len(chunk) for chunk in read_contacts(path, columns=[0], chunksize=PARTITION_CHUNK_SIZE))
+            for start in range(0, rows, size):
+                yield start, min(start + size, rows), None, min(size, rows - start)
+            return
+        # Keeps the first row, last row and row count of the range each timezone is filling
+        open_ranges = {}
+        row = 0
+        for chunk in read_contacts(path, columns=[self.column], chunksize=PARTITION_CHUNK_SIZE):
+            for zone in self.zone_keys(chunk[self.column]):
+                first, _, count = open_ranges.get(zone, (row, row, 0))
+                if count + 1 == size:
+                    yield first, row + 1, zone, size
+                    open_ranges.pop(zone, None)
+                else:
+                    open_ranges[zone] = (first, row, count + 1)
+                row += 1
+        for zone, (first, last, count) in open_ranges.items():
+            yield first, last + 1, zone, count
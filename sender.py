@@ -0,0 +1,407 @@
+# Library to run sends on a bounded pool of worker threads
+from concurrent.futures import ThreadPoolExecutor
+# Library to spread retries out so workers that failed together don't retry together
+import random
+# Library to share one rate limiter between worker processes sending as the same account
+import sqlite3
+# Library to guard the rate limiter's shared state
+import threading
+# Library to measure time and add delays to the code execution
+import time
+# Library to build the tuple of network errors once
+from functools import lru_cache
+# Function that defers Google's client libraries until a send needs them
+from lazy import lazy_import
+# Library for the network errors Google's client raises, such as a server that can't be found
+httplib2 = lazy_import("httplib2")
+# Library to handle errors from Google's API
+errors = lazy_import("googleapiclient.errors")
+# Class that lends each worker its own Gmail service
+from gmail_client import ServicePool
+# Registry that records send latency, retries and errors
+from metrics import shared_registry
+
+# Gmail allows 250 quota units per user per second (https://developers.google.com/gmail/api/reference/quota)
+GMAIL_QUOTA_UNITS_PER_SECOND = 250
+# Sending a single message with messages.send costs 100 quota units
+SEND_QUOTA_COST = 100
+# Error reasons Gmail uses to signal that the per-user quota has been exhausted
+RATE_LIMIT_REASONS = (b"rateLimitExceeded", b"userRateLimitExceeded")
+# Defines the kinds of send errors: the API asking us to slow down, a failure worth retrying, and one that will fail again
+RATE_LIMITED = "rate_limit"
+TRANSIENT = "transient"
+PERMANENT = "permanent"
+# Defines the kinds of failed sends worth replaying later
+RETRYABLE = (RATE_LIMITED, TRANSIENT)
+# Defines the table a SharedTokenBucket keeps each account's bucket in
+RATE_LIMIT_SCHEMA = """
+CREATE TABLE IF NOT EXISTS rate_limits (
+    account TEXT PRIMARY KEY,
+    tokens REAL NOT NULL,
+    rate REAL NOT NULL,
+    updated REAL NOT NULL,
+    paused_until REAL NOT NULL DEFAULT 0
+);
+"""
+
+
+# Returns the network errors a send is retried after, such as a socket timeout or a dropped connection
+@lru_cache(maxsize=None)
+def network_errors():
+    return (OSError, httplib2.HttpLib2Error)
+
+
+# Checks whether an HttpError was caused by hitting the Gmail rate limit
+def is_rate_limit_error(error):
+    # Reads the HTTP status code from the error response
+    status = getattr(error.resp, "status", None)
+    # A 429 status is always a rate limit error
+    if status == 429:
+        return True
+    # Gmail also reports rate limits as a 403 with a rateLimitExceeded reason
+    content = error.content or b""
+    return status == 403 and any(reason in content for reason in RATE_LIMIT_REASONS)
+
+
+# Sorts a send error into a rate limit, a transient failure worth retrying, or a permanent one such as a bad address
+def error_kind(error):
+    if isinstance(error, errors.HttpError):
+        if is_rate_limit_error(error):
+            return RATE_LIMITED
+        # Retries server errors, and fails fast on any other 4xx since sending again won't change the answer
+        status = getattr(error.resp, "status", None)
+        return TRANSIENT if status is None or int(status) >= 500 else PERMANENT
+    # Retries an SMTP server's temporary (4xx) refusals, and fails fast on its permanent (5xx) ones
+    code = getattr(error, "code", None)
+    if isinstance(code, int):
+        return TRANSIENT if code < 500 else PERMANENT
+    return TRANSIENT if isinstance(error, network_errors()) else PERMANENT
+
+
+# Returns the label a failed send is counted under: its HTTP status, or the name of its error
+def error_label(error):
+    status = getattr(getattr(error, "resp", None), "status", None)
+    return str(status) if status is not None else type(error).__name__
+
+
+# Returns how long to wait before retry number attempt: an exponential backoff capped at cap, with half of it random
+def backoff_delay(attempt, base=1.0, cap=32.0):
+    delay = min(cap, base * 2 ** attempt)
+    return delay / 2 + random.uniform(0, delay / 2)
+
+
+# Reads the number of seconds the API asked us to wait, if it sent a Retry-After header
+def retry_after(error):
+    # Looks up the header on the error response (httplib2 lowercases header names)
+    resp = getattr(error, "resp", None)
+    value = resp.get("retry-after") if hasattr(resp, "get") else None
+    # Returns the delay as a float, or None if the header is missing or not a number
+    try:
+        return float(value) if value is not None else None
+    except ValueError:
+        return None
+
+
+# Defines a token-bucket rate limiter that adapts its refill rate to rate limit errors
+class TokenBucket:
+    """
+    Hands out quota units at a steady rate, slowing down when the API pushes back and speeding back up when it stops.
+    The bucket never holds more than one second of the quota, so a burst after an idle spell stays within it
+    """
+    # Initializes the bucket with a refill rate (units per second) and a burst capacity of at most that rate
+    def __init__(self, rate=GMAIL_QUOTA_UNITS_PER_SECOND, capacity=None, min_rate=None, clock=time.monotonic, sleep=time.sleep):
+        # Stores the fastest rate the bucket is allowed to refill at
+        self.max_rate = rate
+        # Stores the current refill rate, which is lowered on rate limit errors
+        self.rate = rate
+        # Stores the slowest rate the bucket will back off to
+        self.min_rate = min_rate or rate / 50
+        # Stores the most units the bucket can hold, which bounds the size of a burst, capped at the quota
+        self.capacity = min(capacity or rate, rate)
+        # Starts with a full bucket so the first sends go out immediately
+        self.tokens = self.capacity
+        # Stores the clock and sleep functions so tests can run on a fake clock
+        self.clock = clock
+        self.sleep = sleep
+        # Stores the time the bucket was last refilled
+        self.updated = clock()
+        # Stores the time before which nobody may send because the API asked us to wait
+        self.paused_until = 0.0
+        # Guards the bucket so several worker threads can share it
+        self.lock = threading.Lock()
+
+    # Adds the units that have accumulated since the last refill
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    # Runs change on the bucket's state while holding the lock and returns what it returned
+    def _transaction(self, change):
+        with self.lock:
+            return change()
+
+    # Takes units if they are available, or else returns how long to wait, either for a pause to end or for enough units to build up
+    def _take(self, units):
+        now = self.clock()
+        self._refill(now)
+        if now < self.paused_until:
+            return self.paused_until - now
+        if self.tokens >= units:
+            self.tokens -= units
+            return None
+        return (units - self.tokens) / self.rate
+
+    # Blocks until the requested number of units is available, then takes them
+    def acquire(self, units=SEND_QUOTA_COST):
+        while (wait := self._transaction(lambda: self._take(units))) is not None:
+            # Sleeps outside the lock so other threads can keep refilling and checking
+            self.sleep(wait)
+
+    # Halves the refill rate and empties the bucket after a rate limit error
+    def slow_down(self, delay=None):
+        def change():
+            now = self.clock()
+            self._refill(now)
+            self.rate = max(self.min_rate, self.rate / 2)
+            self.tokens = 0.0
+            # Honors the server's Retry-After delay if it sent one
+            if delay:
+                self.paused_until = max(self.paused_until, now + delay)
+        self._transaction(change)
+
+    # Raises the refill rate a little after a successful send, up to the configured maximum
+    def speed_up(self):
+        def change():
+            self.rate = min(self.max_rate, self.rate + self.max_rate / 20)
+        self._transaction(change)
+
+
+# Defines a token bucket kept in SQLite, so every worker process sending as the same account draws from one quota
+class SharedTokenBucket(TokenBucket):
+    """
+    Keeps each account's tokens, refill rate and pause in a row of the database at path, and reads and
+    writes them in one BEGIN IMMEDIATE transaction per call, so processes sending as the same account
+    take turns on its quota, and a rate limit error one of them hits slows them all down. Uses the wall
+    clock, since it is the one clock every process agrees on
+    """
+    # Initializes the bucket and creates its table if it doesn't exist yet; the row starts full the first time the account is seen
+    def __init__(self, path, account, rate=GMAIL_QUOTA_UNITS_PER_SECOND, capacity=None, min_rate=None, clock=time.time, sleep=time.sleep):
+        super().__init__(rate, capacity, min_rate, clock, sleep)
+        self.account = account
+        # Shares one connection between the sender's threads, which the lock already takes turns on
+        self.db = sqlite3.connect(path, timeout=30, isolation_level=None, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.executescript(RATE_LIMIT_SCHEMA)
+
+    # Loads the account's row, runs change on it and writes it back, without another process changing it in between
+    def _transaction(self, change):
+        with self.lock:
+            self.db.execute("BEGIN IMMEDIATE")
+            try:
+                row = self.db.execute("SELECT tokens, rate, updated, paused_until FROM rate_limits WHERE account = ?", (self.account,)).fetchone()
+                if row is not None:
+                    self.tokens, self.rate, self.updated, self.paused_until = row
+                result = change()
+                self.db.execute("INSERT OR REPLACE INTO rate_limits (account, tokens, rate, updated, paused_until) VALUES (?, ?, ?, ?, ?)",
+                                (self.account, self.tokens, self.rate, self.updated, self.paused_until))
+                self.db.execute("COMMIT")
+            except BaseException:
+                self.db.execute("ROLLBACK")
+                raise
+            return result
+
+    # Closes the database connection
+    def close(self):
+        self.db.close()
+
+
+# Defines a circuit breaker that holds every worker while the API keeps failing
+class CircuitBreaker:
+    """
+    Opens after threshold transient failures in a row and holds every send for cooldown seconds, so a
+    degraded API isn't hammered by the whole pool. Then lets a single send through to probe it: if it
+    succeeds the breaker closes, and if it fails the breaker opens again for twice as long, up to max_cooldown
+    """
+    # Initializes a closed breaker
+    def __init__(self, threshold=5, cooldown=5.0, max_cooldown=300.0, clock=time.monotonic, sleep=time.sleep):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        # Stores the clock and sleep functions so tests can run on a fake clock
+        self.clock = clock
+        self.sleep = sleep
+        # Stores the transient failures in a row, how long the breaker opens for next, and when it may be probed
+        self.failures = 0
+        self.open_for = cooldown
+        self.opened_until = 0.0
+        # Stores whether a send is probing the API right now
+        self.probing = False
+        # Guards the breaker so several worker threads can share it
+        self.lock = threading.Lock()
+        # Stores the registry that counts how often the breaker opens
+        self.metrics = shared_registry()
+
+    # Returns whether the breaker is closed, open or letting a probe through
+    @property
+    def state(self):
+        with self.lock:
+            if self.failures < self.threshold:
+                return "closed"
+            return "half_open" if self.probing or self.clock() >= self.opened_until else "open"
+
+    # Blocks while the breaker is open, and while another send is probing the API
+    def wait(self):
+        while True:
+            with self.lock:
+                if self.failures < self.threshold:
+                    return
+                now = self.clock()
+                # Lets the first send after the cooldown through as the probe
+                if now >= self.opened_until and not self.probing:
+                    self.probing = True
+                    return
+                wait = max(self.opened_until - now, 0.1)
+            # Sleeps outside the lock so the probe can report back
+            self.sleep(wait)
+
+    # Closes the breaker after the API answered, even with an error that isn't its fault
+    def success(self):
+        with self.lock:
+            self.failures = 0
+            self.open_for = self.cooldown
+            self.probing = False
+
+    # Counts a transient failure, opening the breaker on the threshold-th in a row or when the probe fails
+    def failure(self):
+        with self.lock:
+            self.failures += 1
+            if not self.probing and self.failures != self.threshold:
+                return
+            # Doubles the cooldown each time a probe finds the API still failing
+            if self.probing:
+                self.open_for = min(self.max_cooldown, self.open_for * 2)
+            self.probing = False
+            self.opened_until = self.clock() + self.open_for
+        self.metrics.inc("sales_circuit_opens_total")
+
+    # Frees the probe for the next send when this one ended without hearing back from the API, such as a failed token refresh
+    def release(self):
+        with self.lock:
+            self.probing = False
+
+
+# Defines the engine that sends Gmail messages on a bounded worker pool under a shared rate limiter
+class GmailSender:
+    """
+    Sends encoded messages concurrently while keeping the account under its Gmail quota. Retries rate
+    limit errors, server errors and network errors with exponential backoff and jitter, fails fast on other
+    4xx errors such as a bad address, and holds every worker while the circuit breaker is open
+    """
+    # Initializes the sender with a pool of Gmail services (or a function that builds them) and the size of the worker pool
+    def __init__(self, service_factory, workers=4, limiter=None, max_retries=5, breaker=None, sleep=time.sleep):
+        # Stores the pool that lends each worker thread its own Gmail service, since Google's client is not thread-safe
+        self.pool = service_factory if isinstance(service_factory, ServicePool) else ServicePool(service_factory, workers)
+        # Stores the number of messages that may be in flight at once
+        self.workers = workers
+        # Stores the rate limiter shared by every worker
+        self.limiter = limiter or TokenBucket()
+        # Stores how many times a message is retried before giving up
+        self.max_retries = max_retries
+        # Stores the circuit breaker shared by every worker
+        self.breaker = breaker or CircuitBreaker()
+        # Stores the function that waits before a transient failure is retried, so tests can skip the wait
+        self.sleep = sleep
+        # Stores the registry that records each send
+        self.metrics = shared_registry()
+
+    # Sends one encoded message, retrying with backoff after rate limit, server and network errors
+    def send_one(self, message):
+        for attempt in range(self.max_retries + 1):
+            # Waits while the circuit breaker is open, then for enough quota to send the message
+            self.breaker.wait()
+            try:
+                with self.metrics.time("sales_rate_limit_wait_seconds", transport="gmail"):
+                    self.limiter.acquire(SEND_QUOTA_COST)
+                # Sends the message using a Gmail service borrowed from the pool
+                with self.pool.client() as service, self.metrics.time("sales_send_seconds", transport="gmail"):
+                    response = service.users().messages().send(userId="me", body=message).execute()
+            except (errors.HttpError, *network_errors()) as error:
+                kind = error_kind(error)
+                # Counts only failures that suggest the API is degraded towards opening the breaker
+                if kind == TRANSIENT:
+                    self.breaker.failure()
+                else:
+                    self.breaker.success()
+                # Lets a permanent error, or the last retry, reach the caller
+                if kind == PERMANENT or attempt == self.max_retries:
+                    self.metrics.inc("sales_send_errors_total", transport="gmail", error=error_label(error))
+                    raise
+                self.metrics.inc("sales_send_retries_total", transport="gmail", reason=kind)
+                delay = retry_after(error) or backoff_delay(attempt)
+                if kind == RATE_LIMITED:
+                    # Slows the shared limiter down and pauses every worker
+                    self.limiter.slow_down(delay)
+                else:
+                    # Waits before retrying just this message
+                    self.sleep(delay)
+                continue
+            except BaseException:
+                # Lets another send probe the API if this one was the probe, so the other workers don't wait forever
+                self.breaker.release()
+                raise
+            self.breaker.success()
+            # Lets the limiter creep back up to full speed once sends succeed again
+            self.limiter.speed_up()
+            return response
+
+    # Sends one encoded message, handing back the error instead of raising it
+    def _send_or_error(self, message):
+        try:
+            return self.send_one(message)
+        except (errors.HttpError, *network_errors()) as error:
+            return error
+
+    # Sends every message, yielding each API response in the same order as the messages
+    # If return_errors is True, a failed message's error is yielded in its place instead of being raised
+    def send_each(self, messages, return_errors=False):
+        """
+        With return_errors, an error that isn't a failed send, such as a failed token refresh, stops new
+        messages from being sent; it is yielded in its message's place, every send already in flight is
+        still yielded so the caller can record it, and then the error is raised
+        """
+        # Picks the function each worker runs for a message
+        send = self._send_or_error if return_errors else self.send_one
+        # Caps the number of queued messages so a long generator is not read into memory all at once
+        window = self.workers * 2
+        pending = []
+        unexpected = []
+        # Returns a send's response, or with return_errors its error, remembering an unexpected one to raise later
+        def collect(future):
+            try:
+                return future.result()
+            except Exception as error:
+                if not return_errors:
+                    raise
+                unexpected.append(error)
+                return error
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            for message in messages:
+                if unexpected:
+                    break
+                pending.append(pool.submit(send, message))
+                # Waits for the oldest send once the window is full
+                if len(pending) >= window:
+                    yield collect(pending.pop(0))
+            # Collects the sends that are still running
+            for future in pending:
+                yield collect(future)
+        if unexpected:
+            raise unexpected[0]
+
+    # Sends every message and returns the API responses in the same order
+    def send_all(self, messages, return_errors=False):
+        return list(self.send_each(messages, return_errors))
+
+    # Does nothing, since the pooled Gmail clients are shared with the rest of the process
+    def close(self):
+        pass
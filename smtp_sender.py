@@ -0,0 +1,221 @@
+# Library to run the SMTP connections on an event loop
+import asyncio
+# Library to decode the messages Sales encodes for the Gmail API
+import base64
+# Library to run the event loop alongside the caller's threads
+import threading
+# Library to read the sender and recipient back out of an encoded message
+from email.parser import BytesHeaderParser
+# Library to time each send
+import time
+# Registry that records send latency, retries and errors
+from metrics import shared_registry
+# Function that spaces retries out with jitter
+from sender import backoff_delay
+# Function that defers aiosmtplib until an SMTP sender connects
+from lazy import lazy_import
+# Library that speaks SMTP on asyncio; only needed for the SMTP transport
+try:
+    aiosmtplib = lazy_import("aiosmtplib")
+except ImportError:
+    aiosmtplib = None
+
+# Defines Gmail's SMTP server, which accepts the same OAuth credentials as the Gmail API
+SMTP_HOST = "smtp.gmail.com"
+# Defines the submission port, which upgrades to TLS with STARTTLS
+SMTP_PORT = 587
+
+
+# Returns the sender and recipient addresses of an encoded message, for the SMTP envelope
+def envelope(content):
+    headers = BytesHeaderParser().parsebytes(content)
+    return headers["From"], [headers["To"]]
+
+
+# Defines the engine that sends messages over a few persistent SMTP connections
+class SmtpSender:
+    """
+    Accepts the same {"raw": ...} messages as GmailSender and sends them over up to connections
+    authenticated SMTP connections, each reused for message after message, from an event loop on a
+    background thread. Logs in with XOAUTH2 when given a CredentialManager, or with a password.
+    """
+    # Initializes the sender with the server to send through, how to log in and how many connections to open
+    def __init__(self, host=SMTP_HOST, port=SMTP_PORT, username=None, password=None, credentials=None, connections=4,
+                 use_tls=False, start_tls=None, timeout=30, max_retries=3):
+        if aiosmtplib is None:
+            raise ImportError("The SMTP transport needs aiosmtplib: pip install aiosmtplib")
+        # Stores the server and how to reach it
+        self.host = host
+        self.port = port
+        self.use_tls = use_tls
+        self.start_tls = start_tls
+        self.timeout = timeout
+        # Stores the account to log in as, and either its password or the manager that keeps its OAuth token fresh
+        self.username = username
+        self.password = password
+        self.credentials = credentials
+        # Stores the most connections to open, which is also the most messages in flight at once
+        self.connections = connections
+        # Stores how many times a message is retried after a dropped connection or a temporary (4xx) refusal
+        self.max_retries = max_retries
+        # Stores connections that aren't sending right now, and the slots that bound how many are open or being
+        # opened; both are created on the event loop the first time they are needed
+        self.idle = None
+        self.slots = None
+        # Counts the connections currently open
+        self.opened = 0
+        # Stores the registry that records each send
+        self.metrics = shared_registry()
+        # Starts the event loop the connections live on
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.thread.start()
+
+    # Opens and logs in one connection
+    async def _connect(self):
+        smtp = aiosmtplib.SMTP(hostname=self.host, port=self.port, use_tls=self.use_tls, start_tls=self.start_tls, timeout=self.timeout)
+        await smtp.connect()
+        try:
+            if self.credentials is not None:
+                # Reads the access token on a worker thread, since refreshing it is a blocking HTTP call
+                creds = await self.loop.run_in_executor(None, self.credentials.credentials)
+                await smtp.auth_xoauth2(self.username, creds.token)
+            elif self.password is not None:
+                await smtp.login(self.username, self.password)
+        except BaseException:
+            smtp.close()
+            raise
+        return smtp
+
+    # Borrows an idle connection, or opens a new one if none is idle, once one of the connections' slots is free
+    async def _borrow(self):
+        """
+        A borrower holds its slot until it returns or drops the connection, so a connect that fails frees
+        the slot for the next borrower to try, and that borrower gets the error back instead of waiting forever
+        """
+        if self.idle is None:
+            self.idle = asyncio.Queue()
+            self.slots = asyncio.Semaphore(self.connections)
+        await self.slots.acquire()
+        if not self.idle.empty():
+            return self.idle.get_nowait()
+        try:
+            smtp = await self._connect()
+        except BaseException:
+            self.slots.release()
+            raise
+        self.opened += 1
+        return smtp
+
+    # Hands a borrowed connection back for the next message
+    def _return(self, smtp):
+        self.idle.put_nowait(smtp)
+        self.slots.release()
+
+    # Closes and forgets a connection the server dropped or that was left in an unknown state, so the next borrower opens a new one in its slot
+    def _drop(self, smtp):
+        smtp.close()
+        self.opened -= 1
+        self.slots.release()
+
+    # Sends one message on a borrowed connection, retrying on a fresh connection if the server hung up
+    async def _send(self, message):
+        content = base64.urlsafe_b64decode(message["raw"])
+        sender, recipients = envelope(content)
+        for attempt in range(self.max_retries + 1):
+            smtp = await self._borrow()
+            start = time.perf_counter()
+            try:
+                errors, response = await smtp.sendmail(sender, recipients, content)
+            except aiosmtplib.SMTPServerDisconnected:
+                # Forgets the dropped connection so the next borrow opens a new one
+                self._drop(smtp)
+                if attempt == self.max_retries:
+                    self.metrics.inc("sales_send_errors_total", transport="smtp", error="disconnected")
+                    raise
+                self.metrics.inc("sales_send_retries_total", transport="smtp", reason="disconnected")
+                continue
+            except aiosmtplib.SMTPResponseException as error:
+                self._return(smtp)
+                # Waits and retries when the server refuses for now, such as Gmail's 421 "try again later"
+                if error.code >= 500 or attempt == self.max_retries:
+                    self.metrics.inc("sales_send_errors_total", transport="smtp", error=str(error.code))
+                    raise
+                self.metrics.inc("sales_send_retries_total", transport="smtp", reason=str(error.code))
+                await asyncio.sleep(backoff_delay(attempt))
+                continue
+            except BaseException as error:
+                # Closes the connection, since a timeout, cancellation or socket error may have left it partway through a message
+                self._drop(smtp)
+                self.metrics.inc("sales_send_errors_total", transport="smtp", error=type(error).__name__)
+                raise
+            self.metrics.observe("sales_send_seconds", time.perf_counter() - start, transport="smtp")
+            self._return(smtp)
+            # Uses the server's reply, which names the queued message, as the message ID
+            return {"id": response, "labelIds": ["SENT"]}
+
+    # Sends one message, handing back the error instead of raising it
+    async def _send_or_error(self, message):
+        try:
+            return await self._send(message)
+        except (aiosmtplib.SMTPException, OSError, asyncio.TimeoutError) as error:
+            return error
+
+    # Sends one encoded message and returns its response
+    def send_one(self, message):
+        return asyncio.run_coroutine_threadsafe(self._send(message), self.loop).result()
+
+    # Sends every message, yielding each response in the same order as the messages
+    # If return_errors is True, a failed message's error is yielded in its place instead of being raised
+    def send_each(self, messages, return_errors=False):
+        """
+        With return_errors, an error that isn't a failed send stops new messages from being sent; it is
+        yielded in its message's place, every send already in flight is still yielded, and then it is raised
+        """
+        send = self._send_or_error if return_errors else self._send
+        # Keeps every connection busy while bounding how many messages are queued at once
+        window = self.connections * 2
+        pending = []
+        unexpected = []
+        # Returns a send's response, or with return_errors its error, remembering an unexpected one to raise later
+        def collect(future):
+            try:
+                return future.result()
+            except Exception as error:
+                if not return_errors:
+                    raise
+                unexpected.append(error)
+                return error
+        for message in messages:
+            if unexpected:
+                break
+            pending.append(asyncio.run_coroutine_threadsafe(send(message), self.loop))
+            # Waits for the oldest send once the window is full
+            if len(pending) >= window:
+                yield collect(pending.pop(0))
+        # Collects the sends that are still running
+        for future in pending:
+            yield collect(future)
+        if unexpected:
+            raise unexpected[0]
+
+    # Sends every message and returns the responses in the same order
+    def send_all(self, messages, return_errors=False):
+        return list(self.send_each(messages, return_errors))
+
+    # Closes every idle connection and stops the event loop
+    async def _quit(self):
+        while self.idle is not None and not self.idle.empty():
+            smtp = self.idle.get_nowait()
+            try:
+                await smtp.quit()
+            except (aiosmtplib.SMTPException, OSError):
+                smtp.close()
+        self.opened = 0
+
+    # Logs out of the server and stops the background thread
+    def close(self):
+        asyncio.run_coroutine_threadsafe(self._quit(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
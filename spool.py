@@ -0,0 +1,97 @@
+# Library for encoding binary data into a URL-safe format
+import base64
+# Library to find body lines that mbox format needs escaped
+import re
+# Library to date each message in the mbox file
+import time
+# Library for interacting with the file system
+import os
+# Library to hand messages to a local SMTP sink
+import smtplib
+# Function to read the sender and recipient back out of an encoded message
+from smtp_sender import envelope
+# Library to split an smtp:// spool target into host and port
+from urllib.parse import urlsplit
+
+# Matches lines starting with "From ", which would otherwise be read as the start of a new message in an mbox file
+FROM_LINE = re.compile(rb"^From ", re.MULTILINE)
+
+
+# Defines a stand-in for GmailSender that writes each message to a local spool instead of sending it
+class SpoolSender:
+    """
+    Accepts the same {"raw": ...} messages as GmailSender and writes them, without any rate limit, to
+    an mbox file (a target ending in .mbox), an SMTP sink (smtp://host:port, for example
+    `python -m aiosmtpd -n -l localhost:8025`) or a folder of .eml files (any other target)
+    """
+    # Initializes the spool with where messages should be written
+    def __init__(self, target):
+        # Stores where messages are written
+        self.target = target
+        # Counts the messages written, which also numbers their IDs
+        self.written = 0
+        # Creates the folder for .eml files if that is the kind of spool this is
+        if not self._is_smtp() and not self._is_mbox():
+            os.makedirs(target, exist_ok=True)
+
+    # Checks whether the spool is an SMTP sink
+    def _is_smtp(self):
+        return self.target.startswith("smtp://")
+
+    # Checks whether the spool is an mbox file
+    def _is_mbox(self):
+        return self.target.lower().endswith(".mbox")
+
+    # Writes each message in order and yields a response shaped like the Gmail API's for each one
+    def send_each(self, messages, return_errors=False):
+        """
+        Writes the whole list before yielding, since a local spool is fast enough that nothing is gained by overlapping
+        """
+        contents = [base64.urlsafe_b64decode(message["raw"]) for message in messages]
+        try:
+            ids = self._write(contents)
+        except (OSError, smtplib.SMTPException) as error:
+            if not return_errors:
+                raise
+            ids = [error] * len(contents)
+        yield from ({"id": message_id, "labelIds": ["SENT"]} if isinstance(message_id, str) else message_id for message_id in ids)
+
+    # Writes every message and returns the list of responses
+    def send_all(self, messages, return_errors=False):
+        return list(self.send_each(messages, return_errors))
+
+    # Writes one message and returns its response
+    def send_one(self, message):
+        return self.send_all([message])[0]
+
+    # Does nothing, since every batch is written and closed as soon as it arrives
+    def close(self):
+        pass
+
+    # Writes a list of message contents to the spool and returns an ID for each
+    def _write(self, contents):
+        ids = [f"{self.written + i:016x}" for i in range(len(contents))]
+        if self._is_smtp():
+            self._write_smtp(contents)
+        elif self._is_mbox():
+            self._write_mbox(contents)
+        else:
+            for message_id, content in zip(ids, contents):
+                with open(os.path.join(self.target, f"{message_id}.eml"), "wb") as eml:
+                    eml.write(content)
+        self.written += len(contents)
+        return ids
+
+    # Appends messages to the mbox file, escaping body lines that start with "From " as mbox readers expect
+    def _write_mbox(self, contents):
+        separator = f"From MAILER-DAEMON {time.asctime()}\n".encode()
+        with open(self.target, "ab") as box:
+            for content in contents:
+                box.write(separator + FROM_LINE.sub(b">From ", content).rstrip(b"\n") + b"\n\n")
+
+    # Hands messages to the SMTP sink over one connection
+    def _write_smtp(self, contents):
+        address = urlsplit(self.target)
+        with smtplib.SMTP(address.hostname, address.port or 25) as smtp:
+            for content in contents:
+                smtp.sendmail(*envelope(content), content)
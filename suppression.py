@@ -0,0 +1,205 @@
+"""
+Keeps the persistent list of addresses that must never be contacted, and normalizes the addresses
+and LinkedIn URLs campaigns are deduplicated on
+
+Add to the list from the command line with: python suppression.py add --email someone@example.com --reason bounced
+"""
+# Library to read command line options
+import argparse
+# Library to hash each entry into the Bloom filter
+import hashlib
+# Library to size the Bloom filter for its false positive rate
+import math
+# Library for the persistent suppression list
+import sqlite3
+# Library to timestamp each entry
+import time
+# Function that defers heavy libraries until the first function that needs them runs
+from lazy import lazy_import
+# Library for data manipulation and analysis, imported the first time a contact file is read or rendered
+pd = lazy_import("pandas")
+
+# Defines the default location of the suppression list
+SUPPRESSION_DATABASE = "suppression.sqlite3"
+# Defines the kinds of entry the list holds
+KINDS = ("email", "linkedin")
+# Defines how many values are looked up in one query, below SQLite's limit on bound parameters
+LOOKUP_SIZE = 500
+
+# Defines the table of suppressed emails and LinkedIn URLs
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS suppressed (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    kind TEXT NOT NULL,
+    value TEXT NOT NULL,
+    reason TEXT,
+    created_at REAL NOT NULL,
+    UNIQUE (kind, value)
+);
+CREATE TABLE IF NOT EXISTS bloom (
+    id INTEGER PRIMARY KEY CHECK (id = 0),
+    capacity INTEGER NOT NULL,
+    count INTEGER NOT NULL,
+    loaded INTEGER NOT NULL,
+    bits BLOB NOT NULL
+);
+"""
+
+
+# Normalizes a column of email addresses to lower case without surrounding spaces, blanking anything that isn't an address
+def normalize_email(series):
+    emails = series.fillna("").astype(str).str.strip().str.lower()
+    return emails.where(emails.str.contains("@", regex=False), "")
+
+
+# Normalizes a column of LinkedIn URLs to linkedin.com/in/<name>, dropping the scheme, www, query and trailing slash
+def normalize_linkedin(series):
+    urls = series.fillna("").astype(str).str.strip().str.lower()
+    urls = urls.str.replace(r"^[a-z]+://", "", regex=True).str.replace(r"^www\.", "", regex=True)
+    return urls.str.replace(r"[?#].*$", "", regex=True).str.rstrip("/")
+
+
+# Defines a Bloom filter, which answers "definitely not present" without a database lookup
+class BloomFilter:
+    """
+    Holds up to capacity entries at about error_rate false positives, in a bit array of a few bits per entry
+    """
+    # Initializes a filter sized for capacity entries, empty unless the bits and count of a saved filter are given
+    def __init__(self, capacity, error_rate=0.01, array=None, count=0):
+        # Stores how many entries the filter is sized for
+        self.capacity = max(capacity, 1024)
+        # Works out the number of bits and hashes that give the requested false positive rate
+        self.bits = int(-self.capacity * math.log(error_rate) / math.log(2) ** 2)
+        self.hashes = max(1, round(self.bits / self.capacity * math.log(2)))
+        self.array = bytearray(array) if array is not None else bytearray((self.bits + 7) // 8)
+        # Counts the entries added
+        self.count = count
+
+    # Returns the bit positions for a key, derived from two halves of one hash
+    def _positions(self, key):
+        digest = hashlib.blake2b(key.encode(), digest_size=16).digest()
+        first, second = int.from_bytes(digest[:8], "little"), int.from_bytes(digest[8:], "little")
+        return [(first + i * second) % self.bits for i in range(self.hashes)]
+
+    # Adds a key to the filter
+    def add(self, key):
+        for position in self._positions(key):
+            self.array[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    # Checks whether a key might have been added
+    def __contains__(self, key):
+        return all(self.array[position >> 3] & (1 << (position & 7)) for position in self._positions(key))
+
+
+# Defines the persistent list of emails and LinkedIn URLs that campaigns must skip
+class SuppressionList:
+    """
+    Stores entries in SQLite, unique on (kind, value), and mirrors them into an in-memory Bloom filter
+    so most lookups never touch the database. The filter is saved alongside the entries, so opening
+    the list reads one blob instead of every entry, and it picks up entries other processes add
+    """
+    # Opens the suppression list and loads its entries into the Bloom filter
+    def __init__(self, path=SUPPRESSION_DATABASE):
+        # Stores the location of the suppression list
+        self.path = path
+        self.db = sqlite3.connect(path, timeout=30, isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.executescript(SCHEMA)
+        # Loads the saved filter, or builds one if there isn't one yet
+        saved = self.db.execute("SELECT capacity, count, loaded, bits FROM bloom").fetchone()
+        if saved is None:
+            self._rebuild()
+        else:
+            capacity, count, self.loaded, bits = saved
+            self.bloom = BloomFilter(capacity, array=bits, count=count)
+            self._refresh()
+
+    # Closes the connection to the suppression list
+    def close(self):
+        self.db.close()
+
+    # Builds a new Bloom filter holding every entry, with room for the list to double, and saves it
+    def _rebuild(self):
+        count = self.db.execute("SELECT COUNT(*) FROM suppressed").fetchone()[0]
+        self.bloom = BloomFilter(count * 2)
+        # Stores the ID of the newest entry in the filter
+        self.loaded = 0
+        self._refresh()
+        self._save()
+
+    # Saves the filter so the next process to open the list doesn't have to rebuild it
+    def _save(self):
+        self.db.execute("INSERT OR REPLACE INTO bloom (id, capacity, count, loaded, bits) VALUES (0, ?, ?, ?, ?)",
+                        (self.bloom.capacity, self.bloom.count, self.loaded, bytes(self.bloom.array)))
+
+    # Adds entries written since the filter was last brought up to date, including ones from other processes
+    def _refresh(self):
+        # Rebuilds the filter instead if the new entries would take it past the size it was built for
+        new = self.db.execute("SELECT COUNT(*) FROM suppressed WHERE id > ?", (self.loaded,)).fetchone()[0]
+        if self.bloom.count + new > self.bloom.capacity:
+            return self._rebuild()
+        for entry_id, kind, value in self.db.execute("SELECT id, kind, value FROM suppressed WHERE id > ? ORDER BY id", (self.loaded,)):
+            self.bloom.add(f"{kind}:{value}")
+            self.loaded = entry_id
+
+    # Adds normalized values of one kind to the list, ignoring ones that are already on it, and returns how many were new
+    def add(self, kind, values, reason=None):
+        if kind not in KINDS:
+            raise ValueError(f"Unknown kind {kind!r}; expected one of {', '.join(KINDS)}")
+        now = time.time()
+        before = self.db.total_changes
+        self.db.execute("BEGIN IMMEDIATE")
+        try:
+            self.db.executemany("INSERT OR IGNORE INTO suppressed (kind, value, reason, created_at) VALUES (?, ?, ?, ?)",
+                                [(kind, value, reason, now) for value in values if value])
+            self.db.execute("COMMIT")
+        except Exception:
+            self.db.execute("ROLLBACK")
+            raise
+        added = self.db.total_changes - before
+        self._refresh()
+        self._save()
+        return added
+
+    # Removes normalized values of one kind from the list; the Bloom filter keeps them until the next rebuild, which only costs a lookup
+    def remove(self, kind, values):
+        self.db.executemany("DELETE FROM suppressed WHERE kind = ? AND value = ?", [(kind, value) for value in values])
+
+    # Returns the subset of normalized values of one kind that are on the list
+    def contains(self, kind, values):
+        self._refresh()
+        # Looks up only the values the Bloom filter can't rule out
+        candidates = list({value for value in values if value and f"{kind}:{value}" in self.bloom})
+        found = set()
+        for i in range(0, len(candidates), LOOKUP_SIZE):
+            chunk = candidates[i:i + LOOKUP_SIZE]
+            found.update(row[0] for row in self.db.execute(
+                f"SELECT value FROM suppressed WHERE kind = ? AND value IN ({', '.join('?' * len(chunk))})", (kind, *chunk)))
+        return found
+
+
+# Adds entries to the suppression list when this file is run directly
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Adds emails and LinkedIn URLs to the suppression list")
+    parser.add_argument("action", choices=["add", "remove"])
+    parser.add_argument("--email", action="append", default=[], help="an email address; may be repeated")
+    parser.add_argument("--linkedin", action="append", default=[], help="a LinkedIn profile URL; may be repeated")
+    parser.add_argument("--file", help="a CSV file whose Email and Person Linkedin Url columns are all added")
+    parser.add_argument("--reason", help="why these entries are suppressed, such as unsubscribed or bounced")
+    parser.add_argument("--database", default=SUPPRESSION_DATABASE, help="path to the suppression list")
+    args = parser.parse_args()
+    emails, urls = pd.Series(args.email, dtype=object), pd.Series(args.linkedin, dtype=object)
+    if args.file:
+        contacts = pd.read_csv(args.file, dtype=str, keep_default_na=False)
+        emails = pd.concat([emails, contacts.get("Email", pd.Series(dtype=object))])
+        urls = pd.concat([urls, contacts.get("Person Linkedin Url", pd.Series(dtype=object))])
+    suppression = SuppressionList(args.database)
+    try:
+        for kind, values in (("email", normalize_email(emails)), ("linkedin", normalize_linkedin(urls))):
+            if args.action == "add":
+                print(f"Added {suppression.add(kind, values, args.reason)} {kind} entries")
+            else:
+                suppression.remove(kind, [value for value in values if value])
+    finally:
+        suppression.close()